@@ -0,0 +1,274 @@
+#--------------------------------------------------------------------------------------------
+# GOAL: benchmark every stage of the pipeline on synthetic street networks and rasters (offline):
+#          i. Time (wall and CPU) and peak memory of each stage
+#         ii. Fast implementations checked against the reference ones
+#        iii. Results appended as JSON lines, one per stage, to compare runs across commits
+#--------------------------------------------------------------------------------------------
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+sys.path.append('../')
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from scipy.cluster.hierarchy import cut_tree
+
+from src import synthetic
+from src import get_graph
+from src import get_GDM
+from src import get_GCM
+from src import node_clustering
+from src import tile_clustering
+from src.csr_graph import CSRGraph
+from src.vars import ghsl_crs
+
+#--------------------------------------------------------------------------------------------
+
+_results_path = '../data/benchmarks/benchmark_results.jsonl'
+_generators = ['grid', 'geometric', 'organic']
+_sizes = [1000, 10000, 100000, 1000000] #Reference implementations are skipped above _reference_max_nodes
+_reference_max_nodes = 20000            #Reference (slow) implementations only run on smaller graphs
+_distance_max_nodes = 5000              #Distance matrices use at most this many nodes
+_distance_reference_max_nodes = 2000    #The reference (pairwise) distance matrix only runs on smaller samples
+_memory = True                          #Whether each fast stage runs a second time to trace its peak memory
+
+#--------------------------------------------------------------------------------------------
+
+def get_commit():
+    """
+    return: string, short hash of the current commit (with '-dirty' if there are uncommitted changes), or 'unknown'
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def measure(func, *args, memory=True, **kwargs):
+    """
+    Runs a function once timing it, and a second time tracing the memory it allocates (NumPy included)
+
+    :param func: function to run
+    :param memory: Boolean, whether to run it a second time to get the peak memory
+
+    return: tuple of the output and a dictionary with wall_s, cpu_s, peak_bytes (None if not traced) and error
+    """
+    stats = {'wall_s': None, 'cpu_s': None, 'peak_bytes': None, 'error': None}
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        output = func(*args, **kwargs)
+    except Exception as e:
+        stats['error'] = type(e).__name__ + ': ' + str(e)
+        return None, stats
+    stats['wall_s'] = time.perf_counter() - wall
+    stats['cpu_s'] = time.process_time() - cpu
+
+    if memory:
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            stats['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return output, stats
+
+def run_stage(records, context, stage, fast, reference=None, check=None, run_reference=True, memory=_memory):
+    """
+    Benchmarks one stage: its fast implementation, and its reference one (if any) checked against it
+
+    :param records: list where the result dictionaries are appended
+    :param context: dictionary with the fields shared by the records (run, generator, size...)
+    :param stage: string, name of the stage
+    :param fast: function without arguments, fast implementation
+    :param reference: function without arguments, reference implementation, or None
+    :param check: function receiving both outputs and returning whether they agree
+    :param run_reference: Boolean, whether the reference runs for this size
+
+    return: output of the fast implementation (None if it failed)
+    """
+    output, stats = measure(fast, memory=memory)
+    records.append(dict(context, stage=stage, implementation='fast', **stats))
+
+    if reference is not None and run_reference and output is not None:
+        reference_output, stats = measure(reference, memory=False)
+        if stats['error'] is None and check is not None:
+            try:
+                stats['check'] = bool(check(output, reference_output))
+            except Exception as e:
+                stats['check'] = False
+                stats['error'] = 'check ' + type(e).__name__ + ': ' + str(e)
+        records.append(dict(context, stage=stage, implementation='reference', **stats))
+
+    return output
+
+def same_GCMs(GCMs, reference_GCMs):
+    """
+    Whether two lists of GCMs agree, NaN standing for missing (empty tiles) or undefined (constant orbits) values
+    """
+    for GCM, reference_GCM in zip(GCMs, reference_GCMs):
+        if reference_GCM is None:
+            if not np.isnan(GCM).all():
+                return False
+        elif not np.allclose(GCM, reference_GCM, equal_nan=True):
+            return False
+    return True
+
+def same_simplification(G, H, rtol=0.01):
+    """
+    Whether two simplified networks have about the same numbers of nodes and edges. osmnx merges nodes whose
+      buffers (polygons) intersect, so nodes almost exactly 2*tol apart can be merged differently than with
+      the exact distance: a few nodes differ on random layouts, none on grids
+    """
+    return np.allclose([G.number_of_nodes(), G.number_of_edges()], [H.number_of_nodes(), H.number_of_edges()], rtol=rtol)
+
+def benchmark_network(generator, n_nodes, context, workdir, reference_max_nodes=_reference_max_nodes,
+                      distance_max_nodes=_distance_max_nodes, memory=_memory):
+    """
+    Benchmarks every stage on one synthetic street network
+
+    :param generator: string, one of synthetic.generators
+    :param n_nodes: int, size of the network
+    :param context: dictionary with the fields shared by the records
+    :param workdir: string, directory for the synthetic raster
+
+    return: list of result dictionaries
+    """
+    records = []
+    run_reference = n_nodes <= reference_max_nodes
+
+    graph, stats = measure(synthetic.get_street_graph, generator, n_nodes, memory=False)
+    context = dict(context, generator=generator, size=n_nodes, n_nodes=graph.number_of_nodes(),
+                   n_edges=graph.number_of_edges()//2)
+    records.append(dict(context, stage='generate', implementation='fast', **stats))
+
+    #Simplification (consolidation of intersections), projected as in the pipeline:
+    simplified = run_stage(records, context, 'simplify_graph',
+                           lambda: get_graph.simplify_graph_array(graph, proj=ghsl_crs),
+                           lambda: get_graph.simplify_graph(graph),
+                           same_simplification, run_reference, memory)
+    if simplified is None:
+        return records
+    csr = CSRGraph.from_networkx(simplified)
+
+    #Orbit counts:
+    GDM = run_stage(records, context, 'orbit_counts',
+                    lambda: get_GDM.get_GDM(csr, method='array'),
+                    lambda: get_GDM.get_GDM(csr, method='str'),
+                    np.array_equal, run_reference, memory)
+    if GDM is None:
+        return records
+    nodes_gdf = get_GDM.get_node_geodataframe(csr, GDM)
+
+    #Raster tiles:
+    raster = synthetic.get_synthetic_raster(nodes_gdf.geometry.x.to_numpy(), nodes_gdf.geometry.y.to_numpy(),
+                                            os.path.join(workdir, generator + '_' + str(n_nodes) + '.tif'))
+    ghsl_gdf = run_stage(records, context, 'get_ghsl_gdf', lambda: get_GCM.get_ghsl_gdf(raster), memory=memory)
+
+    #Nodes of each tile:
+    tile_GDMs = run_stage(records, context, 'tile_GDMs',
+                          lambda: get_GCM.get_tile_GDMs(nodes_gdf, raster.transform, raster.height, raster.width, GDM),
+                          lambda: [get_GCM.get_polygon_GDM(polygon, nodes_gdf, GDM) for polygon in ghsl_gdf.geometry],
+                          lambda fast, reference: all(np.array_equal(a, b) for a, b in zip(fast, reference)),
+                          run_reference and ghsl_gdf is not None, memory)
+
+    #GCM of each tile:
+    tile_index = get_GCM.get_node_tile_index(nodes_gdf, raster.transform, raster.height, raster.width)
+    n_tiles = raster.height*raster.width
+    GCMs = run_stage(records, context, 'get_GCM',
+                     lambda: get_GCM.get_GCMs(GDM, tile_index, n_tiles),
+                     lambda: [get_GCM.get_GCM(tile_GDM) if len(tile_GDM) else None for tile_GDM in tile_GDMs],
+                     same_GCMs, run_reference and tile_GDMs is not None, memory)
+
+    #Distances between nodes (on a sample of them):
+    sample_GDM = GDM[:distance_max_nodes]
+    D_cond = run_stage(records, dict(context, n_distance_nodes=len(sample_GDM)), 'get_D_matrix',
+                       lambda: node_clustering.get_D_matrix(sample_GDM, method='chunked'),
+                       lambda: node_clustering.get_D_matrix(sample_GDM, method='pairwise'),
+                       lambda D, D_reference: np.allclose(D, D_reference),
+                       len(sample_GDM) <= _distance_reference_max_nodes, memory)
+
+    #Tile clustering (two stages against the full hierarchy) and flat clusters for every k:
+    if GCMs is not None:
+        valid = ~np.isnan(GCMs).any(axis=(1, 2))
+        tiles_gdf = gpd.GeoDataFrame({'GCM': pd.Series(list(GCMs), dtype=object), 'valid_GCM': valid},
+                                     geometry=get_GCM.get_tile_geometries(*np.divmod(np.arange(n_tiles), raster.width),
+                                                                          raster.transform),
+                                     crs=raster.crs)
+        n_valid = int(valid.sum())
+        tile_context = dict(context, n_tiles=n_valid)
+        if n_valid > 2:
+            clustering = run_stage(records, tile_context, 'HierClustering',
+                                   lambda: tile_clustering.HierClustering(tiles_gdf, method='ward', cache=False),
+                                   memory=memory)
+            run_stage(records, tile_context, 'HierClustering_micro',
+                      lambda: tile_clustering.HierClustering(tiles_gdf, method='ward', cache=False,
+                                                             n_micro_clusters=max(2, min(500, n_valid//4))),
+                      memory=memory)
+            if clustering is not None:
+                k_values = list(range(2, min(51, n_valid+1)))
+                run_stage(records, tile_context, 'all_flat_clusters',
+                          lambda: tile_clustering.cut_linkage(clustering.linkage, k_values),
+                          lambda: cut_tree(clustering.linkage, n_clusters=k_values),
+                          lambda labels, reference: all(len(np.unique(labels[:, j]*n_valid + reference[:, j])) == k
+                                                        for j, k in enumerate(k_values)),
+                          run_reference, memory)
+
+    raster.close()
+    return records
+
+def summarize(records):
+    """
+    :param records: list of result dictionaries
+
+    return: DataFrame with the wall time of each stage (rows) for each network (columns), and failed checks
+    """
+    df = pd.DataFrame(records)
+    df['network'] = df['generator'] + '_' + df['size'].astype(str)
+    summary = df.pivot_table(index=['stage', 'implementation'], columns='network', values='wall_s', aggfunc='first')
+    if 'check' in df:
+        failed = df[df['check'] == False]
+        if len(failed):
+            print('Failed checks:')
+            print(failed[['network', 'stage', 'error']].to_string(index=False))
+    errors = df[df['error'].notna()]
+    if len(errors):
+        print('Errors:')
+        print(errors[['network', 'stage', 'implementation', 'error']].to_string(index=False))
+    return summary
+
+#--------------------------------------------------------------------------------------------
+
+def main(results_path, generators, sizes, reference_max_nodes=_reference_max_nodes,
+         distance_max_nodes=_distance_max_nodes, memory=_memory):
+    context = {'run': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': get_commit(),
+               'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.node(),
+               'cpu_count': os.cpu_count()}
+
+    records = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for generator in generators:
+            for n_nodes in sizes:
+                network_records = benchmark_network(generator, n_nodes, context, workdir, reference_max_nodes,
+                                                    distance_max_nodes, memory)
+                records.extend(network_records)
+
+                #Append as we go, so a long run that fails keeps its results:
+                os.makedirs(os.path.dirname(os.path.abspath(results_path)), exist_ok=True)
+                with open(results_path, 'a') as file:
+                    for record in network_records:
+                        file.write(json.dumps(record, default=str) + '\n')
+
+    print(summarize(records).to_string())
+    return "Benchmark results saved"
+
+if __name__ == '__main__':
+    done = main(_results_path, _generators, _sizes)
@@ -12,22 +12,29 @@ from src import get_cities
 from src import get_boundary
 from src import get_graph
 from src import get_GDM
+from src import instrument
 
 #--------------------------------------------------------------------------------------------
 
 _list_cities_path = '../data/d1_raw/node_list_of_cities.csv'
+_run_log_path = '../data/run_logs/get_graph_data.jsonl'    #One JSON line per stage and city, summary next to it
 
 #--------------------------------------------------------------------------------------------
 
-def main(list_cities_path):
+def main(list_cities_path, run_log_path=_run_log_path):
+    #Record the time, memory and size of every stage of every city:
+    run_log = instrument.RunLog(run_log_path)
     #Get the list of cities and countries:
     all_cities, all_countries = get_cities.get_cities_and_countries(method='csv', test=False, cities_filepath=list_cities_path)
     #Get the administrative boundaries, save them as a dictionary:
-    boundaries_dict = get_boundary.get_boundaries(cities=all_cities, countries=all_countries, method='osmnx', test=False, save=True)
+    boundaries_dict = get_boundary.get_boundaries(cities=all_cities, countries=all_countries, method='osmnx', test=False, save=True,
+                                                  run_log=run_log)
     #Get the street networks, save them as a dictionary:
-    graphs_dict = get_graph.get_graphs(boundaries_dict, test=False, save=True)
+    graphs_dict = get_graph.get_graphs(boundaries_dict, test=False, save=True, run_log=run_log)
     #Get the Graphlet Degree Matrices and the corresponding GeoDataFrames, save tehm as a dictonary
-    GDMs_dict, nodes_gdfs_dict = get_GDM.get_GDMs(graphs_dict, test=False, get_nodes_gdf=True, save=True)
+    GDMs_dict, nodes_gdfs_dict = get_GDM.get_GDMs(graphs_dict, test=False, get_nodes_gdf=True, save=True, run_log=run_log)
+    #Report of the run (slowest stages and cities, failures):
+    run_log.summarize()
     
     return boundaries_dict, graphs_dict, GDMs_dict, nodes_gdfs_dict
 
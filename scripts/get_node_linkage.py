@@ -4,37 +4,53 @@
 #         ii. Linkage matrix for hierarchical clustering of the nodes
 #--------------------------------------------------------------------------------------------
 
+import os
 import sys
+import tempfile
 sys.path.append('../')
 
 from src.utils import load_file, save_file
 from src import node_clustering
+from src import store
+from src import instrument
 
-from joblib import Parallel, delayed
 import multiprocessing
 num_cores = multiprocessing.cpu_count()
 
 #--------------------------------------------------------------------------------------------
 
-_GDMs_dict_path = '../data/d2_processed/GDMs_dict.pickle'
+_GDMs_dict_path = '../data/d2_processed/GDMs_store'
 _clustering_methods = ['single', 'complete', 'average', 'weighted']
+_max_exact_nodes = None     #If set, larger cities get approximate (k-nearest neighbour) linkages, which only
+                            # support single and average: use it with _clustering_methods = ['single', 'average']
+_run_log_path = '../data/run_logs/get_node_linkage.jsonl'    #One JSON line per stage and city, summary next to it
 
 #--------------------------------------------------------------------------------------------
 
-def main(GDMs_dict_path, cluster_methods, num_cores=num_cores):
-    #Load the GDMs dicitonary:
-    GDMs_dict = load_file(GDMs_dict_path)
+def main(GDMs_dict_path, cluster_methods, num_cores=num_cores, max_exact_nodes=_max_exact_nodes, collapse=False,
+         run_log_path=_run_log_path):
+    #Record the time and memory of the distances and linkages of every city (workers append to the same file):
+    run_log = instrument.RunLog(run_log_path)
+    #Load the GDMs dicitonary (memory-mapped if it is the GDM store, so workers receive views of the file):
+    if os.path.isdir(GDMs_dict_path):
+        GDMs_dict = store.GDMStore(GDMs_dict_path)
+    else:
+        GDMs_dict = load_file(GDMs_dict_path)
     keys = list(GDMs_dict.keys())
     GDMs = list(GDMs_dict.values())
     
-    #Get the distance matrices and linkage matrices:
-    outputs = Parallel(n_jobs=num_cores)(delayed(node_clustering.get_Dmatrix_and_linkages)(GDM, cluster_methods=cluster_methods)
-                                                                                           for GDM in GDMs)
-    #Save the distance matrix dictionary:
-    D_matrix_list = [output_tuple[0] for output_tuple in outputs]
-    D_matrix_dict = dict(zip(keys, D_matrix_list))
-    f_path = '../data/d3_results/Dmatrix_dict.pickle'
-    f = save_file(D_matrix_dict, f_path)
+    #Distance matrices are memory-mapped from this directory while the linkage workers use them:
+    with tempfile.TemporaryDirectory(dir='../data/d3_results') as memmap_dir:
+        
+        #Get the distance matrices and linkage matrices, splitting the cores between and within cities:
+        outputs = node_clustering.get_Dmatrix_and_linkages_scheduled(GDMs, cluster_methods, num_cores=num_cores,
+                                                                     max_exact_nodes=max_exact_nodes, collapse=collapse,
+                                                                     memmap_dir=memmap_dir, keys=keys, run_log=run_log)
+        #Save the distance matrix dictionary:
+        D_matrix_list = [output_tuple[0] for output_tuple in outputs]
+        D_matrix_dict = dict(zip(keys, D_matrix_list))
+        f_path = '../data/d3_results/Dmatrix_dict.pickle'
+        f = save_file(D_matrix_dict, f_path)
     
     #Save the linkage dictionaries (one per method):
     i = 0
@@ -45,6 +61,9 @@ def main(GDMs_dict_path, cluster_methods, num_cores=num_cores):
         f = save_file(linkage_dict, f_path)
         i+=1
     
+    #Report of the run (slowest stages and cities, failures):
+    run_log.summarize()
+    
     return "Distance and linkage matrices saved"
 
 if __name__ == '__main__':
@@ -0,0 +1,160 @@
+#--------------------------------------------------------------------------------------------
+# GOAL: compare whole cities by the Graphlet Correlation Matrices (GCMs) of their full street networks
+#--------------------------------------------------------------------------------------------
+
+import os
+import pickle as pkl
+import sys
+sys.path.append('../')
+
+import numpy as np
+from joblib import Parallel, delayed
+
+import multiprocessing
+num_cores = multiprocessing.cpu_count()
+
+from scipy.spatial.distance import cdist
+
+from src.get_GCM import get_GCMs
+from src.vars import config
+
+#--------------------------------------------------------------------------------------------
+
+def get_concatenated_GCMs(GDMs):
+    """
+    Gets the GCM of each of a list of GDMs in one vectorized pass, each GDM being a segment of their concatenation
+
+    :param GDMs: list of np.arrays (N x 15), with at least one row each
+
+    :return np.array of shape (len(GDMs), 11, 11)
+    """
+    GDM = np.concatenate([np.asarray(GDM) for GDM in GDMs])
+    tile_index = np.repeat(np.arange(len(GDMs)), [len(GDM) for GDM in GDMs])
+    return get_GCMs(GDM, tile_index, len(GDMs))
+
+def get_city_GCMs(GDMs, num_cores=num_cores):
+    """
+    Gets the GCM of each city, same as applying get_GCM to each GDM. Cities are split into num_cores
+      groups of about the same number of nodes, and each group is computed in one vectorized pass of
+      get_GCMs (every city is a segment of the concatenated GDMs)
+
+    :param GDMs: list of np.arrays (N x 15) or None
+    :param num_cores: int, number of groups computed at once
+
+    :return np.array of shape (len(GDMs), 11, 11), NaN matrices for cities without GDM
+    """
+    sizes = np.array([0 if GDM is None else len(GDM) for GDM in GDMs], dtype=np.int64)
+    cities = np.flatnonzero(sizes)
+
+    #Consecutive groups with about the same number of nodes:
+    n_groups = max(1, min(num_cores, len(cities)))
+    bounds = np.searchsorted(np.cumsum(sizes[cities]), np.linspace(0, sizes.sum(), n_groups+1)[1:-1], side='right')
+    groups = [group for group in np.split(cities, bounds) if len(group)]
+
+    outputs = Parallel(n_jobs=max(1, len(groups)))(delayed(get_concatenated_GCMs)([GDMs[i] for i in group])
+                                                   for group in groups)
+
+    GCMs = np.full((len(GDMs), 11, 11), np.nan)
+    for group, group_GCMs in zip(groups, outputs):
+        GCMs[group] = group_GCMs
+
+    return GCMs
+
+def splice_condensed(D_cond, n_previous, new_rows):
+    """
+    Adds rows to a condensed distance matrix without building the square matrix: each previous row gets the
+      distances to the new items appended at its end, followed by the rows of the new items
+
+    :param D_cond: condensed distance matrix between n_previous items
+    :param n_previous: int
+    :param new_rows: np.array of shape (m, n_previous+m), distances of the m new items to all items (previous first)
+
+    :return condensed distance matrix between the n_previous+m items
+    """
+    m = len(new_rows)
+    n = n_previous + m
+    D_new = np.empty(n*(n-1)//2)
+
+    #Row i of a condensed matrix holds the distances from item i to the items after it:
+    old_start = new_start = 0
+    for i in range(n_previous):
+        length = n_previous - i - 1
+        D_new[new_start:new_start+length] = D_cond[old_start:old_start+length]
+        D_new[new_start+length:new_start+length+m] = new_rows[:, i]
+        old_start += length
+        new_start += length + m
+    for k in range(m):
+        D_new[new_start:new_start+m-k-1] = new_rows[k, n_previous+k+1:]
+        new_start += m-k-1
+
+    return D_new
+
+def get_city_GCD(GDMs_dict, previous=None, num_cores=num_cores):
+    """
+    Gets the Graphlet Correlation Distance between every pair of cities. If a previous result is given,
+      only the GCMs of the cities it does not have (with or without a valid GCM) and their rows of the
+      distance matrix are computed
+
+    :param GDMs_dict: dictionary, keys are tuples (city, country) and values are GDMs (or None)
+    :param previous: dictionary returned by get_city_GCD on some of the cities, or None
+    :param num_cores: int, number of processes computing GCMs
+
+    :return dictionary with:
+        - keys: list of tuples (city, country) with a valid GCM, previous cities first
+        - GCMs: np.array of shape (len(keys), 11, 11)
+        - D_cond: condensed GCD matrix between the cities, in the order of keys
+        - invalid_keys: list of tuples (city, country) without a valid GCM, skipped in later updates
+    """
+    if previous is None:
+        previous = {'keys': [], 'GCMs': np.zeros((0, 11, 11)), 'D_cond': np.zeros(0), 'invalid_keys': []}
+    previous_invalid_keys = list(previous.get('invalid_keys', []))
+    previous_keys = set(previous['keys']) | set(previous_invalid_keys)
+    new_keys = [key for key in GDMs_dict.keys() if key not in previous_keys]
+
+    #GCMs of the new cities, dropping those without a valid one (no nodes, or constant orbits):
+    new_GCMs = get_city_GCMs([GDMs_dict[key] for key in new_keys], num_cores=num_cores)
+    valid = ~np.isnan(new_GCMs).any(axis=(1, 2))
+    invalid_keys = previous_invalid_keys + [key for key, is_valid in zip(new_keys, valid) if not is_valid]
+    new_keys = [key for key, is_valid in zip(new_keys, valid) if is_valid]
+    new_GCMs = new_GCMs[valid]
+
+    #Distances from the new cities to all cities, spliced into the previous condensed matrix:
+    n_previous = len(previous['keys'])
+    GCMs = np.concatenate([previous['GCMs'], new_GCMs])
+    i, j = np.triu_indices(GCMs.shape[1], k=1)
+    new_rows = cdist(new_GCMs[:, i, j], GCMs[:, i, j], metric='euclidean')
+
+    return {'keys': list(previous['keys']) + new_keys, 'GCMs': GCMs,
+            'D_cond': splice_condensed(previous['D_cond'], n_previous, new_rows), 'invalid_keys': invalid_keys}
+
+def update_city_GCD(GDMs_dict, save=True, test=False, filepath=None, num_cores=num_cores):
+    """
+    Updates the city GCD file with the cities of GDMs_dict that are not in it yet (creating it if needed)
+
+    :param GDMs_dict: dictionary, keys are tuples (city, country) and values are GDMs (or None)
+
+    :return dictionary with keys, GCMs, D_cond, and invalid_keys (see get_city_GCD)
+    """
+    if filepath is None:
+        if test:
+            filepath = config.get_path('test-run/city_GCD.pickle')
+        else:
+            filepath = config.get_path('d3_results/city_GCD.pickle')
+
+    previous = None
+    if os.path.exists(filepath):
+        with open(filepath, 'rb') as file:
+            previous = pkl.load(file)
+
+    city_GCD = get_city_GCD(GDMs_dict, previous=previous, num_cores=num_cores)
+
+    if save:
+        with open(filepath, 'wb') as file:
+            pkl.dump(city_GCD, file)
+
+    return city_GCD
+
+#--------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,143 @@
+#--------------------------------------------------------------------------------------------
+# GOAL: compact representation of street networks, keeping only node coordinates and adjacency
+#--------------------------------------------------------------------------------------------
+
+import sys
+sys.path.append('../')
+
+import numpy as np
+import networkx as nx
+import pyproj
+
+#--------------------------------------------------------------------------------------------
+
+class CSRGraph:
+    """
+    Undirected simple graph in Compressed Sparse Row (CSR) form: the neighbours of node i are
+      indices[indptr[i]:indptr[i+1]], sorted, without self-loops or parallel edges. Nodes are the
+      positions 0, ..., N-1, following the order of the networkx graph they come from.
+
+    :attr indptr: np.array of int32 and shape (N+1,)
+    :attr indices: np.array of int32 and shape (2E,)
+    :attr x: np.array of float64 and shape (N,), node coordinates in crs
+    :attr y: np.array of float64 and shape (N,), node coordinates in crs
+    :attr osmid: np.array of int64 and shape (N,) with the original node labels, None if they were 0, ..., N-1
+    :attr crs: crs of the coordinates
+    """
+
+    def __init__(self, indptr, indices, x, y, osmid=None, crs=None):
+        self.indptr = np.ascontiguousarray(indptr, dtype=np.int32)
+        self.indices = np.ascontiguousarray(indices, dtype=np.int32)
+        self.x = np.ascontiguousarray(x, dtype=np.float64)
+        self.y = np.ascontiguousarray(y, dtype=np.float64)
+        self.osmid = None if osmid is None else np.ascontiguousarray(osmid, dtype=np.int64)
+        self.crs = crs
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def number_of_nodes(self):
+        return len(self)
+
+    def number_of_edges(self):
+        return len(self.indices) // 2
+
+    def degree(self):
+        """
+        return: np.array with the degree of each node
+        """
+        return np.diff(self.indptr)
+
+    def edge_array(self):
+        """
+        Gets each edge once, as the positions of its endpoints (smallest first)
+
+        return: np.array of int32 and shape (E, 2)
+        """
+        sources = np.repeat(np.arange(len(self), dtype=np.int32), self.degree())
+        upper = sources < self.indices
+        return np.ascontiguousarray(np.column_stack([sources[upper], self.indices[upper]]))
+
+    @classmethod
+    def from_edges(cls, n_nodes, edges, x, y, osmid=None, crs=None):
+        """
+        Builds the CSR arrays from a list of edges, dropping self-loops and parallel edges
+
+        :param n_nodes: int
+        :param edges: np.array of shape (E, 2) with node positions, in any direction
+        :param x: np.array of shape (N,)
+        :param y: np.array of shape (N,)
+        :param osmid: np.array of shape (N,) with the original node labels, or None
+        :param crs: crs of the coordinates
+
+        return: CSRGraph
+        """
+        edges = np.sort(np.asarray(edges, dtype=np.int64).reshape(-1, 2), axis=1)
+        edges = np.unique(edges[edges[:, 0] != edges[:, 1]], axis=0)
+
+        #Both directions, sorted by source and then by target:
+        sources = np.concatenate([edges[:, 0], edges[:, 1]])
+        targets = np.concatenate([edges[:, 1], edges[:, 0]])
+        order = np.lexsort((targets, sources))
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(sources, minlength=n_nodes))])
+
+        return cls(indptr, targets[order], x, y, osmid, crs)
+
+    @classmethod
+    def from_networkx(cls, graph):
+        """
+        :param graph: networkx graph whose nodes have x and y attributes (e.g. an osmnx street network)
+
+        return: CSRGraph, with the crs of graph.graph['crs']
+        """
+        nodes = list(graph.nodes)
+        index = {node: i for i, node in enumerate(nodes)}
+        edges = np.fromiter((index[node] for edge in graph.edges(data=False) for node in edge[:2]),
+                            dtype=np.int64, count=2*graph.number_of_edges()).reshape(-1, 2)
+        x = np.fromiter((x for _, x in graph.nodes(data='x')), dtype=np.float64, count=len(nodes))
+        y = np.fromiter((y for _, y in graph.nodes(data='y')), dtype=np.float64, count=len(nodes))
+
+        #Labels are only kept if they are not the positions already:
+        osmid = None if nodes == list(range(len(nodes))) else np.array(nodes, dtype=np.int64)
+
+        return cls.from_edges(len(nodes), edges, x, y, osmid, graph.graph.get('crs'))
+
+    def to_networkx(self):
+        """
+        return: networkx.Graph with x and y node attributes, labelled by osmid if available
+        """
+        labels = np.arange(len(self)) if self.osmid is None else self.osmid
+        graph = nx.Graph(crs=self.crs)
+        graph.add_nodes_from((label, {'x': x, 'y': y}) for label, x, y in zip(labels.tolist(), self.x.tolist(), self.y.tolist()))
+        graph.add_edges_from(labels[self.edge_array()].tolist())
+        return graph
+
+    def save(self, filepath):
+        """
+        Writes the arrays (uncompressed) to a .npz file, the crs is kept as WKT
+
+        :param filepath: string
+        """
+        arrays = {'indptr': self.indptr, 'indices': self.indices, 'x': self.x, 'y': self.y}
+        if self.osmid is not None:
+            arrays['osmid'] = self.osmid
+        if self.crs is not None:
+            arrays['crs'] = np.array(pyproj.CRS.from_user_input(self.crs).to_wkt())
+        np.savez(filepath, **arrays)
+
+    @classmethod
+    def load(cls, filepath):
+        """
+        :param filepath: string, .npz file written by CSRGraph.save
+
+        return: CSRGraph
+        """
+        with np.load(filepath) as arrays:
+            return cls(arrays['indptr'], arrays['indices'], arrays['x'], arrays['y'],
+                       osmid=arrays['osmid'] if 'osmid' in arrays else None,
+                       crs=str(arrays['crs']) if 'crs' in arrays else None)
+
+#--------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    pass
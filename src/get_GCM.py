@@ -14,16 +14,15 @@ from scipy import stats
 import networkx as nx
 
 import geopandas as gpd
-import osmnx as ox
-
-import rasterio as rio
-from rasterio.mask import mask
 
+import shapely
 from shapely.geometry import shape
-from shapely.geometry import Polygon
+from shapely.geometry import box
 
 from src.utils import load_file
-from src.vars import ghsl_data, ghsl_crs, redundant_orbits, ghsl_resolution
+from src import store
+from src import instrument
+from src.vars import config, ghsl_crs, redundant_orbits, ghsl_resolution
 
 test=False
 
@@ -67,6 +66,89 @@ def get_GCM(GDM):
     
     return GCM
 
+def get_segment_ranks(values, segment_ids):
+    """
+    Ranks values separately within each segment, ties get their average rank (as scipy's rankdata)
+    
+    :param values: np.array of shape (n,)
+    :param segment_ids: np.array of n non-negative ints, segment of each value
+    
+    return: np.array of shape (n,) with ranks starting at 1 in every segment
+    """
+    
+    #Sort by segment, then by value:
+    order = np.lexsort((values, segment_ids))
+    sorted_values = values[order]
+    sorted_segments = segment_ids[order]
+    
+    #Positions where a new segment or a new value (tie group) starts:
+    n = len(values)
+    positions = np.arange(n)
+    new_segment = np.ones(n, dtype=bool)
+    new_segment[1:] = sorted_segments[1:] != sorted_segments[:-1]
+    new_group = new_segment.copy()
+    new_group[1:] |= sorted_values[1:] != sorted_values[:-1]
+    
+    #First position of the segment and first/last positions of the tie group of each element:
+    segment_start = np.maximum.accumulate(np.where(new_segment, positions, 0))
+    group_ids = np.cumsum(new_group) - 1
+    group_start = positions[new_group]
+    group_end = np.append(group_start[1:], n) - 1
+    
+    sorted_ranks = (group_start[group_ids] + group_end[group_ids])/2 - segment_start + 1
+    
+    ranks = np.empty(n)
+    ranks[order] = sorted_ranks
+    return ranks
+
+def get_GCMs(full_GDM, tile_index, n_tiles, redundant_orbits=redundant_orbits):
+    """
+    Gets the Graphlet Correlation Matrices of many tiles at once, same as applying get_GCM to the GDM of
+      each tile: the non-redundant orbits are ranked within each tile (plus the dummy signature) and the
+      Spearman correlations of every tile are computed in one vectorized pass
+    
+    :param full_GDM: np.array of shape N x 15, the Graphlet Degree Matrix of all nodes
+    :param tile_index: np.array of N ints, tile of each node (from 0 to n_tiles-1, -1 for nodes in no tile)
+    :param n_tiles: int, number of tiles
+    
+    return: np.array of shape (n_tiles, 11, 11), NaN matrices for tiles without nodes
+    """
+    
+    kept_orbits = [i for i in range(full_GDM.shape[1]) if i not in redundant_orbits]
+    length = len(kept_orbits)
+    GCMs = np.full((n_tiles, length, length), np.nan)
+    
+    #Nodes in some tile, and one dummy signature for each tile with nodes:
+    tile_index = np.asarray(tile_index)
+    inside = tile_index >= 0
+    tiles_with_nodes = np.unique(tile_index[inside])
+    if len(tiles_with_nodes) == 0:
+        return GCMs
+    segment_ids = np.concatenate([tile_index[inside], tiles_with_nodes])
+    GDM = np.concatenate([full_GDM[inside][:, kept_orbits],
+                          np.ones((len(tiles_with_nodes), length), dtype=full_GDM.dtype)])
+    
+    #Ranks centred on their tile mean, the mean rank of a tile with m rows is (m+1)/2:
+    sizes = np.bincount(segment_ids, minlength=n_tiles)
+    centred_ranks = np.empty(GDM.shape)
+    for i in range(length):
+        centred_ranks[:, i] = get_segment_ranks(GDM[:, i], segment_ids) - (sizes[segment_ids]+1)/2
+    
+    #Covariance of every pair of orbits within each tile:
+    cov = np.zeros((n_tiles, length, length))
+    for i in range(length):
+        for j in range(i, length):
+            cov[:, i, j] = np.bincount(segment_ids, weights=centred_ranks[:, i]*centred_ranks[:, j], minlength=n_tiles)
+            cov[:, j, i] = cov[:, i, j]
+    
+    #Normalize to get the correlations:
+    std = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = cov / std[:, :, None] / std[:, None, :]
+    GCMs[tiles_with_nodes] = np.clip(corr[tiles_with_nodes], -1, 1)
+    
+    return GCMs
+
 def clip_raster(raster_data, boundary_geometry, filepath=None):
     """
     Clips raster data according to Polygon and saves the file
@@ -77,6 +159,9 @@ def clip_raster(raster_data, boundary_geometry, filepath=None):
     
     return: rasterio DatasetReader object
     """
+    import rasterio as rio
+    from rasterio.mask import mask
+    
     #Project the boundary:
     boundary_proj = boundary_geometry.to_crs(raster_data.crs)['geometry']
     
@@ -91,7 +176,7 @@ def clip_raster(raster_data, boundary_geometry, filepath=None):
     
     #Save the raster file:
     if filepath is None:
-        filepath = '../data/d2_processed/clipped_raster.tif'
+        filepath = config.get_path('d2_processed/clipped_raster.tif')
     
     with rio.open(filepath, 'w', **out_meta) as dest:
         dest.write(out_image)
@@ -111,9 +196,10 @@ def get_ghsl_gdf_contiguous(ghsl_raster_data, value_name='classification'):
     
     return: GeoDataFrame object with all the tile geometries
     """
+    import rasterio.features
     
     #Read the data and get contiguous shapes:
-    shapes = rio.features.shapes(ghsl_raster_data.read(1))
+    shapes = rasterio.features.shapes(ghsl_raster_data.read(1))
     #Read the shapes and values as separate lists:
     values = []
     geometries = []
@@ -130,7 +216,33 @@ def get_ghsl_gdf_contiguous(ghsl_raster_data, value_name='classification'):
 
     return gdf
 
-def get_ghsl_gdf(ghsl_raster_data, value_name='classification', box_len=ghsl_resolution):
+def get_tile_geometries(rows, cols, transform, box_len=ghsl_resolution):
+    """
+    Builds the pixel boxes of a raster in a single vectorized pass from its affine transformation
+    
+    :param rows: array of ints, row index of each pixel
+    :param cols: array of ints, column index of each pixel
+    :param transform: affine.Affine, transformation of the raster (pixel indices to coordinates)
+    :param box_len: tuple of ints, length of a GHSL tile i.e. resolution of the raster data. Default is 1km.
+    
+    return: np.array of shapely Polygons
+    """
+    
+    #Upper left corner of every pixel:
+    cols = np.asarray(cols, dtype=float)
+    rows = np.asarray(rows, dtype=float)
+    ul_x = transform.a*cols + transform.b*rows + transform.c
+    ul_y = transform.d*cols + transform.e*rows + transform.f
+    
+    #Array-based creation with shapely 2, otherwise build the boxes one by one:
+    if hasattr(shapely, 'box'):
+        geometries = shapely.box(ul_x, ul_y - box_len[1], ul_x + box_len[0], ul_y)
+    else:
+        geometries = np.array([box(x, y - box_len[1], x + box_len[0], y) for x, y in zip(ul_x, ul_y)], dtype=object)
+    
+    return geometries
+
+def get_ghsl_gdf(ghsl_raster_data, value_name='classification', box_len=ghsl_resolution, geometry=True):
     """
     Transforms raster data into GeoDataFrame with 'geometry' and 'classification' (values) columns, each
      geometry corresponds to a pixel
@@ -138,8 +250,10 @@ def get_ghsl_gdf(ghsl_raster_data, value_name='classification', box_len=ghsl_res
     :param ghsl_raster_data: rasterio DatasetReader object
     :param value_name: string
     :param box_len: tuple of ints, length of a GHSL tile i.e. resolution of the raster data. Default is 1km.
+    :param geometry: Boolean, if False skip the geometries and return a DataFrame with the pixel indices only,
+                     polygons can be created later with get_tile_geometries
     
-    return: GeoDataFrame object with all the tile geometries
+    return: GeoDataFrame object with all the tile geometries, and 'row' and 'col' columns with pixel indices
     """
     
     #Get the values:
@@ -147,22 +261,18 @@ def get_ghsl_gdf(ghsl_raster_data, value_name='classification', box_len=ghsl_res
     values = values_arr.flatten()
     values_processed = np.where(values == ghsl_raster_data.nodata, np.nan, values)
     
-    #Get the box corners using the affine transformation:    
-    box_width = box_len[0]
-    box_height = box_len[1]
-    geometries = []
-    for row_idx in range(ghsl_raster_data.height):
-        for col_idx in range(ghsl_raster_data.width):
-            ul_x, ul_y = ghsl_raster_data.xy(row_idx, col_idx, offset='ul')
-            box = [(ul_x, ul_y),
-                  (ul_x + box_width, ul_y),
-                  (ul_x + box_width, ul_y - box_height),
-                  (ul_x, ul_y - box_height)]
-            geometries.append(Polygon(box))
+    #Get the pixel indices, in the same (row-major) order as the values:
+    rows, cols = np.divmod(np.arange(values.size), ghsl_raster_data.width)
+    df = pd.DataFrame({'row': rows, 'col': cols, value_name: values_processed})
+    
+    if not geometry:
+        return df
+    
+    #Get the boxes using the affine transformation:
+    geometries = get_tile_geometries(rows, cols, ghsl_raster_data.transform, box_len)
             
     #Creat the GeoDataFrame and return:
-    gdf = gpd.GeoDataFrame({value_name: values_processed, 'geometry': geometries},
-                           crs=ghsl_raster_data.crs)
+    gdf = gpd.GeoDataFrame(df, geometry=geometries, crs=ghsl_raster_data.crs)
 
     return gdf
 
@@ -188,6 +298,67 @@ def get_polygon_GDM(polygon, node_gdf, full_GDM=None):
     polygon_GDM = full_GDM[node_is_within_polygon_arr]
     return polygon_GDM
 
+def get_node_tile_index(node_gdf, transform, height, width, crs=None):
+    """
+    Finds the raster pixel (tile) containing each node with the inverse affine transformation
+    
+    :param node_gdf: GeoDataFrame of all N nodes (geometries are points)
+    :param transform: affine.Affine, transformation of the raster (pixel indices to coordinates)
+    :param height: int, number of rows of the raster
+    :param width: int, number of columns of the raster
+    :param crs: crs of the raster, nodes are projected to it if given
+    
+    return: np.array of N ints, flat (row-major) index of the tile of each node, -1 if outside the raster
+    """
+    
+    #Make sure the nodes are in the raster projection:
+    if crs is not None and node_gdf.crs != crs:
+        node_gdf = node_gdf.to_crs(crs)
+    x = node_gdf.geometry.x.to_numpy()
+    y = node_gdf.geometry.y.to_numpy()
+    
+    #Pixel coordinates of every node at once:
+    inverse = ~transform
+    cols = np.floor(inverse.a*x + inverse.b*y + inverse.c).astype(np.int64)
+    rows = np.floor(inverse.d*x + inverse.e*y + inverse.f).astype(np.int64)
+    
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    tile_index = np.where(inside, rows*width + cols, -1)
+    
+    return tile_index
+
+def get_tile_GDMs(node_gdf, transform, height, width, full_GDM=None, crs=None, tile_index=None):
+    """
+    Obtains the Graphlet Degree Matrix (GDM) of the network inside each pixel of a raster, grouping
+      the nodes by their tile index instead of testing every node against every tile polygon
+    
+    :param node_gdf: GeoDataFrame of all N nodes (geometries are points)
+    :param transform: affine.Affine, transformation of the raster (pixel indices to coordinates)
+    :param height: int, number of rows of the raster
+    :param width: int, number of columns of the raster
+    :param full_GDM: np.array with N rows, if None then nodes_gdf must contain the GDV of each node
+    :param crs: crs of the raster, nodes are projected to it if given
+    :param tile_index: np.array of N ints, output of get_node_tile_index if already computed
+    
+    return: np.array of height*width objects, the GDM of each tile in row-major order
+    """
+    
+    #Get the GDM if we do not have it:
+    if full_GDM is None:
+        full_GDM = np.stack(node_gdf['GDV'].values)
+    
+    #Sort the nodes inside the raster by tile and split the GDM:
+    if tile_index is None:
+        tile_index = get_node_tile_index(node_gdf, transform, height, width, crs)
+    inside = np.flatnonzero(tile_index >= 0)
+    order = inside[np.argsort(tile_index[inside], kind='stable')]
+    counts = np.bincount(tile_index[inside], minlength=height*width)
+    
+    tile_GDMs = np.empty(height*width, dtype=object)
+    tile_GDMs[:] = np.split(full_GDM[order], np.cumsum(counts)[:-1])
+    
+    return tile_GDMs
+
 def refine_city_gdf(city_gdf, city, country):
     """
     Prepares each city's GHSL GeoDataFrame to the combinated gdf
@@ -212,19 +383,29 @@ def refine_city_gdf(city_gdf, city, country):
     return city_gdf    
 
 def get_ghsl_geodataframe(node_gdfs_dict, boundaries_dict,
-                          ghsl_data=ghsl_data, proj=ghsl_crs,
+                          ghsl_data=None, proj=ghsl_crs,
                           test=test,
-                          save=True, filepath=None):
+                          save=True, filepath=None,
+                          assignment='raster', storage='store', store_dir=None, run_log=None):
     """
     Get GeoDataFrame of GHSL tiles
     
     :param nodes_gdfs_dict: dictionary with node geodataframes, keys are tuples (city, country)
     :param boundaries_dict: dictionary with city boundaries, keys are tuples (city, country)
-    :param ghsl_data: raster data from GHSL with classification
+    :param ghsl_data: raster data from GHSL with classification, default is config.ghsl_data (opened on first use)
     :param proj: crs to project the gdf (using the default GHSL throughout the project, Mollweide)
     :param test: Boolean, whether this is the test run
     :param save: Boolean, whether the geodataframe should be saved
     :param filepath: string, filepath if non-default path is desired
+    :param assignment: 'raster' or 'polygon', how nodes are assigned to tiles. 'raster' (default) finds the pixel of
+                       every node from the raster transformation, 'polygon' tests containment in each tile geometry
+                       (slower, but also valid for irregular geometries)
+    :param storage: 'store' or 'pickle'. With 'store' (default) each city is written once as a partition of the
+                    tile store (see src.store) and cities already in its manifest are not computed again, but
+                    are still returned (also if save is False). With 'pickle' the full GeoDataFrame is
+                    concatenated and re-pickled after every city
+    :param store_dir: string, directory of the tile store if non-default path is desired
+    :param run_log: instrument.RunLog where the tile assignment and GCM stages of each city are recorded, or None
     
     return: GeoDataFrame with all GHSL tiles with columns
             - classification: degree of urbanization according to GHSL documentation
@@ -232,23 +413,49 @@ def get_ghsl_geodataframe(node_gdfs_dict, boundaries_dict,
             - GCM: Graphlet Correlation Matrix (11x11) for that tile
             - valid_GCM: Boolean Series, flags tiles with valid GCM (only finite values) 
             - city, country: identification of the tile
+            - row, col: index of the tile in the city raster
     """
     
-    if filepath is None:
-        if test:
-            filepath = '../data/test-run/tiles_gdf.pickle'
-        else:
-            filepath = '../data/d2_processed/tiles_gdf.pickle'
-            
-    #Maybe the ghsl tiles gdf already begun to be available, so we load it and add to list:    
-    try:
-        ghsl_tiles_gdf = load_file(filepath)
-        ghsl_gdfs = [ghsl_tiles_gdf]
-        existing_cities = list(set(ghsl_tiles_gdf['city']))
-    except FileNotFoundError:
+    if assignment not in ['raster', 'polygon']:
+        print('Invalid assignment. Only valid parameters are raster and polygon.')
+        return None
+    
+    if storage not in ['store', 'pickle']:
+        print('Invalid storage. Only valid parameters are store and pickle.')
+        return None
+    
+    if ghsl_data is None:
+        ghsl_data = config.ghsl_data
+    
+    if storage == 'store':
+        if store_dir is None:
+            if test:
+                store_dir = config.get_path('test-run/tiles_store')
+            else:
+                store_dir = config.get_path('d2_processed/tiles_store')
+        
+        #Resume from the cities already in the store:
         ghsl_gdfs = []
+        existing_keys = [(entry['city'], entry['country']) for partition, entry in store.get_partitions(store_dir)]
         existing_cities = []
     
+    else:
+        existing_keys = []
+        if filepath is None:
+            if test:
+                filepath = config.get_path('test-run/tiles_gdf.pickle')
+            else:
+                filepath = config.get_path('d2_processed/tiles_gdf.pickle')
+                
+        #Maybe the ghsl tiles gdf already begun to be available, so we load it and add to list:    
+        try:
+            ghsl_tiles_gdf = load_file(filepath)
+            ghsl_gdfs = [ghsl_tiles_gdf]
+            existing_cities = list(set(ghsl_tiles_gdf['city']))
+        except FileNotFoundError:
+            ghsl_gdfs = []
+            existing_cities = []
+    
     na_counter=1  #for cities named N/A
     
     for city, country in tqdm(node_gdfs_dict.keys()):
@@ -258,7 +465,7 @@ def get_ghsl_geodataframe(node_gdfs_dict, boundaries_dict,
         node_gdf = node_gdfs_dict[(city, country)]
         boundary_polygon = boundaries_dict[(city, country)][['geometry']]
         
-        if node_gdf is not None and city not in existing_cities: #and city not in ['Tokyo', 'Algiers', 'London']:
+        if node_gdf is not None and city not in existing_cities and (city, country) not in existing_keys:
         
             #We will save the clipped rasters, so we must know the filename:
             if '/' in city:
@@ -268,24 +475,51 @@ def get_ghsl_geodataframe(node_gdfs_dict, boundaries_dict,
                 clipped_raster_filename = city + '_' + country
                 
             if test:
-                clipped_raster_filepath = '../data/test-run/cities-GHSL/' + clipped_raster_filename + '.tif'
+                clipped_raster_filepath = config.get_path('test-run/cities-GHSL/' + clipped_raster_filename + '.tif')
             else:
-                clipped_raster_filepath = '../data/d2_processed/cities-GHSL/' + clipped_raster_filename + '.tif'
+                clipped_raster_filepath = config.get_path('d2_processed/cities-GHSL/' + clipped_raster_filename + '.tif')
 
 
             #Get the clipped raster according to city boundary and the GHSL gdf:
-            clipped_raster = clip_raster(ghsl_data, boundary_polygon, filepath=clipped_raster_filepath)
-            ghsl_gdf = get_ghsl_gdf(clipped_raster)
+            with instrument.stage(run_log, 'tile_assignment', (city, country), assignment=assignment) as record:
+                clipped_raster = clip_raster(ghsl_data, boundary_polygon, filepath=clipped_raster_filepath)
+                ghsl_gdf = get_ghsl_gdf(clipped_raster)
 
-            #Get the GDM of each tile and add the column to the GeoDataFrame:
-            full_GDM = np.stack(node_gdf['GDV'].values)
-            ghsl_gdf['GDM'] = ghsl_gdf['geometry'].apply(get_polygon_GDM, node_gdf=node_gdf, full_GDM=full_GDM)
+                #Get the GDM of each tile and add the column to the GeoDataFrame:
+                full_GDM = np.stack(node_gdf['GDV'].values)
+                if assignment == 'raster':
+                    height, width = clipped_raster.height, clipped_raster.width
+                    node_tile_index = get_node_tile_index(node_gdf, clipped_raster.transform, height, width, clipped_raster.crs)
+                    tile_GDMs = get_tile_GDMs(node_gdf, clipped_raster.transform, height, width,
+                                              full_GDM=full_GDM, tile_index=node_tile_index)
+                    tile_index = (ghsl_gdf['row']*width + ghsl_gdf['col']).to_numpy()
+                    ghsl_gdf['GDM'] = pd.Series(tile_GDMs[tile_index], index=ghsl_gdf.index, dtype=object)
+                else:
+                    ghsl_gdf['GDM'] = ghsl_gdf['geometry'].apply(get_polygon_GDM, node_gdf=node_gdf, full_GDM=full_GDM)
+                record.update(n_nodes=len(node_gdf), n_tiles=len(ghsl_gdf))
 
-            #Get the GCM of each tile:
-            ghsl_gdf['GCM'] = ghsl_gdf['GDM'].apply(get_GCM)
+            with instrument.stage(run_log, 'GCM', (city, country), n_nodes=len(node_gdf), n_tiles=len(ghsl_gdf)):
+                if assignment == 'raster':
+                    #Get the GCM of all tiles in one pass (None for tiles without nodes, as get_GCM):
+                    GCMs = get_GCMs(full_GDM, node_tile_index, height*width)[tile_index]
+                    has_nodes = np.bincount(node_tile_index[node_tile_index >= 0], minlength=height*width)[tile_index] > 0
+                    ghsl_gdf['GCM'] = pd.Series([GCM if valid else None for GCM, valid in zip(GCMs, has_nodes)],
+                                                index=ghsl_gdf.index, dtype=object)
+                else:
+                    #Get the GCM of each tile:
+                    ghsl_gdf['GCM'] = ghsl_gdf['GDM'].apply(get_GCM)
 
             #Refine the gdf:
             new_ghsl_gdf = refine_city_gdf(ghsl_gdf, city, country)
+            
+            #Write the city partition once, or keep it in memory if not saving:
+            if storage == 'store':
+                if save:
+                    store.save_city_tiles(new_ghsl_gdf, city, country, store_dir,
+                                          clipped_raster.transform, clipped_raster.crs)
+                else:
+                    ghsl_gdfs.append(new_ghsl_gdf.to_crs(proj))
+                continue
 
             #Add the GeoDataFrame to our list:
             ghsl_gdfs.append(ghsl_gdf)
@@ -297,13 +531,23 @@ def get_ghsl_geodataframe(node_gdfs_dict, boundaries_dict,
             if save:
                 if filepath is None:
                     if test:
-                        filepath = '../data/test-run/tiles_gdf.pickle'
+                        filepath = config.get_path('test-run/tiles_gdf.pickle')
                     else:
-                        filepath = '../data/d2_processed/tiles_gdf.pickle'
+                        filepath = config.get_path('d2_processed/tiles_gdf.pickle')
 
                 with open(filepath, 'wb') as file:
                     pkl.dump(ghsl_gdf, file)
     
+    #Read the store once at the end (without saving, the cities already stored plus those computed here):
+    if storage == 'store':
+        if save:
+            ghsl_gdf = store.load_tiles(store_dir, cities=list(node_gdfs_dict.keys()), proj=proj)
+        else:
+            stored_keys = [key for key in node_gdfs_dict.keys() if key in existing_keys]
+            if stored_keys:
+                ghsl_gdfs.insert(0, store.load_tiles(store_dir, cities=stored_keys, proj=proj))
+            ghsl_gdf = gpd.GeoDataFrame(pd.concat(ghsl_gdfs, ignore_index=True)) if ghsl_gdfs else None
+    
     return ghsl_gdf
 
 #--------------------------------------------------------------------------------------------
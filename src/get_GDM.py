@@ -5,15 +5,19 @@
 import pickle as pkl
 import sys
 from tqdm import tqdm
+from joblib import Parallel, delayed
 sys.path.append('../')
 
 import numpy as np
 import pandas as pd
+import geopandas as gpd
 import networkx as nx
-import osmnx as ox
 
-from src.vars import ghsl_crs
+from src.vars import config, ghsl_crs
 from src.orcalib import orca
+from src.csr_graph import CSRGraph
+from src import store
+from src import instrument
 
 test=False
 
@@ -24,19 +28,150 @@ def get_node_geodataframe(graph, GDM, proj=ghsl_crs):
     Get GeoDataFrame with the nodes of the street networks (represented as points) and
       their respective Graphlet Degree Vectors (GDVs)
     
-    :param graph: simplified street network whose nodes are indexed sequentially as integers
+    :param graph: simplified street network whose nodes are indexed sequentially as integers, or CSRGraph
     :param GDM: Graphlet Degree Matrix (GDM), rows correspond to nodes via index
     :param proj: crs to project the gdf (using the default GHSL throughout the project, Mollweide)
     
     return: GeoDataFrame, geometries are points (nodes) and GDVs are arrays of integers
     """    
-    nodes_gdf = ox.graph_to_gdfs(graph, edges=False).to_crs(proj)
-    nodes_gdf['GDV'] = pd.Series(GDM)
+    if isinstance(graph, CSRGraph):
+        index = pd.RangeIndex(len(graph), name='osmid') if graph.osmid is None else pd.Index(graph.osmid, name='osmid')
+        nodes_gdf = gpd.GeoDataFrame({'y': graph.y, 'x': graph.x}, index=index,
+                                     geometry=gpd.points_from_xy(graph.x, graph.y), crs=graph.crs).to_crs(proj)
+    else:
+        import osmnx as ox
+        nodes_gdf = ox.graph_to_gdfs(graph, edges=False).to_crs(proj)
+    nodes_gdf['GDV'] = pd.Series(list(GDM), index=nodes_gdf.index)
     
     return nodes_gdf
 
 
-def get_GDMs(graphs_dict, graphlets_up_to=4, test=test, save=True, filepath=None, get_nodes_gdf=False, proj=ghsl_crs):
+def get_GDM(graph, graphlets_up_to=4, method='array'):
+    """
+    Get the Graphlet Degree Matrix (GDM) of a single graph.
+    
+    :param graph: simplified street network (networkx or CSRGraph), or None
+    :param graphlets_up_to: 4 or 5, maximum size of graphlets whose orbits we want to compute
+    :param method: 'array' or 'str', whether orca receives the edges as a NumPy array or as text
+    
+    return: np.array with one row (GDV) per node, None if graph is None
+    """
+    if graph is None:
+        return None
+    
+    if method == 'array':
+        GDM = orca.orbit_counts_array('node', graphlets_up_to, graph)
+    else:
+        if isinstance(graph, CSRGraph):
+            graph = graph.to_networkx()
+        GDM = np.array(orca.orbit_counts('node', graphlets_up_to, graph))
+    
+    return GDM
+
+def get_logged_GDM(graph, key, graphlets_up_to=4, method='array', run_log=None):
+    """
+    Get the GDM of a single graph as get_GDM does, recording the orbit count of the city in run_log
+    
+    :param graph: simplified street network (networkx or CSRGraph), or None
+    :param key: tuple (city, country)
+    :param run_log: instrument.RunLog or None
+    
+    return: np.array with one row (GDV) per node, None if graph is None
+    """
+    if graph is None:
+        return None
+    
+    with instrument.stage(run_log, 'orbit_count', key, method=method) as record:
+        record.update(n_nodes=graph.number_of_nodes(), n_edges=graph.number_of_edges())
+        GDM = get_GDM(graph, graphlets_up_to, method)
+    
+    return GDM
+
+def get_neighbourhood(graph, sources, radius, extra_edges=None):
+    """
+    Get all nodes within a number of hops from a set of source nodes (breadth-first search)
+
+    :param graph: networkx graph
+    :param sources: iterable of nodes
+    :param radius: int, maximum number of hops
+    :param extra_edges: list of edges (tuples of two nodes) also traversed, even if not in the graph
+
+    return: set of nodes
+    """
+    extra_neighbours = dict()
+    for u, v in (extra_edges or []):
+        extra_neighbours.setdefault(u, set()).add(v)
+        extra_neighbours.setdefault(v, set()).add(u)
+
+    reached = set(node for node in sources if node in graph or node in extra_neighbours)
+    frontier = reached
+    for _ in range(radius):
+        next_frontier = set()
+        for node in frontier:
+            if node in graph:
+                next_frontier.update(graph.neighbors(node))
+            next_frontier.update(extra_neighbours.get(node, ()))
+        frontier = next_frontier - reached
+        reached |= frontier
+
+    return reached
+
+def update_GDM(graph, GDM, added_edges=None, removed_edges=None, graphlets_up_to=4, method='array', copy=True):
+    """
+    Update the Graphlet Degree Matrix (GDM) of a graph after some edges are added and/or removed,
+      recounting orbits only for the nodes whose graphlets can contain a changed edge
+
+    A graphlet on k nodes containing a node v and an edge (a, b) puts v at most k-2 hops away from a or b
+      (3 edges of the graphlet for k=4), so only those nodes are affected. Their orbits are recounted on the
+      subgraph induced by all nodes up to k-1 hops away from them, which holds every graphlet they belong to.
+
+    :param graph: street network the GDM was computed for (before the edit)
+    :param GDM: np.array, Graphlet Degree Matrix of graph, rows follow the order of graph.nodes
+    :param added_edges: list of edges (tuples of two nodes) to add, new nodes are appended to the GDM
+    :param removed_edges: list of edges (tuples of two nodes) to remove, including parallel edges
+    :param graphlets_up_to: 4 or 5, maximum size of graphlets the GDM was computed for
+    :param method: 'array' or 'str', see get_GDM
+    :param copy: Boolean, if False the edit is applied to graph in place
+
+    return: tuple of the edited graph and its GDM
+    """
+    added_edges = [tuple(edge[:2]) for edge in (added_edges or [])]
+    removed_edges = [tuple(edge[:2]) for edge in (removed_edges or [])]
+
+    #Apply the edit:
+    new_graph = graph.copy() if copy else graph
+    for u, v in removed_edges:
+        while new_graph.has_edge(u, v):
+            new_graph.remove_edge(u, v)
+    new_graph.add_edges_from(added_edges)
+
+    #Rows of the previous GDM keep their position, new nodes are appended at the end:
+    new_GDM = np.zeros((len(new_graph), GDM.shape[1]), dtype=GDM.dtype)
+    new_GDM[:len(GDM)] = GDM
+
+    changed_edges = [(u, v) for u, v in added_edges + removed_edges if u != v]
+    if not changed_edges:
+        return new_graph, new_GDM
+
+    #Nodes whose orbit counts may change, searching in the union of the old and new graphs:
+    endpoints = set(node for edge in changed_edges for node in edge)
+    affected_nodes = get_neighbourhood(new_graph, endpoints, graphlets_up_to-2, extra_edges=removed_edges)
+    affected_nodes &= set(new_graph.nodes)
+
+    #Recount the orbits on the subgraph that contains all graphlets of affected nodes:
+    ball = get_neighbourhood(new_graph, affected_nodes, graphlets_up_to-1)
+    subgraph = new_graph.subgraph(ball)
+    sub_GDM = get_GDM(subgraph, graphlets_up_to, method)
+
+    index = {node: i for i, node in enumerate(new_graph)}
+    sub_rows = [i for i, node in enumerate(subgraph) if node in affected_nodes]
+    rows = [index[node] for node in subgraph if node in affected_nodes]
+    new_GDM[rows] = sub_GDM[sub_rows]
+
+    return new_graph, new_GDM
+
+def get_GDMs(graphs_dict, graphlets_up_to=4, test=test, save=True, filepath=None, get_nodes_gdf=False, proj=ghsl_crs,
+             method='array', n_threads=1, storage='store', store_dir=None, run_log=None):
     """
     Get Graphlet Degree Matrices (GDM) for each graph in the dictionary.
     
@@ -44,52 +179,80 @@ def get_GDMs(graphs_dict, graphlets_up_to=4, test=test, save=True, filepath=None
     :param graphlets_up_to: 4 or 5, maximum size of graphlets whose orbits we want to compute
     :param test: Boolean, whether this is the test run
     :param save: Boolean, whether the graph dictionary should be saved
-    :param filepath: string, if saved file must be named in a particular way, default is graphs_dict.pickle
+    :param filepath: string, if saved file must be named in a particular way, default is GDMs_dict.pickle
     :param get_nodes_gdf: Boolean, whether to also obtain the nodes GeoDataFrame simultaneously
     :param proj: crs to project the gdf (using the default GHSL throughout the project, Mollweide)
+    :param method: 'array' or 'str', whether orca receives the edges as a NumPy array (default, faster)
+                   or as the original text input
+    :param n_threads: int, number of cities counted at once. Orca releases the GIL while counting,
+                      so threads share the graphs without forking or pickling them
+    :param storage: 'store' or 'pickle'. With 'store' (default) the GDMs are saved to the memory-mapped GDM
+                    store (see src.store.save_GDMs), with 'pickle' as a pickled dictionary
+    :param store_dir: string, directory of the GDM store if non-default path is desired
+    :param run_log: instrument.RunLog where the orbit count of each city is recorded, or None
     
-    return: dictionary with GDMs, keys are tuples (city, country)
+    return: dictionary with GDMs, keys are tuples (city, country). With the store and save=True this is a
+            store.GDMStore, whose GDMs are memory-mapped
             and if get_nodes_gdf = True, also dictionary with nodes GeoDataFrames, keys are tuples (city, country)
     """
-    GDMs_dict = dict()
+    if method not in ['array', 'str']:
+        print('Invalid method. Only valid parameters are array and str.')
+        return None
+    
+    if storage not in ['store', 'pickle']:
+        print('Invalid storage. Only valid parameters are store and pickle.')
+        return None
+    
+    keys = list(graphs_dict.keys())
+    
+    if n_threads == 1:
+        GDMs = [get_logged_GDM(graphs_dict[key], key, graphlets_up_to, method, run_log) for key in tqdm(keys)]
+    else:
+        GDMs = Parallel(n_jobs=n_threads, prefer='threads')(delayed(get_logged_GDM)(graphs_dict[key], key, graphlets_up_to,
+                                                                                    method, run_log)
+                                                            for key in tqdm(keys))
+    GDMs_dict = dict(zip(keys, GDMs))
     
     if get_nodes_gdf:
         node_gdfs_dict = dict()
     
-    for city, country in tqdm(graphs_dict.keys()):
-        
-        graph = graphs_dict[(city, country)]
-        
-        if graph is None:
-            GDMs_dict[(city, country)]  = None
-
-            if get_nodes_gdf:
-                node_gdfs_dict[(city, country)] = None            
+        for city, country in keys:
             
-        else:
-            GDM = orca.orbit_counts('node', graphlets_up_to, graph)
-            GDMs_dict[(city, country)] = np.array(GDM)
-
-            if get_nodes_gdf:
-                node_gdf = get_node_geodataframe(graph, GDM, proj)
+            graph = graphs_dict[(city, country)]
+            
+            if graph is None:
+                node_gdfs_dict[(city, country)] = None
+            else:
+                node_gdf = get_node_geodataframe(graph, GDMs_dict[(city, country)], proj)
                 node_gdfs_dict[(city, country)] = node_gdf
                
     if save:
-        if filepath is None:
-            if test:
-                filepath = '../data/test-run/GDMs_dict.pickle'
-            else:
-                filepath = '../data/d2_processed/GDMs_dict.pickle'
-                
-        with open(filepath, 'wb') as file:
-            pkl.dump(GDMs_dict, file)
+        if storage == 'store':
+            if store_dir is None:
+                if test:
+                    store_dir = config.get_path('test-run/GDMs_store')
+                else:
+                    store_dir = config.get_path('d2_processed/GDMs_store')
+            
+            store.save_GDMs(GDMs_dict, store_dir)
+            GDMs_dict = store.GDMStore(store_dir)
+        
+        else:
+            if filepath is None:
+                if test:
+                    filepath = config.get_path('test-run/GDMs_dict.pickle')
+                else:
+                    filepath = config.get_path('d2_processed/GDMs_dict.pickle')
+                    
+            with open(filepath, 'wb') as file:
+                pkl.dump(GDMs_dict, file)
             
         if get_nodes_gdf:
             if save:
                 if test:
-                    filepath = '../data/test-run/node_gdfs_dict.pickle'
+                    filepath = config.get_path('test-run/node_gdfs_dict.pickle')
                 else:
-                    filepath = '../data/d2_processed/node_gdfs_dict.pickle'
+                    filepath = config.get_path('d2_processed/node_gdfs_dict.pickle')
 
                 with open(filepath, 'wb') as file:
                     pkl.dump(node_gdfs_dict, file)
@@ -126,9 +289,9 @@ def get_node_geodataframes(graphs_dict, GDMs_dict, proj=ghsl_crs, test=test, sav
     if save:
         if filepath is None:
             if test:
-                filepath = '../data/test-run/node_gdfs_dict.pickle'
+                filepath = config.get_path('test-run/node_gdfs_dict.pickle')
             else:
-                filepath = '../data/d2_processed/node_gdfs_dict.pickle'
+                filepath = config.get_path('d2_processed/node_gdfs_dict.pickle')
                 
         with open(filepath, 'wb') as file:
             pkl.dump(node_gdfs_dict, file)
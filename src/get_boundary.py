@@ -12,7 +12,8 @@ import fiona
 import geopandas as gpd
 from tqdm import tqdm
 
-from src.vars import ghsl_crs
+from src.vars import config, ghsl_crs
+from src import instrument
 from src.get_cities import get_processed_urbancentre_gdf
 
 test=False
@@ -45,13 +46,14 @@ def get_boundaries_GHSL(ghsl_gdf=None):
     
     return boundaries_dict
 
-def get_boundaries_osmnx(cities, countries, proj=ghsl_crs):
+def get_boundaries_osmnx(cities, countries, proj=ghsl_crs, run_log=None):
     """
     Get boundaries (polygons) for all the cities provided using the GHSL data
     
     :param cities: list of cities
     :param countries: list of countries
     :param proj: crs to project the boundary (using the default GHSL throughout the project, Mollweide)
+    :param run_log: instrument.RunLog where the geocoding of each city is recorded, or None
     
     return: dictionary with boundaries, keys are tuples (city, country)
     """
@@ -59,14 +61,16 @@ def get_boundaries_osmnx(cities, countries, proj=ghsl_crs):
     
     for city, country in tqdm(zip(cities, countries), total=len(cities)):
         try:
-            boundary = ox.geocode_to_gdf(city +', '+country)
+            with instrument.stage(run_log, 'boundaries', (city, country)):
+                boundary = ox.geocode_to_gdf(city +', '+country)
             boundaries_dict[(city, country)] = boundary
         except:
             print("Problem with ", city +', '+country)
     
     return boundaries_dict
 
-def get_boundaries(cities=None, countries=None, method='osmnx', proj=ghsl_crs, ghsl_gdf=None, test=test, save=True, filepath=None):
+def get_boundaries(cities=None, countries=None, method='osmnx', proj=ghsl_crs, ghsl_gdf=None, test=test, save=True, filepath=None,
+                   run_log=None):
     """
     Get boundaries (polygons) for all the cities provided
     
@@ -78,13 +82,14 @@ def get_boundaries(cities=None, countries=None, method='osmnx', proj=ghsl_crs, g
     :param test: Boolean, whether this is the test run
     :param save: Boolean, whether the graph dictionary should be saved
     :param filepath: string, if saved file must be named in a particular way, default is graphs_dict.pickle
+    :param run_log: instrument.RunLog where the geocoding of each city is recorded (osmnx method), or None
     
     return: dictionary with boundaries, keys are tuples (city, country)
     """
     
     #Get the boundary dictionary according to the given method:  
     if method == 'osmnx':
-        boundaries_dict = get_boundaries_osmnx(cities, countries, proj)
+        boundaries_dict = get_boundaries_osmnx(cities, countries, proj, run_log)
 
     elif method == 'GHSL':
         boundaries_dict = get_boundaries_GHSL(ghsl_gdf)
@@ -97,9 +102,9 @@ def get_boundaries(cities=None, countries=None, method='osmnx', proj=ghsl_crs, g
     if save:
         if filepath is None:
             if test:
-                filepath = '../data/test-run/boundaries_dict.pickle'
+                filepath = config.get_path('test-run/boundaries_dict.pickle')
             else:
-                filepath = '../data/d2_processed/boundaries_dict.pickle'
+                filepath = config.get_path('d2_processed/boundaries_dict.pickle')
                 
         with open(filepath, 'wb') as file:
             pkl.dump(boundaries_dict, file)
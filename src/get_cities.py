@@ -9,17 +9,17 @@ import csv
 import fiona
 import geopandas as gpd
 
-from src.vars import test_cities, ghsl_crs, urbancentre_filepath, cities_filepath
+from src.vars import test_cities, ghsl_crs, config
 
 test=False
 
 #--------------------------------------------------------------------------------------------
 
-def get_urbancentre_gdf(raw_data_path=urbancentre_filepath, crs=ghsl_crs, method='Fiona'):
+def get_urbancentre_gdf(raw_data_path=None, crs=ghsl_crs, method='Fiona'):
     """
     Gets a GeoDataFrame of urbancentres from GHSL data
     
-    :param raw_data_path: string, filepath for raw data
+    :param raw_data_path: string, filepath for raw data, default is config.urbancentre_filepath
     :param crs: crs, projection of GHSL data
     :param method: direct or Fiona, whether to load the geopackage directly or using Fiona
                     (currently recommend using Fiona)
@@ -27,6 +27,9 @@ def get_urbancentre_gdf(raw_data_path=urbancentre_filepath, crs=ghsl_crs, method
     return GeoDataFrame
     """
     
+    if raw_data_path is None:
+        raw_data_path = config.urbancentre_filepath
+    
     if method == 'direct':
         
         gdf = gpd.read_file(raw_data_path, to_crs=crs)
@@ -67,7 +70,7 @@ def clean_urbancentre_gdf(gdf,
     
     return processed_gdf
 
-def get_processed_urbancentre_gdf(raw_data_path=urbancentre_filepath,
+def get_processed_urbancentre_gdf(raw_data_path=None,
                                   crs=ghsl_crs,
                                   columns=['UC_NM_MN', 'UC_NM_LST', 'CTR_MN_NM', 'GRGN_L1', 'GRGN_L2', 'P15', 'AREA', 'geometry'],
                                   column_names={'UC_NM_MN':'urban centre',
@@ -85,7 +88,7 @@ def get_processed_urbancentre_gdf(raw_data_path=urbancentre_filepath,
     """
     Gets a GeoDataFrame of urbancentres from GHSL data, cleans the columns, and samples the rows
     
-    :param raw_data_path: string, filepath for raw data
+    :param raw_data_path: string, filepath for raw data, default is config.urbancentre_filepath
     :param crs: crs, projection of GHSL data
     :param columns: list of strings, columns of the data to keep
     :param column_names: dictionary, how to rename the columns
@@ -120,7 +123,7 @@ def get_processed_urbancentre_gdf(raw_data_path=urbancentre_filepath,
     return sampled_gdf
 
 def read_cities_GHSL(ghsl_gdf=None,
-                     raw_data_path=urbancentre_filepath,
+                     raw_data_path=None,
                      crs=ghsl_crs,
                      columns=['UC_NM_MN', 'UC_NM_LST', 'CTR_MN_NM', 'GRGN_L1', 'GRGN_L2', 'P15', 'AREA', 'geometry'],
                      column_names={'UC_NM_MN':'urban centre',
@@ -149,13 +152,18 @@ def read_cities_GHSL(ghsl_gdf=None,
     
     return cities, countries
 
-def read_cities_csv(cities_filepath=cities_filepath, dlm=';'):
+def read_cities_csv(cities_filepath=None, dlm=';'):
     """
     Gets a list of cities and a list of countries from the csv file provided
     
+    :param cities_filepath: string, default is config.cities_filepath
+    
     return: list of cities, list of countries (respectively)
     """
     
+    if cities_filepath is None:
+        cities_filepath = config.cities_filepath
+    
     cities = []
     countries = []
     with open(cities_filepath) as csvfile:
@@ -167,7 +175,7 @@ def read_cities_csv(cities_filepath=cities_filepath, dlm=';'):
     
     return cities, countries  
     
-def get_cities_and_countries(test=test, method='GHSL', ghsl_gdf=None, method_GHSL='Fiona', cities_filepath=cities_filepath):
+def get_cities_and_countries(test=test, method='GHSL', ghsl_gdf=None, method_GHSL='Fiona', cities_filepath=None):
     """
     Gets a list of cities and a list of countries that will be used in the experiments
     
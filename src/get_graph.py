@@ -7,11 +7,18 @@ from tqdm import tqdm
 import sys
 sys.path.append('../')
 
+import numpy as np
 import networkx as nx
-import osmnx as ox
+from pyproj import Transformer
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
-from src.vars import ghsl_crs, tolerance
+from src.vars import config, ghsl_crs, tolerance
 from src.utils import load_file
+from src import store
+from src import instrument
+from src.csr_graph import CSRGraph
 
 test=False
 
@@ -51,6 +58,8 @@ def simplify_graph(graph, tol=tolerance):
     
     return: osmnx.Graph, cleaned street network
     """
+    import osmnx as ox
+    
     #First we need to project it so we can run the OSMNx functions:
     H = ox.project_graph(graph)
     #Now consolidate intersections, using tolerance provided, default is 15:
@@ -81,7 +90,100 @@ def simplify_graph(graph, tol=tolerance):
     #This is the graph we want, so let's return it:
     return H4  
 
-def get_graphs(boundaries_dict, proj=ghsl_crs, test=test, save=True, filepath=None):
+def get_node_clusters(points, edges, tol=tolerance):
+    """
+    Groups the nodes as ox.consolidate_intersections does: nodes whose buffers of radius tol overlap
+      (distance below 2*tol, chained) form a cluster, which is then split into its connected parts
+
+    :param points: np.array of shape (N, 2), projected coordinates (meters) of the nodes
+    :param edges: np.array of shape (E, 2), positions of the endpoints of each edge
+    :param tol: float, distance (in meters) within which nodes are deemed indistinguishable
+
+    return: np.array of N integers, the cluster of each node
+    """
+    n_nodes = len(points)
+    
+    #Overlapping buffers, found with a KD-tree instead of a union of polygons:
+    pairs = cKDTree(points).query_pairs(2*tol, output_type='ndarray')
+    adjacency = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n_nodes, n_nodes))
+    _, buffer_clusters = connected_components(adjacency, directed=False)
+    
+    #Nodes of the same cluster stay together only if the street network connects them inside it:
+    same_cluster = edges[buffer_clusters[edges[:, 0]] == buffer_clusters[edges[:, 1]]]
+    adjacency = coo_matrix((np.ones(len(same_cluster)), (same_cluster[:, 0], same_cluster[:, 1])), shape=(n_nodes, n_nodes))
+    _, clusters = connected_components(adjacency, directed=False)
+    
+    return clusters
+
+def simplify_graph_array(graph, tol=tolerance, proj=ghsl_crs):
+    """
+    Simplify graph as simplify_graph does (consolidate intersections, remove direction, parallel edges and
+      self-loops) working on arrays of nodes and edges, and project it to proj at the same time
+    
+    Nodes are clustered on UTM coordinates (as osmnx does) with a KD-tree, so the result is topologically
+      the same as projecting the output of simplify_graph. Merged nodes are placed at the mean of their
+      members and edges keep the attributes of one of the edges they replace, without geometry.
+    
+    :param graph: osmnx.MultiDiGraph, raw street network (unprojected)
+    :param tol: float, distance (in meters) within which nodes are deemed indistinguishable
+    :param proj: crs to project the graph
+    
+    return: osmnx.MultiGraph, cleaned street network with nodes indexed sequentially as integers
+    """
+    node_ids = list(graph.nodes)
+    index = {node: i for i, node in enumerate(node_ids)}
+    lon = np.array([x for _, x in graph.nodes(data='x')])
+    lat = np.array([y for _, y in graph.nodes(data='y')])
+    edge_list = list(graph.edges(data=True))
+    edges = np.array([(index[u], index[v]) for u, v, _ in edge_list], dtype=np.int64).reshape(-1, 2)
+    
+    #Cluster on the UTM zone osmnx would project to, but place nodes directly in the final projection:
+    utm_zone = int(np.floor((np.mean(lon) + 180) / 6) + 1)
+    utm_crs = f'+proj=utm +zone={utm_zone} +ellps=WGS84 +datum=WGS84 +units=m +no_defs'
+    points = np.column_stack(Transformer.from_crs(graph.graph['crs'], utm_crs, always_xy=True).transform(lon, lat))
+    x, y = Transformer.from_crs(graph.graph['crs'], proj, always_xy=True).transform(lon, lat)
+    
+    clusters = get_node_clusters(points, edges, tol)
+    n_clusters = clusters.max() + 1 if len(clusters) else 0
+    cluster_sizes = np.bincount(clusters, minlength=n_clusters)
+    
+    #Undirected edges between different clusters, once each (this drops self-loops and parallel edges):
+    cluster_edges = np.sort(clusters[edges], axis=1)
+    keep = np.flatnonzero(cluster_edges[:, 0] != cluster_edges[:, 1])
+    _, first = np.unique(cluster_edges[keep], axis=0, return_index=True)
+    keep = keep[first]
+    
+    H = nx.MultiGraph(**graph.graph)
+    H.graph['crs'] = proj
+    
+    #Merged nodes are placed at the mean of their members:
+    cluster_x = np.bincount(clusters, weights=x, minlength=n_clusters) / cluster_sizes
+    cluster_y = np.bincount(clusters, weights=y, minlength=n_clusters) / cluster_sizes
+    cluster_lon = np.bincount(clusters, weights=lon, minlength=n_clusters) / cluster_sizes
+    cluster_lat = np.bincount(clusters, weights=lat, minlength=n_clusters) / cluster_sizes
+    members = dict()
+    for i, cluster in enumerate(clusters):
+        members.setdefault(cluster, []).append(node_ids[i])
+    for cluster in range(n_clusters):
+        osmids = members[cluster]
+        if len(osmids) == 1:
+            data = dict(graph.nodes[osmids[0]], osmid_original=osmids[0])
+        else:
+            data = {'osmid_original': str(osmids)}
+        data.update({'x': cluster_x[cluster], 'y': cluster_y[cluster],
+                     'lon': cluster_lon[cluster], 'lat': cluster_lat[cluster]})
+        H.add_node(cluster, **data)
+    
+    for i in keep:
+        u, v, data = edge_list[i]
+        data = {key: value for key, value in data.items() if key != 'geometry'}
+        H.add_edge(cluster_edges[i, 0], cluster_edges[i, 1], u_original=u, v_original=v, **data)
+    
+    return H
+
+def get_graphs(boundaries_dict, proj=ghsl_crs, test=test, save=True, filepath=None,
+               storage='store', store_dir=None, retry_failed=False, osm_filepath=None, method='array',
+               graph_type='networkx', run_log=None):
     """
     Get simplified street networks for all polygons provided.
     
@@ -90,42 +192,122 @@ def get_graphs(boundaries_dict, proj=ghsl_crs, test=test, save=True, filepath=No
     :param test: Boolean, whether this is the test run
     :param save: Boolean, whether the graph dictionary should be saved
     :param filepath: string, if saved file must be named in a particular way, default is graphs_dict.pickle
+    :param storage: 'store' or 'pickle'. With 'store' (default) each graph is written once to its own file of the
+                    graph store (see src.store), with a manifest of completed and failed cities used to resume.
+                    With 'pickle' the whole dictionary is re-pickled after every city
+    :param store_dir: string, directory of the graph store if non-default path is desired
+    :param retry_failed: Boolean, whether cities that failed in a previous run of the store are tried again
+    :param osm_filepath: string, local OSM extract (.osm or .pbf) covering the cities. If given, the networks are
+                         read from it in a single streaming pass (see src.get_osm_extract) instead of being
+                         downloaded city by city from the Overpass API
+    :param method: 'array' or 'osmnx', whether graphs are simplified on arrays (default, faster, see
+                   simplify_graph_array) or with the osmnx functions and projected afterwards
+    :param graph_type: 'networkx' or 'csr', whether graphs are kept as osmnx graphs or only as their node
+                       coordinates and adjacency (src.csr_graph.CSRGraph), much smaller to store and load
+    :param run_log: instrument.RunLog where the download and simplify stages of each city (and the read_extract
+                    stage of osm_filepath) are recorded, or None
     
-    return: dictionary with graphs, keys are tuples (city, country)
+    return: dictionary with graphs, keys are tuples (city, country). With the store and save=True this is a
+            store.CityStore, which only loads a graph when it is accessed
     """
-    if filepath is None:
-        if test:
-            filepath = '../data/test-run/graphs_dict.pickle'
-        else:
-            filepath = '../data/d2_processed/graphs_dict.pickle'
-    #Maybe the graphs dictionary is already available, so we load it:    
-    try:
-        graphs_dict = load_file(filepath)
-    except:
+    if storage not in ['store', 'pickle']:
+        print('Invalid storage. Only valid parameters are store and pickle.')
+        return None
+    
+    if method not in ['array', 'osmnx']:
+        print('Invalid method. Only valid parameters are array and osmnx.')
+        return None
+    
+    if graph_type not in ['networkx', 'csr']:
+        print('Invalid graph_type. Only valid parameters are networkx and csr.')
+        return None
+    
+    if storage == 'store':
+        if store_dir is None:
+            if test:
+                store_dir = config.get_path('test-run/graphs_store')
+            else:
+                store_dir = config.get_path('d2_processed/graphs_store')
+        
+        #Resume from the cities already in the store:
+        status = None if not retry_failed else 'done'
+        done_keys = set((entry['city'], entry['country']) for partition, entry in store.get_partitions(store_dir, status=status))
         graphs_dict = dict()
     
+    else:
+        if filepath is None:
+            if test:
+                filepath = config.get_path('test-run/graphs_dict.pickle')
+            else:
+                filepath = config.get_path('d2_processed/graphs_dict.pickle')
+        #Maybe the graphs dictionary is already available, so we load it:    
+        try:
+            graphs_dict = load_file(filepath)
+        except:
+            graphs_dict = dict()
+        done_keys = set(graphs_dict.keys())
+    
+    pending_keys = [key for key in boundaries_dict.keys() if key not in done_keys and key[0] != 'Tokyo']
+    
+    #osmnx is only imported here, to download or simplify the graphs, so importing this module stays light:
+    import osmnx as ox
+    
+    #The extract is read once for all pending cities (its own stage in the run log), graphs are then built by key:
+    if osm_filepath is not None and pending_keys:
+        from src.get_osm_extract import read_extract, get_extract_graph
+        with instrument.stage(run_log, 'read_extract', source=osm_filepath, n_cities=len(pending_keys)) as record:
+            extract = read_extract(osm_filepath, {key: boundaries_dict[key]['geometry'][0] for key in pending_keys})
+            record.update(n_nodes=len(extract['nodes']), n_ways=len(extract['way_runs']))
+    
     #Iterate over all cities in the boundaries dictionary that are not in the dict yet:
     for city, country in tqdm(boundaries_dict.keys()):
         
-        if (city, country) not in graphs_dict.keys() and city != 'Tokyo':
+        if (city, country) in pending_keys:
         
             boundary = boundaries_dict[(city, country)]['geometry'][0]
+            error = None
             try:
-                graph = ox.graph_from_polygon(boundary, network_type='drive')
+                with instrument.stage(run_log, 'download', (city, country), source='extract' if osm_filepath else 'overpass') as record:
+                    if osm_filepath is not None:
+                        graph = get_extract_graph(extract, (city, country))
+                    else:
+                        graph = ox.graph_from_polygon(boundary, network_type='drive')
+                    record.update(n_nodes=graph.number_of_nodes(), n_edges=graph.number_of_edges())
 
-                simplified_graph = simplify_graph(graph)
+                with instrument.stage(run_log, 'simplify', (city, country), method=method) as record:
+                    if method == 'array':
+                        simplified_graph_proj = simplify_graph_array(graph, proj=proj)
+                    else:
+                        simplified_graph = simplify_graph(graph)
 
-                simplified_graph_proj = ox.project_graph(simplified_graph, to_crs=proj)
+                        simplified_graph_proj = ox.project_graph(simplified_graph, to_crs=proj)
+                    record.update(n_nodes=simplified_graph_proj.number_of_nodes(), n_edges=simplified_graph_proj.number_of_edges())
+                    
+                    if graph_type == 'csr':
+                        simplified_graph_proj = CSRGraph.from_networkx(simplified_graph_proj)
 
                 graphs_dict[(city, country)] = simplified_graph_proj
-            except:
+            except Exception as e:
                 print("Problem in the graph of ", city, ",", country)
                 graphs_dict[(city, country)] = None
+                error = e
 
-            #Save at every step to avoid issues.
             if save:
-                with open(filepath, 'wb') as file:
-                    pkl.dump(graphs_dict, file)
+                #Write only this city, atomically (CSR graphs as their .npz arrays, see store.save_city_artifact):
+                if storage == 'store':
+                    if error is None:
+                        store.save_city_artifact(graphs_dict.pop((city, country)), city, country, store_dir)
+                    else:
+                        store.save_city_failure(city, country, store_dir, error)
+                        graphs_dict.pop((city, country))
+                
+                #Save at every step to avoid issues.
+                else:
+                    with open(filepath, 'wb') as file:
+                        pkl.dump(graphs_dict, file)
+    
+    if storage == 'store' and save:
+        graphs_dict = store.CityStore(store_dir, cities=list(boundaries_dict.keys()))
     
     return graphs_dict
 
@@ -0,0 +1,308 @@
+#--------------------------------------------------------------------------------------------
+# GOAL: obtain the street networks of many polygons from a local OSM extract (offline)
+#--------------------------------------------------------------------------------------------
+
+import itertools
+import re
+import sys
+import xml.etree.ElementTree as ET
+sys.path.append('../')
+
+import networkx as nx
+import osmnx as ox
+import shapely
+
+#--------------------------------------------------------------------------------------------
+
+"""
+drive_filter: dictionary
+              tag values (regular expressions) excluding a way from the drive network, as in the osmnx query
+              used by graph_from_polygon(network_type='drive')
+"""
+drive_filter = {'area': 'yes',
+                'access': 'private',
+                'highway': 'abandoned|bridleway|bus_guideway|construction|corridor|cycleway|elevator|escalator|'
+                           'footway|path|pedestrian|planned|platform|proposed|raceway|service|steps|track',
+                'motor_vehicle': 'no',
+                'motorcar': 'no',
+                'service': 'alley|driveway|emergency_access|parking|parking_aisle|private'}
+
+#--------------------------------------------------------------------------------------------
+# osmnx internals used to build graphs as graph_from_polygon does. The pipeline pins osmnx 1.1.1; these
+# functions are private or moved in osmnx 2, so every call to them goes through this section
+
+def is_osmnx_1():
+    return int(ox.__version__.split('.')[0]) < 2
+
+def add_paths(G, paths):
+    """
+    Adds the edges of OSM ways to a graph (private ox.graph._add_paths, same signature in osmnx 1.1.1 and 2)
+    """
+    ox.graph._add_paths(G, paths, bidirectional=False)
+
+def truncate_graph_polygon(G, polygon, retain_all):
+    """
+    Removes the nodes outside a polygon, and keeps only the largest weakly connected component if not retain_all
+    """
+    if is_osmnx_1():
+        return ox.truncate.truncate_graph_polygon(G, polygon, retain_all=retain_all)
+    G = ox.truncate.truncate_graph_polygon(G, polygon)
+    return G if retain_all else ox.truncate.largest_component(G)
+
+def count_streets_per_node(G, nodes):
+    """
+    Counts the streets of each node (ox.utils_graph in osmnx 1.1.1, ox.stats in osmnx 2)
+    """
+    if is_osmnx_1():
+        return ox.utils_graph.count_streets_per_node(G, nodes=nodes)
+    return ox.stats.count_streets_per_node(G, nodes=nodes)
+
+#The pinned environment has shapely 1.7, whose STRtree returns geometries (not indices) and has no predicates,
+# and shapely 2 has vectorized queries: spatial queries go through these two functions
+
+def is_shapely_1():
+    return int(shapely.__version__.split('.')[0]) < 2
+
+def build_polygon_tree(polygons):
+    """
+    Spatial index of polygons, queried with query_points
+
+    :param polygons: list of shapely Polygons
+    """
+    if not is_shapely_1():
+        return shapely.STRtree(polygons)
+    from shapely.strtree import STRtree
+    from shapely.prepared import prep
+    return STRtree(polygons), {id(polygon): (j, prep(polygon)) for j, polygon in enumerate(polygons)}
+
+def query_points(tree, xs, ys):
+    """
+    :param tree: from build_polygon_tree
+    :param xs: list of floats, x coordinates of the points
+    :param ys: list of floats, y coordinates of the points
+
+    return: tuple of lists, index of a point and of a polygon it intersects, for every such pair
+    """
+    if not is_shapely_1():
+        point_index, polygon_index = tree.query(shapely.points(xs, ys), predicate='intersects')
+        return point_index.tolist(), polygon_index.tolist()
+    from shapely.geometry import Point
+    tree, prepared = tree
+    point_index, polygon_index = [], []
+    for i, (x, y) in enumerate(zip(xs, ys)):
+        point = Point(x, y)
+        for polygon in tree.query(point):
+            j, polygon_prepared = prepared[id(polygon)]
+            if polygon_prepared.intersects(point):
+                point_index.append(i)
+                polygon_index.append(j)
+    return point_index, polygon_index
+
+#--------------------------------------------------------------------------------------------
+
+def iter_osm_elements(filepath, element_type):
+    """
+    Streams the nodes or ways of an OSM extract, without keeping the file in memory
+
+    :param filepath: string, .osm (XML) or .pbf file. PBF files require pyosmium
+    :param element_type: 'node' or 'way'
+
+    return: generator of tuples (osmid, data, tags), data is (lat, lon) for nodes and the list of node ids for ways
+    """
+    if filepath.endswith('.pbf'):
+        try:
+            import osmium
+        except ImportError:
+            raise ImportError('Reading .pbf extracts requires pyosmium (pip install osmium)')
+
+        entity = osmium.osm.NODE if element_type == 'node' else osmium.osm.WAY
+        for obj in osmium.FileProcessor(filepath, entity):
+            tags = {tag.k: tag.v for tag in obj.tags}
+            if element_type == 'node':
+                yield obj.id, (obj.location.lat, obj.location.lon), tags
+            else:
+                yield obj.id, [node.ref for node in obj.nodes], tags
+
+    else:
+        context = ET.iterparse(filepath, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event != 'end' or elem.tag not in ['node', 'way', 'relation']:
+                continue
+            if elem.tag == element_type:
+                tags = {tag.get('k'): tag.get('v') for tag in elem.iter('tag')}
+                if element_type == 'node':
+                    yield int(elem.get('id')), (float(elem.get('lat')), float(elem.get('lon'))), tags
+                else:
+                    yield int(elem.get('id')), [int(nd.get('ref')) for nd in elem.iter('nd')], tags
+            #Drop the parsed elements to keep the memory bounded:
+            root.clear()
+
+def is_drive_way(tags, drive_filter=drive_filter):
+    """
+    Whether an OSM way belongs to the drive network
+
+    :param tags: dictionary, tags of the way
+
+    return: Boolean
+    """
+    if 'highway' not in tags:
+        return False
+    for key, pattern in drive_filter.items():
+        if key in tags and re.search(pattern, tags[key]):
+            return False
+    return True
+
+def read_drive_network(filepath, polygons, chunk_size=2**16):
+    """
+    Reads the drive network inside some polygons from an OSM extract in two streaming passes: the nodes inside
+      the polygons first (tested in chunks against a spatial index of the polygons), then the drive ways using
+      any of them. Memory grows with the networks inside the polygons, not with the size of the extract.
+
+    :param filepath: string, .osm (XML) or .pbf file
+    :param polygons: list of shapely Polygons in lat-lon
+    :param chunk_size: int, number of nodes tested against the polygons at once
+
+    return: tuple of dictionary of ways (osmid to osmnx path dict with a 'nodes' list), dictionary of nodes
+            (osmid to osmnx node dict with 'x' and 'y'), and list with the set of node ids inside each polygon
+    """
+    tree = build_polygon_tree(polygons)
+    nodes = dict()
+    nodes_in_polygon = [set() for polygon in polygons]
+
+    def add_chunk(chunk):
+        point_index, polygon_index = query_points(tree, [node[2] for node in chunk], [node[1] for node in chunk])
+        for i, j in zip(point_index, polygon_index):
+            nodes_in_polygon[j].add(chunk[i][0])
+        for i in sorted(set(point_index)):
+            osmid, lat, lon, tags = chunk[i]
+            nodes[osmid] = dict(tags, y=lat, x=lon)
+
+    #First pass: nodes inside the polygons, keeping only the tags osmnx keeps:
+    chunk = []
+    for osmid, (lat, lon), tags in iter_osm_elements(filepath, 'node'):
+        chunk.append((osmid, lat, lon, {tag: tags[tag] for tag in ox.settings.useful_tags_node if tag in tags}))
+        if len(chunk) == chunk_size:
+            add_chunk(chunk)
+            chunk = []
+    if chunk:
+        add_chunk(chunk)
+
+    #Second pass: drive ways touching those nodes:
+    ways = dict()
+    for osmid, refs, tags in iter_osm_elements(filepath, 'way'):
+        if is_drive_way(tags) and any(node in nodes for node in refs):
+            path = {'osmid': osmid, 'nodes': [group[0] for group in itertools.groupby(refs)]}
+            path.update({tag: tags[tag] for tag in ox.settings.useful_tags_way if tag in tags})
+            ways[osmid] = path
+
+    return ways, nodes, nodes_in_polygon
+
+def build_polygon_graph(paths, nodes, polygon, polygon_buffered):
+    """
+    Builds the street network inside a polygon as ox.graph_from_polygon does with downloaded data: the graph of
+      the buffered polygon is built, truncated, and simplified, and then truncated to the polygon
+
+    :param paths: list of osmnx path dicts (with a 'nodes' list) touching the buffered polygon
+    :param nodes: dictionary of the osmnx node dicts used by paths
+    :param polygon: shapely Polygon in lat-lon
+    :param polygon_buffered: shapely Polygon in lat-lon, polygon with a buffer
+
+    return: networkx.MultiDiGraph with the same schema as ox.graph_from_polygon(polygon, network_type='drive')
+    """
+    G_buff = nx.MultiDiGraph(created_date=ox.utils.ts(), created_with='OSMnx ' + ox.__version__,
+                             crs=ox.settings.default_crs)
+    for node in set(node for path in paths for node in path['nodes']):
+        G_buff.add_node(node, **nodes[node])
+    add_paths(G_buff, [dict(path) for path in paths])
+    if len(G_buff.edges) > 0:
+        G_buff = ox.distance.add_edge_lengths(G_buff)
+
+    G_buff = truncate_graph_polygon(G_buff, polygon_buffered, retain_all=True)
+    G_buff = ox.simplify_graph(G_buff)
+    G = truncate_graph_polygon(G_buff, polygon, retain_all=False)
+
+    spn = count_streets_per_node(G_buff, nodes=G.nodes)
+    nx.set_node_attributes(G, values=spn, name='street_count')
+
+    return G
+
+def read_extract(filepath, polygons_dict, buffer_dist=500):
+    """
+    Reads the drive network of many polygons from a local OSM extract once, instead of one Overpass request
+      per polygon. Only the nodes inside the (buffered) polygons are kept, matched with a spatial index, and
+      every way touching a polygon is kept for its graph, as the Overpass query does. Graphs are then built
+      with get_extract_graph.
+
+    :param filepath: string, .osm (XML) or .pbf file covering the polygons
+    :param polygons_dict: dictionary with polygons in lat-lon, keys are tuples (city, country)
+    :param buffer_dist: float, buffer (in meters) around each polygon used before simplifying, as in osmnx
+
+    return: dictionary with the polygons, nodes and ways read, keys of polygons_dict are in extract['index']
+    """
+    keys = list(polygons_dict.keys())
+    polygons = [polygons_dict[key] for key in keys]
+
+    #Buffer the polygons in meters, as osmnx does:
+    polygons_buffered = []
+    for polygon in polygons:
+        polygon_proj, crs_utm = ox.projection.project_geometry(polygon)
+        polygon_buffered, _ = ox.projection.project_geometry(polygon_proj.buffer(buffer_dist), crs=crs_utm, to_latlong=True)
+        polygons_buffered.append(polygon_buffered)
+
+    ways, nodes, nodes_in_polygon = read_drive_network(filepath, polygons_buffered)
+
+    #Ways touching each polygon, split where their nodes fall outside the polygons that were read (truncating
+    # the graph to the buffered polygon removes those nodes anyway):
+    way_runs = dict()
+    for osmid, path in ways.items():
+        runs = [list(group) for known, group in itertools.groupby(path['nodes'], key=lambda node: node in nodes) if known]
+        way_runs[osmid] = [dict(path, nodes=run) for run in runs if len(run) > 1]
+    node_to_ways = dict()
+    for osmid, runs in way_runs.items():
+        for run in runs:
+            for node in run['nodes']:
+                node_to_ways.setdefault(node, set()).add(osmid)
+
+    return {'index': {key: i for i, key in enumerate(keys)}, 'polygons': polygons,
+            'polygons_buffered': polygons_buffered, 'nodes': nodes, 'nodes_in_polygon': nodes_in_polygon,
+            'way_runs': way_runs, 'node_to_ways': node_to_ways}
+
+def get_extract_graph(extract, key):
+    """
+    Builds the drive network of one polygon of an extract
+
+    :param extract: dictionary, from read_extract
+    :param key: tuple (city, country), key of the polygon in the polygons_dict given to read_extract
+
+    return: networkx MultiDiGraph, as osmnx graph_from_polygon
+    """
+    i = extract['index'][key]
+    touching_ways = set(way for node in extract['nodes_in_polygon'][i] for way in extract['node_to_ways'].get(node, ()))
+    paths = [run for way in touching_ways for run in extract['way_runs'][way]]
+
+    if not paths:
+        raise ValueError('There is no drive network for this polygon in the extract')
+    return build_polygon_graph(paths, extract['nodes'], extract['polygons'][i], extract['polygons_buffered'][i])
+
+def iter_extract_graphs(filepath, polygons_dict, buffer_dist=500):
+    """
+    Gets the drive network of many polygons reading a local OSM extract once (see read_extract)
+
+    :param filepath: string, .osm (XML) or .pbf file covering the polygons
+    :param polygons_dict: dictionary with polygons in lat-lon, keys are tuples (city, country)
+    :param buffer_dist: float, buffer (in meters) around each polygon used before simplifying, as in osmnx
+
+    return: generator of tuples (key, graph), graph is an exception if it could not be built
+    """
+    extract = read_extract(filepath, polygons_dict, buffer_dist)
+    for key in extract['index']:
+        try:
+            yield key, get_extract_graph(extract, key)
+        except Exception as e:
+            yield key, e
+
+#--------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,281 @@
+#--------------------------------------------------------------------------------------------
+# GOAL: record the time, memory, size and failures of every stage of the pipeline, city by city
+#--------------------------------------------------------------------------------------------
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+sys.path.append('../')
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#psutil (optional) measures the worker processes of a stage, otherwise they are read from /proc (Linux only):
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+#--------------------------------------------------------------------------------------------
+
+def get_children_usage():
+    """
+    return: tuple of CPU time (in seconds) and resident memory (in MB) of the child processes still running (e.g.
+            joblib workers), from psutil or else from /proc (Linux), (0, 0) if neither is available
+    """
+    cpu, rss = 0, 0
+    if psutil is not None:
+        for child in psutil.Process().children(recursive=True):
+            try:
+                times = child.cpu_times()
+                cpu += times.user + times.system
+                rss += child.memory_info().rss/2**20
+            except psutil.Error:
+                pass
+        return cpu, rss
+
+    #Fields of /proc/<pid>/stat after the command name: ppid is 1, utime and stime 11 and 12, rss (pages) 21
+    try:
+        children = dict()
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open('/proc/' + entry + '/stat') as file:
+                        stat = file.read()
+                except OSError:
+                    continue
+                fields = stat[stat.rindex(')')+2:].split()
+                children.setdefault(int(fields[1]), []).append((int(entry), fields))
+        ticks, page_mb = os.sysconf('SC_CLK_TCK'), os.sysconf('SC_PAGE_SIZE')/2**20
+    except (OSError, ValueError, AttributeError):
+        return cpu, rss
+    pending = [os.getpid()]
+    while pending:
+        for pid, fields in children.get(pending.pop(), []):
+            cpu += (int(fields[11]) + int(fields[12]))/ticks
+            rss += int(fields[21])*page_mb
+            pending.append(pid)
+    return cpu, rss
+
+def get_rss_mb():
+    """
+    return: float, current resident memory (in MB) of this process and its child processes, None if not available
+    """
+    if psutil is not None:
+        rss = psutil.Process().memory_info().rss/2**20
+    else:
+        try:
+            with open('/proc/self/statm') as file:
+                rss = int(file.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+        except (OSError, ValueError, AttributeError):
+            return None
+    return rss + get_children_usage()[1]
+
+def get_cpu_s():
+    """
+    return: float, CPU time (in seconds) of all threads of this process, plus that of its child processes: those
+            finished (getrusage) and those still running (e.g. joblib workers, see get_children_usage)
+    """
+    cpu = time.process_time() + get_children_usage()[0]
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu += children.ru_utime + children.ru_stime
+    return cpu
+
+class MemorySampler:
+    """
+    Samples the resident memory in a background thread, to get the peak reached while a stage runs
+
+    :attr start_mb: float, memory when sampling started
+    :attr peak_mb: float, highest memory sampled
+    """
+
+    def __init__(self, interval=0.1):
+        """
+        :param interval: float, seconds between samples
+        """
+        self.interval = interval
+        self.start_mb = self.peak_mb = get_rss_mb()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.update()
+
+    def update(self):
+        rss = get_rss_mb()
+        if rss is not None and (self.peak_mb is None or rss > self.peak_mb):
+            self.peak_mb = rss
+
+    def start(self):
+        if self.start_mb is not None:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        return: tuple of memory at the start, peak memory, and peak increase during the stage (in MB)
+        """
+        if self._thread.is_alive():
+            self._stop.set()
+            self._thread.join()
+        self.update()
+        if self.start_mb is None:
+            return None, None, None
+        return self.start_mb, self.peak_mb, self.peak_mb - self.start_mb
+
+class RunLog:
+    """
+    Log of a pipeline run, written as JSON lines: one line per stage and city with its wall time, CPU time,
+      resident memory at its start, peak and peak increase during it, sizes (e.g. nodes and edges) and status.
+      Each line is appended in a single write, so threads and worker processes (the log is only a file path,
+      it can be pickled) share the file.
+
+    CPU time and memory are those of the whole process (and its worker processes), so stages running at the
+      same time in threads of one process include each other. thread_cpu_s is the CPU time of the thread
+      that ran the stage only.
+
+    :attr filepath: string, .jsonl file of the log
+    :attr run_id: string, identifies the lines of this run in the file
+    """
+
+    def __init__(self, filepath, run_id=None):
+        """
+        :param filepath: string, .jsonl file, created if needed and appended to otherwise
+        :param run_id: string, default is the start time of the run
+        """
+        self.filepath = filepath
+        self.run_id = run_id if run_id is not None else time.strftime('%Y-%m-%dT%H:%M:%S')
+        os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+
+    def write(self, record):
+        """
+        Appends a record to the log
+
+        :param record: dictionary, JSON-serializable (other values are written as strings)
+        """
+        line = json.dumps(dict(record, run=self.run_id, pid=os.getpid(), time=time.time()), default=str) + '\n'
+        with open(self.filepath, 'a') as file:
+            file.write(line)
+
+    @contextlib.contextmanager
+    def stage(self, stage, key=None, **fields):
+        """
+        Context manager recording one stage of one city. The dictionary it yields is written at the end, so
+          sizes can be added to it (e.g. record['n_nodes'] = ...). Exceptions are recorded and raised again.
+
+        :param stage: string, name of the stage (e.g. download, simplify, orbit_count)
+        :param key: tuple (city, country) or None
+        :param fields: other values of the record
+        """
+        record = {'stage': stage, 'city': None if key is None else key[0], 'country': None if key is None else key[1]}
+        record.update(fields)
+        sampler = MemorySampler().start()
+        wall, cpu, thread_cpu = time.perf_counter(), get_cpu_s(), time.thread_time()
+        try:
+            yield record
+            record['status'] = 'done'
+        except Exception as e:
+            record['status'] = 'failed'
+            record['error'] = type(e).__name__ + ': ' + str(e)
+            raise
+        finally:
+            record['wall_s'] = time.perf_counter() - wall
+            record['cpu_s'] = get_cpu_s() - cpu
+            record['thread_cpu_s'] = time.thread_time() - thread_cpu
+            record['rss_start_mb'], record['rss_peak_mb'], record['rss_increase_mb'] = sampler.stop()
+            self.write(record)
+
+    def load(self, all_runs=False):
+        """
+        :param all_runs: Boolean, whether to include the lines of previous runs in the same file
+
+        return: DataFrame with one row per record
+        """
+        #pandas is only needed for reports, not by the (worker) processes writing records:
+        import pandas as pd
+        
+        with open(self.filepath) as file:
+            records = [json.loads(line) for line in file if line.strip()]
+        df = pd.DataFrame(records)
+        if not all_runs and len(df):
+            df = df[df['run'] == self.run_id]
+        return df
+
+    def summarize(self, n_outliers=5, save=True):
+        """
+        Prints and saves (next to the log, as .summary.json) a report of the run: for every stage the number
+          of records (a stage can run more than once per city) and cities, failures, total and typical times,
+          and memory, followed by the slowest cities and those whose memory increased most
+
+        :param n_outliers: int, number of cities listed per stage as time and memory outliers
+        :param save: Boolean, whether to write the summary file
+
+        return: DataFrame with one row per stage
+        """
+        df = self.load()
+        if len(df) == 0:
+            print('No stages recorded in this run.')
+            return None
+
+        summary = df.groupby('stage', sort=False).agg(records=('status', 'size'),
+                                                       cities=('city', 'nunique'),
+                                                       failed=('status', lambda status: int((status == 'failed').sum())),
+                                                       wall_total_s=('wall_s', 'sum'),
+                                                       wall_median_s=('wall_s', 'median'),
+                                                       wall_max_s=('wall_s', 'max'),
+                                                       cpu_total_s=('cpu_s', 'sum'),
+                                                       rss_peak_mb=('rss_peak_mb', 'max'),
+                                                       rss_increase_max_mb=('rss_increase_mb', 'max'))
+        summary['share_of_time'] = summary['wall_total_s']/summary['wall_total_s'].sum()
+
+        outliers = df.sort_values('wall_s', ascending=False).groupby('stage', sort=False).head(n_outliers)
+        memory_outliers = df.sort_values('rss_increase_mb', ascending=False).groupby('stage', sort=False).head(n_outliers)
+        size_columns = [column for column in ['n_nodes', 'n_edges', 'n_tiles'] if column in df]
+        columns = ['stage', 'city', 'country', 'wall_s', 'rss_increase_mb'] + size_columns
+        failures = df[df['status'] == 'failed']
+
+        print(summary.to_string(float_format=lambda x: '%.3f' % x))
+        print('\nSlowest cities per stage:')
+        print(outliers[columns].to_string(index=False))
+        print('\nLargest memory increases per stage:')
+        print(memory_outliers[columns].to_string(index=False))
+        if len(failures):
+            print('\nFailures:')
+            print(failures[['stage', 'city', 'country', 'error']].to_string(index=False))
+
+        if save:
+            #Missing values (e.g. sizes not recorded by a stage) are written as null:
+            to_records = lambda table: table.astype(object).where(table.notna(), None).to_dict(orient='records')
+            report = {'run': self.run_id,
+                      'stages': to_records(summary.reset_index()),
+                      'outliers': to_records(outliers[columns]),
+                      'memory_outliers': to_records(memory_outliers[columns]),
+                      'failures': to_records(failures[['stage', 'city', 'country', 'error']])}
+            with open(os.path.splitext(self.filepath)[0] + '.summary.json', 'w') as file:
+                json.dump(report, file, indent=1, default=str)
+
+        return summary
+
+def stage(run_log, stage, key=None, **fields):
+    """
+    Records a stage in run_log if there is one (see RunLog.stage), otherwise does nothing
+
+    :param run_log: RunLog or None
+
+    return: context manager yielding the record dictionary
+    """
+    if run_log is None:
+        return contextlib.nullcontext(dict())
+    return run_log.stage(stage, key, **fields)
+
+#--------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    pass
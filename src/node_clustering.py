@@ -2,21 +2,23 @@
 # GOAL: cluster the nodes according to their Graphlet Degree Vectors (GDVs)
 #--------------------------------------------------------------------------------------------
 
+import heapq
+import os
 import pickle as pkl
 import sys
+import tempfile
 sys.path.append('../')
 
 import numpy as np
-from tqdm import tqdm
 from joblib import Parallel, delayed
 
 import multiprocessing
 num_cores = multiprocessing.cpu_count()
 
-from scipy.spatial.distance import minkowski
-from scipy.spatial.distance import squareform
-from sklearn.metrics import pairwise_distances
-from scipy.cluster.hierarchy import linkage
+#scipy and sklearn are imported by the functions using them, so that processes only computing distances
+# import this module without them:
+from src import instrument
+from src.vars import config
 
 #--------------------------------------------------------------------------------------------
 
@@ -85,20 +87,121 @@ def get_GDVdistance(u_gdv, v_gdv, w):
     den = np.log(np.maximum(u_gdv, v_gdv)+2)
     u_tilde = np.log(u_gdv+1)/den
     v_tilde = np.log(v_gdv+1)/den
-    return minkowski(u_tilde, v_tilde, p=1, w=w)
+    #Weighted Minkowski distance with p=1:
+    return np.sum(w*np.abs(u_tilde - v_tilde))
 
 
-def get_D_matrix(GDM):
+def get_memmap(memmap_dir, length):
+    """
+    Creates a new .npy file in a directory and maps it to memory
+    
+    :param memmap_dir: string, directory of the file
+    :param length: int, number of float64 values
+    
+    :return writable np.memmap of shape (length,)
+    """
+    os.makedirs(memmap_dir, exist_ok=True)
+    fd, filepath = tempfile.mkstemp(dir=memmap_dir, prefix='Dmatrix_', suffix='.npy')
+    os.close(fd)
+    return np.lib.format.open_memmap(filepath, mode='w+', dtype=np.float64, shape=(length,))
+
+def to_memmap(D_cond, memmap_dir):
+    """
+    Writes a condensed distance matrix to a memory-mapped file once, so that worker processes attach to
+      the file (joblib sends memmaps by filename and offset) instead of receiving a pickled copy each
+    
+    :param D_cond: condensed distance matrix, or None
+    :param memmap_dir: string, directory of the file
+    
+    :return read-only np.memmap (D_cond itself if it already is one)
+    """
+    if D_cond is None or isinstance(D_cond, np.memmap):
+        return D_cond
+    D_memmap = get_memmap(memmap_dir, len(D_cond))
+    D_memmap[:] = D_cond
+    D_memmap.flush()
+    return np.load(D_memmap.filename, mmap_mode='r')
+
+def get_D_matrix(GDM, method='chunked', chunk_size=2**22, n_jobs=1, memmap_dir=None):
     """
     Gets the distance matrix between array of Graphlet Degree Vectors
     
     :param GDM: np.array where each row is a GDV i.e. corresponds to a node
+    :param method: 'chunked' (default, NumPy) or 'pairwise' (calls get_GDVdistance for every pair)
+    :param chunk_size: int, number of pairs computed at once by the chunked method
+    :param n_jobs: int, number of cores used (threads for the chunked method)
+    :param memmap_dir: string, if given the matrix is written directly to a memory-mapped file in this directory
     
-    :return condensed distance matrix
+    :return condensed distance matrix (read-only np.memmap if memmap_dir is given)
     """
     
     w = get_w_vec(num_orbits=GDM.shape[1])
-    return squareform(pairwise_distances(GDM, metric=get_GDVdistance, w=w, n_jobs=-1))
+    
+    if method == 'chunked':
+        n = len(GDM)
+        out = None if memmap_dir is None else get_memmap(memmap_dir, n*(n-1)//2)
+        D_cond = get_D_matrix_chunked(GDM, w, chunk_size, n_jobs, out=out)
+        if out is not None:
+            out.flush()
+            D_cond = np.load(out.filename, mmap_mode='r')
+        return D_cond
+    elif method == 'pairwise':
+        from scipy.spatial.distance import squareform
+        from sklearn.metrics import pairwise_distances
+        D_cond = squareform(pairwise_distances(GDM, metric=get_GDVdistance, w=w, n_jobs=n_jobs))
+        return D_cond if memmap_dir is None else to_memmap(D_cond, memmap_dir)
+    else:
+        print('Invalid method. Only valid parameters are chunked and pairwise.')
+        return None
+
+def get_D_matrix_chunked(GDM, w, chunk_size=2**22, n_jobs=1, out=None):
+    """
+    Gets the condensed matrix of weighted distances (get_GDVdistance) between all GDVs, filling it
+      one block of rows at a time
+    
+    The logarithms are computed once per node: since log is increasing, the denominator
+      log(max(u, v)+2) is the maximum of log(u+2) and log(v+2).
+    
+    :param GDM: np.array where each row is a GDV i.e. corresponds to a node
+    :param w: np.array, the weight vector
+    :param chunk_size: int, approximate number of pairs computed at once
+    :param n_jobs: int, number of threads filling blocks at once (NumPy releases the GIL)
+    :param out: np.array of length n*(n-1)/2 to fill (e.g. a np.memmap), if None a new array
+    
+    :return condensed distance matrix
+    """
+    GDM = np.asarray(GDM, dtype=np.float64)
+    n = len(GDM)
+    log_num = np.log(GDM+1)
+    log_den = np.log(GDM+2)
+    
+    D_cond = np.zeros(n*(n-1)//2) if out is None else out
+    
+    #Row i of the condensed matrix starts at i*n - i*(i+1)/2 and holds the n-i-1 later nodes,
+    # so blocks of consecutive rows with about chunk_size pairs each get longer along the matrix:
+    offsets = np.concatenate([[0], np.cumsum(np.arange(n-1, 0, -1))]).astype(np.int64)
+    boundaries = np.unique(np.searchsorted(offsets, np.arange(0, offsets[-1], chunk_size), side='right') - 1)
+    boundaries = np.append(boundaries, max(n-1, 0))
+    
+    def fill_block(start, stop):
+        #Distances from the rows of the block to every later node:
+        block = np.zeros((stop-start, n-start-1))
+        for k in range(GDM.shape[1]):
+            num = np.abs(log_num[start:stop, k, None] - log_num[None, start+1:, k])
+            den = np.maximum(log_den[start:stop, k, None], log_den[None, start+1:, k])
+            block += w[k]*num/den
+        
+        for i in range(start, stop):
+            D_cond[offsets[i]:offsets[i+1]] = block[i-start, i-start:]
+    
+    blocks = list(zip(boundaries[:-1], boundaries[1:]))
+    if n_jobs == 1:
+        for start, stop in blocks:
+            fill_block(start, stop)
+    else:
+        Parallel(n_jobs=n_jobs, prefer='threads')(delayed(fill_block)(start, stop) for start, stop in blocks)
+    
+    return D_cond
 
 def get_D_matrix_dict(GDM_dict, save=True, test=False, filepath=None, num_cores=num_cores):
     """
@@ -118,27 +221,33 @@ def get_D_matrix_dict(GDM_dict, save=True, test=False, filepath=None, num_cores=
     if save:
         if filepath is None:
             if test:
-                filepath = '../data/test-run/Dmatrix_dict.pickle'
+                filepath = config.get_path('test-run/Dmatrix_dict.pickle')
             else:
-                filepath = '../data/d3_results/Dmatrix_dict.pickle'
+                filepath = config.get_path('d3_results/Dmatrix_dict.pickle')
                 
         with open(filepath, 'wb') as file:
             pkl.dump(D_dict, file)
         
     return D_dict
 
-def get_linkage_dict(D_matrix_dict, cluster_method, save=True, test=False, filepath=None, num_cores=num_cores):
+def get_linkage_dict(D_matrix_dict, cluster_method, save=True, test=False, filepath=None, num_cores=num_cores,
+                     memmap_dir=None):
     """
     Gets a dictionary with the linkage matrix corresponding to each city
     
     :param D_matrix_dict: dictionary, keys are tuples (city, country) and values are condensed distance matrices
     :param cluster_method: string detailing type of agglomerative clustering; one of single, complete, average, or weighted
+    :param memmap_dir: string, if given the matrices are memory-mapped from files in this directory (see to_memmap)
     
     :return dictionary with the same keys, values are linkage arrays
     """
     
+    from scipy.cluster.hierarchy import linkage
+    
     keys = list(D_matrix_dict.keys())
     inputs = list(D_matrix_dict.values())
+    if memmap_dir is not None:
+        inputs = [to_memmap(D_cond, memmap_dir) for D_cond in inputs]
     outputs = Parallel(n_jobs=num_cores)(delayed(linkage)(i, method=cluster_method, metric=None) for i in inputs)
         
     linkage_dict = dict(zip(keys, outputs))
@@ -146,34 +255,573 @@ def get_linkage_dict(D_matrix_dict, cluster_method, save=True, test=False, filep
     if save:
         if filepath is None:
             if test:
-                filepath = '../data/test-run/linkage_dict' + cluster_method + '.pickle'
+                filepath = config.get_path('test-run/linkage_dict' + cluster_method + '.pickle')
             else:
-                filepath = '../data/d3_results/linkage_dict' + cluster_method + '.pickle'
+                filepath = config.get_path('d3_results/linkage_dict' + cluster_method + '.pickle')
                 
         with open(filepath, 'wb') as file:
             pkl.dump(linkage_dict, file)
             
     return linkage_dict
 
-def get_Dmatrix_and_linkages(GDM, cluster_methods, save=True, test=False, filepath=None, num_cores=num_cores):
+def get_logged_linkage(D_matrix, cluster_method, key=None, run_log=None):
+    """
+    Gets the linkage matrix of a condensed distance matrix, recording it in run_log as a linkage stage
+    
+    :param D_matrix: condensed distance matrix
+    :param cluster_method: string, type of agglomerative clustering
+    :param key: tuple (city, country) or None
+    :param run_log: instrument.RunLog or None
+    
+    :return array
+    """
+    from scipy.cluster.hierarchy import linkage
+    
+    with instrument.stage(run_log, 'linkage', key, cluster_method=cluster_method, n_pairs=len(D_matrix)):
+        linkage_arr = linkage(D_matrix, method=cluster_method, metric=None)
+    return linkage_arr
+
+def get_Dmatrix_and_linkages(GDM, cluster_methods, save=True, test=False, filepath=None, num_cores=num_cores,
+                             approximate=False, n_neighbors=15, collapse=False, memmap_dir=None, key=None, run_log=None):
     """
     Gets a distance matrix and a linkage matrix given a single GDM and a cluster method
     
     :param GDM: numpy array, graphlet degree matrix
     :param cluster_method: string detailing type of agglomerative clustering; one of single, complete, average, or weighted
+    :param approximate: Boolean, if True no distance matrix is built and the linkages come from the k-nearest
+                        neighbour graph of the GDVs (see get_approximate_linkages), only single and average
+    :param n_neighbors: int, number of neighbours of each node when approximate is True
+    :param collapse: Boolean, if True identical GDVs are clustered once, weighted by their multiplicity, and the
+                     linkages are expanded back to all nodes (see get_collapsed_linkages). The distance matrix
+                     is then between the unique GDVs, np.unique(GDM, axis=0)
+    :param memmap_dir: string, if given the distance matrix is written once to a memory-mapped file in this
+                       directory, which every linkage worker attaches to without copying
+    :param key: tuple (city, country) of the GDM, used to identify its records in run_log
+    :param run_log: instrument.RunLog where the distance matrix and each linkage are recorded, or None. Collapsed
+                    and approximate linkages are recorded as a single stage, as they build their own distances
     
-    :return tuple of condensed distance matrix, array
+    :return tuple of condensed distance matrix (None if approximate), array
     """
     
     if GDM is None:
         D_matrix = None
         linkage_arr_list = [None for i in cluster_methods]
     
+    elif collapse:
+        with instrument.stage(run_log, 'linkage', key, cluster_method='collapsed', n_nodes=len(GDM), cores=num_cores):
+            D_matrix, linkage_arr_list = get_collapsed_linkages(GDM, cluster_methods, approximate, n_neighbors, num_cores)
+    
+    elif approximate:
+        D_matrix = None
+        with instrument.stage(run_log, 'linkage', key, cluster_method='approximate', n_nodes=len(GDM), cores=num_cores):
+            linkage_arr_list = get_approximate_linkages(GDM, cluster_methods, n_neighbors)
+    
     else:
-        D_matrix = get_D_matrix(GDM)
-        linkage_arr_list = Parallel(n_jobs=num_cores)(delayed(linkage)(D_matrix, method=cluster_method, metric=None)
-                                                                      for cluster_method in cluster_methods)
+        with instrument.stage(run_log, 'distances', key, n_nodes=len(GDM), cores=num_cores):
+            D_matrix = get_D_matrix(GDM, n_jobs=num_cores, memmap_dir=memmap_dir)
+        linkage_arr_list = Parallel(n_jobs=min(num_cores, len(cluster_methods)))(delayed(get_logged_linkage)(D_matrix, cluster_method,
+                                                                                                            key, run_log)
+                                                                                for cluster_method in cluster_methods)
     return (D_matrix, linkage_arr_list)
+
+def get_core_allocation(costs, num_cores=num_cores):
+    """
+    Splits a budget of cores between cities in proportion to their cost: each city gets at least one core
+      and at most all of them
+    
+    :param costs: list of floats, estimated cost of each city
+    :param num_cores: int, total number of cores
+    
+    :return np.array with the number of cores of each city
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    if len(costs) == 0 or costs.sum() == 0:
+        return np.ones(len(costs), dtype=int)
+    return np.clip(np.floor(num_cores*costs/costs.sum()), 1, num_cores).astype(int)
+
+def get_Dmatrix_and_linkages_scheduled(GDMs, cluster_methods, num_cores=num_cores, max_exact_nodes=None,
+                                       n_neighbors=15, keys=None, **kwargs):
+    """
+    Gets the distance matrix and linkages of many GDMs (get_Dmatrix_and_linkages) within a single budget of cores,
+      without nesting parallel pools: a city gets cores in proportion to its cost (n^2 nodes, or n*k*log(n) if
+      approximate), and cities with the same number of cores c run num_cores//c at a time. Tiny cities are then
+      packed one core each, while mega-cities get many cores for their own distance matrix and linkages.
+    
+    :param GDMs: list of GDMs (or None)
+    :param cluster_methods: list of strings, see get_Dmatrix_and_linkages
+    :param num_cores: int, total number of cores
+    :param max_exact_nodes: int, cities with more nodes use approximate linkages (only single and average, see
+                            get_approximate_linkages), if None all are exact
+    :param n_neighbors: int, number of neighbours of each node in approximate linkages
+    :param keys: list of tuples (city, country) of the GDMs, used to identify their records if a run_log is given
+    :param kwargs: other parameters of get_Dmatrix_and_linkages
+    
+    :return list of tuples (condensed distance matrix, list of linkage arrays), in the order of GDMs
+    """
+    n_nodes = [0 if GDM is None else len(GDM) for GDM in GDMs]
+    approximate = [max_exact_nodes is not None and n > max_exact_nodes for n in n_nodes]
+    #Fail before any city runs rather than losing the linkages of the large ones:
+    if any(approximate):
+        check_approximate_methods(cluster_methods)
+    costs = [n*n_neighbors*np.log2(n+1) if approx else float(n)**2 for n, approx in zip(n_nodes, approximate)]
+    cores = get_core_allocation(costs, num_cores)
+    
+    outputs = [None]*len(GDMs)
+    for city_cores in sorted(set(cores), reverse=True):
+        #Most expensive cities first, so the last workers do not wait on a large one:
+        group = sorted([i for i in range(len(GDMs)) if cores[i] == city_cores], key=lambda i: -costs[i])
+        group_outputs = Parallel(n_jobs=min(num_cores//city_cores, len(group)))(
+            delayed(get_Dmatrix_and_linkages)(GDMs[i], cluster_methods, num_cores=city_cores, approximate=approximate[i],
+                                              n_neighbors=n_neighbors, key=None if keys is None else keys[i], **kwargs)
+            for i in group)
+        for i, output in zip(group, group_outputs):
+            outputs[i] = output
+    
+    return outputs
+        
+
+#--------------------------------------------------------------------------------------------
+# Approximate clustering for large cities, without the quadratic distance matrix
+
+approximate_methods = ['single', 'average']    #Methods with an approximate (k-nearest neighbour graph) linkage
+
+def get_paired_GDVdistances(U, V, w):
+    """
+    Gets the weighted distance (get_GDVdistance) between the GDVs in the same row of two arrays
+    
+    :param U, V: np.arrays of the same shape, one GDV per row
+    :param w: np.array, the weight vector
+    
+    :return np.array with one distance per row
+    """
+    den = np.log(np.maximum(U, V)+2)
+    return np.sum(w*np.abs(np.log(U+1) - np.log(V+1))/den, axis=1)
+
+def get_knn_graph(GDM, w, n_neighbors=15, n_candidates=None, chunk_size=2**20):
+    """
+    Gets the (approximate) k-nearest neighbour graph of the GDVs under the weighted distance. Candidates are
+      found with a KD-tree on the weighted log-counts w*log(u+1) (L1 norm) and ranked with the exact distance.
+    
+    :param GDM: np.array where each row is a GDV i.e. corresponds to a node
+    :param w: np.array, the weight vector
+    :param n_neighbors: int, number of neighbours kept for each node
+    :param n_candidates: int, number of KD-tree candidates ranked for each node, default is 3*n_neighbors
+    :param chunk_size: int, approximate number of candidate pairs ranked at once
+    
+    :return tuple of np.array of shape (E, 2) with each edge once (smallest node first) and np.array with their distances
+    """
+    from scipy.spatial import cKDTree
+    
+    GDM = np.asarray(GDM, dtype=np.float64)
+    n = len(GDM)
+    k = min(n_neighbors, n-1)
+    if k < 1:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros(0)
+    n_candidates = min(n_candidates or 3*k, n-1)
+    
+    tree = cKDTree(w*np.log(GDM+1))
+    rows_per_block = max(1, chunk_size//(n_candidates+1))
+    
+    sources = []
+    targets = []
+    for start in range(0, n, rows_per_block):
+        stop = min(start+rows_per_block, n)
+        _, candidates = tree.query(w*np.log(GDM[start:stop]+1), k=n_candidates+1, p=1)
+    
+        #Exact distances to the candidates, ignoring the node itself (not always first if there are duplicates):
+        rows = np.repeat(np.arange(start, stop), n_candidates+1)
+        distances = get_paired_GDVdistances(GDM[rows], GDM[candidates.ravel()], w).reshape(candidates.shape)
+        distances[candidates == np.arange(start, stop)[:, None]] = np.inf
+        nearest = np.argpartition(distances, k-1, axis=1)[:, :k]
+    
+        sources.append(np.repeat(np.arange(start, stop), k))
+        targets.append(np.take_along_axis(candidates, nearest, axis=1).ravel())
+    
+    edges = np.sort(np.column_stack([np.concatenate(sources), np.concatenate(targets)]), axis=1)
+    edges = np.unique(edges, axis=0)
+    distances = get_paired_GDVdistances(GDM[edges[:, 0]], GDM[edges[:, 1]], w)
+    
+    return edges, distances
+
+def get_single_linkage_from_edges(n, edges, distances):
+    """
+    Gets the single linkage of a graph from its minimum spanning tree (Kruskal's algorithm): edges are
+      merged in order of distance, skipping those inside a cluster
+    
+    :param n: int, number of nodes
+    :param edges: np.array of shape (E, 2)
+    :param distances: np.array of shape (E,)
+    
+    :return list of linkage rows [cluster, cluster, distance, size], fewer than n-1 if the graph is disconnected
+    """
+    parent = list(range(n))
+    cluster_id = list(range(n))
+    size = [1]*n
+    
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+    
+    Z = []
+    for (u, v), distance in zip(edges[np.argsort(distances, kind='stable')].tolist(), np.sort(distances, kind='stable').tolist()):
+        a, b = find(u), find(v)
+        if a == b:
+            continue
+        Z.append([cluster_id[a], cluster_id[b], distance, size[a] + size[b]])
+        if size[a] < size[b]:
+            a, b = b, a
+        parent[b] = a
+        size[a] += size[b]
+        cluster_id[a] = n + len(Z) - 1
+        if len(Z) == n-1:
+            break
+    
+    return Z
+
+def get_average_linkage_from_edges(n, edges, distances, sizes=None):
+    """
+    Gets an average-like linkage restricted to the edges of a graph (as sklearn does with a connectivity
+      matrix): the closest connected clusters are merged, and the distance of the merged cluster to each
+      neighbour is the size-weighted average of the distances its two parts had to it
+    
+    :param n: int, number of nodes
+    :param edges: np.array of shape (E, 2), each edge once
+    :param distances: np.array of shape (E,)
+    :param sizes: np.array of shape (N,), number of observations each node stands for (default is 1)
+    
+    :return list of linkage rows [cluster, cluster, distance, size], fewer than n-1 if the graph is disconnected
+    """
+    neighbours = [dict() for _ in range(n)]
+    heap = []
+    for (u, v), distance in zip(edges.tolist(), distances.tolist()):
+        neighbours[u][v] = distance
+        neighbours[v][u] = distance
+        heap.append((distance, u, v))
+    heapq.heapify(heap)
+    cluster_id = list(range(n))
+    size = [1]*n if sizes is None else list(sizes)
+    
+    Z = []
+    while heap and len(Z) < n-1:
+        distance, a, b = heapq.heappop(heap)
+        #Entries of merged clusters, or whose distance was updated since, are outdated:
+        if neighbours[a] is None or neighbours[b] is None or neighbours[a].get(b) != distance:
+            continue
+        Z.append([cluster_id[a], cluster_id[b], distance, size[a] + size[b]])
+        
+        #The part with more neighbours absorbs the other, so only the neighbours of the smaller one are visited:
+        if len(neighbours[a]) < len(neighbours[b]):
+            a, b = b, a
+        del neighbours[a][b]
+        for c, d_b in neighbours[b].items():
+            if c == a:
+                continue
+            del neighbours[c][b]
+            d_a = neighbours[a].get(c)
+            merged_distance = d_b if d_a is None else (size[a]*d_a + size[b]*d_b)/(size[a] + size[b])
+            neighbours[a][c] = merged_distance
+            neighbours[c][a] = merged_distance
+            heapq.heappush(heap, (merged_distance, a, c))
+        
+        size[a] += size[b]
+        cluster_id[a] = n + len(Z) - 1
+        neighbours[b] = None
+    
+    return Z
+
+def complete_linkage(Z, n, GDM, w, cluster_method, sizes=None):
+    """
+    Finishes a linkage whose graph was disconnected, merging the remaining clusters with an exact linkage
+      between one representative node of each, at distances no smaller than the previous merges
+    
+    :param Z: list of linkage rows, fewer than n-1 if the graph was disconnected
+    :param n: int, number of nodes
+    :param GDM: np.array where each row is a GDV i.e. corresponds to a node
+    :param w: np.array, the weight vector
+    :param cluster_method: string, method of scipy's linkage used between the representatives
+    :param sizes: np.array of shape (N,), number of observations each node stands for (default is 1)
+    
+    :return np.array of shape (n-1, 4), linkage matrix in the scipy format
+    """
+    from scipy.cluster.hierarchy import linkage
+    
+    if len(Z) == n-1:
+        return np.array(Z, dtype=float).reshape(-1, 4)
+    
+    #Remaining clusters and a representative node of each:
+    merged = set(int(row[0]) for row in Z) | set(int(row[1]) for row in Z)
+    remaining = [cluster for cluster in range(n + len(Z)) if cluster not in merged]
+    representative = list(range(n))
+    size = [1]*n if sizes is None else list(sizes)
+    for row in Z:
+        representative.append(representative[int(row[0])])
+        size.append(row[3])
+    
+    D_cond = get_D_matrix_chunked(GDM[[representative[cluster] for cluster in remaining]], w)
+    Z_remaining = linkage(D_cond, method=cluster_method)
+    height = max([row[2] for row in Z], default=0)
+    
+    #Rows of Z_remaining refer to the remaining clusters first and then to their own merges:
+    n_remaining = len(remaining)
+    n_before = len(Z)
+    for row in Z_remaining:
+        a, b = [remaining[int(c)] if c < n_remaining else n + n_before + int(c) - n_remaining for c in row[:2]]
+        height = max(height, row[2])
+        Z.append([a, b, height, size[a] + size[b]])
+        size.append(size[a] + size[b])
+    
+    return np.array(Z, dtype=float)
+
+def check_approximate_methods(cluster_methods):
+    """
+    Raises a ValueError if some cluster method has no approximate linkage (only single and average have one)
+    
+    :param cluster_methods: list of strings
+    """
+    unsupported = [cluster_method for cluster_method in cluster_methods if cluster_method not in approximate_methods]
+    if unsupported:
+        raise ValueError('Approximate linkages are only available for ' + ' and '.join(approximate_methods) +
+                         ', not for ' + ', '.join(unsupported) + '. Use exact linkages (max_exact_nodes=None) '
+                         'or only request ' + ' and '.join(approximate_methods) + '.')
+
+def get_approximate_linkages(GDM, cluster_methods, n_neighbors=15, sizes=None):
+    """
+    Gets linkage matrices (scipy format) from the k-nearest neighbour graph of the GDVs, without the
+      distance matrix: memory is linear in the number of nodes. Single linkage is exact on that graph
+      (its minimum spanning tree), average linkage only averages over the edges of the graph.
+    
+    :param GDM: numpy array, graphlet degree matrix
+    :param cluster_methods: list of strings, among single and average
+    :param n_neighbors: int, number of neighbours of each node
+    :param sizes: np.array of shape (N,), number of observations each GDV stands for (default is 1)
+    
+    :return list of linkage arrays, one per method, each with n-1 rows (components of the k-nearest neighbour
+            graph are joined at the top, see complete_linkage)
+    """
+    from scipy.cluster.hierarchy import is_valid_linkage
+    
+    check_approximate_methods(cluster_methods)
+    
+    GDM = np.asarray(GDM, dtype=np.float64)
+    n = len(GDM)
+    if n < 2:
+        return [np.zeros((0, 4)) for cluster_method in cluster_methods]
+    w = get_w_vec(num_orbits=GDM.shape[1])
+    edges, distances = get_knn_graph(GDM, w, n_neighbors)
+    
+    linkage_arr_list = []
+    for cluster_method in cluster_methods:
+        if cluster_method == 'single':
+            Z = get_single_linkage_from_edges(n, edges, distances)
+        else:
+            Z = get_average_linkage_from_edges(n, edges, distances, sizes)
         
+        #If the graph is disconnected its components are only joined by complete_linkage, check the whole tree:
+        Z = complete_linkage(Z, n, GDM, w, cluster_method, sizes)
+        if len(Z) != n-1 or not is_valid_linkage(Z):
+            raise RuntimeError('The approximate ' + cluster_method + ' linkage does not join all ' + str(n) + ' nodes.')
+        linkage_arr_list.append(Z)
+    
+    return linkage_arr_list
+
+#--------------------------------------------------------------------------------------------
+# Collapsing duplicate GDVs: cluster each distinct GDV once, weighted by how many nodes have it
+
+def get_unique_GDVs(GDM):
+    """
+    Collapses identical rows of a GDM
+    
+    :param GDM: np.array where each row is a GDV i.e. corresponds to a node
+    
+    :return tuple of np.array of the unique GDVs, np.array with the unique GDV of each node (index), and
+            np.array with the number of nodes of each unique GDV
+    """
+    GDM_unique, inverse, counts = np.unique(GDM, axis=0, return_inverse=True, return_counts=True)
+    return GDM_unique, inverse.reshape(-1), counts
+
+def get_weighted_linkage(D_cond, sizes, method='average'):
+    """
+    Gets the linkage of observations that stand for several observations each (identical GDVs, or the
+      tiles of a micro-cluster), with the nearest neighbour chain algorithm (as scipy does) and the
+      Lance-Williams update of the method weighted by cluster sizes. With identical observations this is
+      the linkage of the expanded data after its duplicates are merged.
+    
+    :param D_cond: condensed distance matrix between the observations. For ward, the distance between
+                   clusters i and j is sqrt(2*n_i*n_j/(n_i+n_j)) times the distance of their centroids
+    :param sizes: np.array, number of observations each one stands for
+    :param method: string, one of single, complete, average, weighted, or ward
+    
+    :return np.array of shape (m-1, 4), linkage matrix in the scipy format (sizes count the expanded observations)
+    """
+    m = len(sizes)
+    D = np.array(D_cond, dtype=np.float64)
+    size = np.asarray(sizes, dtype=np.float64).copy()
+    alive = np.ones(m, dtype=bool)
+    others = np.arange(m, dtype=np.int64)
+    
+    def get_positions(i):
+        #Position of each pair (i, j) in the condensed matrix:
+        low, high = np.minimum(i, others), np.maximum(i, others)
+        return low*m - low*(low+1)//2 + (high - low - 1)
+    
+    def get_row(i):
+        row = D[get_positions(i)]
+        row[~alive] = np.inf
+        row[i] = np.inf
+        return row
+    
+    merges = []
+    chain = []
+    for _ in range(m-1):
+        if not chain:
+            chain = [int(np.argmax(alive))]
+        
+        #Follow nearest neighbours until two clusters are each other's nearest:
+        while True:
+            x = chain[-1]
+            row = get_row(x)
+            y = int(np.argmin(row))
+            if len(chain) > 1 and row[chain[-2]] == row[y]:
+                y = chain[-2]
+            if len(chain) > 1 and y == chain[-2]:
+                break
+            chain.append(y)
+        
+        chain = chain[:-2]
+        distance = row[y]
+        merges.append((x, y, distance))
+        
+        #The merged cluster takes the place of y, with the Lance-Williams update:
+        positions = get_positions(y)
+        update = alive.copy()
+        update[[x, y]] = False
+        d_x, d_y, s_k = row[update], D[positions[update]], size[update]
+        s_x, s_y = size[x], size[y]
+        if method == 'single':
+            new_row = np.minimum(d_x, d_y)
+        elif method == 'complete':
+            new_row = np.maximum(d_x, d_y)
+        elif method == 'average':
+            new_row = (s_x*d_x + s_y*d_y)/(s_x + s_y)
+        elif method == 'weighted':
+            new_row = (d_x + d_y)/2
+        elif method == 'ward':
+            new_row = np.sqrt(((s_x + s_k)*d_x**2 + (s_y + s_k)*d_y**2 - s_k*distance**2)/(s_x + s_y + s_k))
+        else:
+            print('Invalid method. Only valid parameters are single, complete, average, weighted, and ward.')
+            return None
+        D[positions[update]] = new_row
+        size[y] += size[x]
+        alive[x] = False
+    
+    #Sort the merges by distance and label clusters as scipy does:
+    parent = list(range(m))
+    cluster_id = list(range(m))
+    cluster_size = list(np.asarray(sizes, dtype=np.float64))
+    
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+    
+    Z = np.zeros((m-1, 4))
+    for i, k in enumerate(np.argsort([distance for _, _, distance in merges], kind='stable')):
+        x, y, distance = merges[k]
+        a, b = find(x), find(y)
+        Z[i] = [min(cluster_id[a], cluster_id[b]), max(cluster_id[a], cluster_id[b]), distance,
+                cluster_size[a] + cluster_size[b]]
+        parent[a] = b
+        cluster_id[b] = m + i
+        cluster_size[b] += cluster_size[a]
+    
+    return Z
+
+def expand_linkage(Z_unique, inverse, counts):
+    """
+    Expands a linkage between unique GDVs to a linkage between all nodes: the nodes of each unique GDV are
+      first merged at distance 0, and then their groups follow the unique linkage
+    
+    :param Z_unique: linkage matrix between the unique GDVs
+    :param inverse: np.array with the unique GDV of each node
+    :param counts: np.array with the number of nodes of each unique GDV
+    
+    :return np.array of shape (n-1, 4), linkage matrix in the scipy format
+    """
+    n = len(inverse)
+    m = len(counts)
+    Z = np.zeros((n-1, 4))
+    
+    #Merge the nodes of each unique GDV in a chain, the last merge represents the group:
+    order = np.argsort(inverse, kind='stable')
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    group_cluster = np.zeros(m, dtype=np.int64)
+    size = np.ones(2*n-1)
+    row = 0
+    for group in range(m):
+        nodes = order[starts[group]:starts[group]+counts[group]]
+        current = nodes[0]
+        for node in nodes[1:]:
+            Z[row] = [min(current, node), max(current, node), 0, size[current] + 1]
+            size[n+row] = size[current] + 1
+            current = n + row
+            row += 1
+        group_cluster[group] = current
+    
+    #Then the unique linkage, with its clusters renamed:
+    n_zero = row
+    for i, (a, b, distance, _) in enumerate(Z_unique):
+        a, b = [group_cluster[int(c)] if c < m else n + n_zero + int(c) - m for c in (a, b)]
+        Z[row] = [min(a, b), max(a, b), distance, size[a] + size[b]]
+        size[n+row] = size[a] + size[b]
+        row += 1
+    
+    return Z
+
+def get_collapsed_linkages(GDM, cluster_methods, approximate=False, n_neighbors=15, num_cores=num_cores):
+    """
+    Gets the linkages of the nodes computing distances and linkages only between their unique GDVs. Identical
+      GDVs are at distance 0, so for single, complete and weighted linkage the result is the same as clustering
+      all nodes, and average linkage weights each unique GDV by its number of nodes.
+    
+    :param GDM: numpy array, graphlet degree matrix
+    :param cluster_methods: list of strings among single, complete, average, and weighted
+    :param approximate: Boolean, whether the unique GDVs are clustered with get_approximate_linkages
+    :param n_neighbors: int, number of neighbours of each unique GDV when approximate is True
+    :param num_cores: int, number of linkages computed at once
+    
+    :return tuple of condensed distance matrix between the unique GDVs (None if approximate), list of arrays
+    """
+    from scipy.cluster.hierarchy import linkage
+    
+    GDM_unique, inverse, counts = get_unique_GDVs(GDM)
+    
+    if approximate:
+        D_matrix = None
+        Z_unique_list = get_approximate_linkages(GDM_unique, cluster_methods, n_neighbors, sizes=counts)
+    
+    else:
+        D_matrix = get_D_matrix(GDM_unique, n_jobs=num_cores)
+    
+        def get_unique_linkage(cluster_method):
+            if len(GDM_unique) < 2:
+                return np.zeros((0, 4))
+            elif cluster_method == 'average':
+                return get_weighted_linkage(D_matrix, counts, 'average')
+            elif cluster_method in ['single', 'complete', 'weighted']:
+                return linkage(D_matrix, method=cluster_method, metric=None)
+            else:
+                print('Invalid cluster_method for collapsed GDVs. Only valid parameters are single, complete, average, and weighted.')
+                return None
+    
+        Z_unique_list = Parallel(n_jobs=min(num_cores, len(cluster_methods)), prefer='threads')(
+            delayed(get_unique_linkage)(cluster_method) for cluster_method in cluster_methods)
+    
+    linkage_arr_list = [None if Z_unique is None else expand_linkage(Z_unique, inverse, counts)
+                        for Z_unique in Z_unique_list]
+    
+    return D_matrix, linkage_arr_list
 
 #--------------------------------------------------------------------------------------------
\ No newline at end of file
@@ -1,12 +1,17 @@
 #include "liborca.h"
 
 char motif_count_func_docs[] = "Count motifs";
+char motif_count_arr_func_docs[] = "Count motifs from an (E, 2) int32 edge array, returns an int64 array of orbit counts";
 
 PyMethodDef orca_funcs[] = {
 	{	"motif_counts_str",
 		(PyCFunction)motif_counts_wrap,
 		METH_VARARGS,
 		motif_count_func_docs},
+	{	"motif_counts_arr",
+		(PyCFunction)motif_counts_arr_wrap,
+		METH_VARARGS,
+		motif_count_arr_func_docs},
 	{	NULL}
 };
 
@@ -25,5 +30,6 @@ PyModuleDef orca_mod = {
 };
 
 PyMODINIT_FUNC PyInit_orcastr(void) {
+	import_array();
 	return PyModule_Create(&orca_mod);
 }
@@ -1,4 +1,8 @@
 #include "Python.h"
+#define PY_ARRAY_UNIQUE_SYMBOL orca_ARRAY_API
+#define NO_IMPORT_ARRAY
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#include <numpy/arrayobject.h>
 #include <cstdio>
 #include <cstdlib>
 #include <cstring>
@@ -59,6 +63,28 @@ struct hash_TRIPLE {
     }
 };
 
+const int adj_chunk = 8*sizeof(int);
+const int node_orbits[] = {0,0,1,4,15,73}; // number of node orbits per graphlet size
+const int edge_orbits[] = {0,0,0,2,12,68}; // number of edge orbits per graphlet size
+
+int check_args(const char* orbit_type, int graphlet_size, string &err) {
+    if (strcmp(orbit_type, "node")!=0 && strcmp(orbit_type, "edge")!=0) {
+        err = string("Incorrect orbit type '") + orbit_type + "'. Should be 'node' or 'edge'.";
+        return 0;
+    }
+    if (graphlet_size!=4 && graphlet_size!=5) {
+        err = "Incorrect graphlet size " + to_string(graphlet_size) + ". Should be 4 or 5.";
+        return 0;
+    }
+    return 1;
+}
+
+/**
+ * All the state of a single orbit count. Every call works on its own context, so several
+ * counts can run at the same time (in different threads) within one process.
+ */
+struct Orca {
+
 unordered_map<PAIR, int, hash_PAIR> common2;
 unordered_map<TRIPLE, int, hash_TRIPLE> common3;
 unordered_map<PAIR, int, hash_PAIR>::iterator common2_it;
@@ -75,9 +101,9 @@ int **adj; // adj[x] - adjacency list of node x
 PII **inc; // inc[x] - incidence list of node x: (y, edge id)
 bool adjacent_list(int x, int y) { return binary_search(adj[x],adj[x]+deg[x],y); }
 int *adj_matrix; // compressed adjacency matrix
-const int adj_chunk = 8*sizeof(int);
+bool use_adj_matrix; // whether adjacency is tested on adj_matrix or on the adjacency lists
 bool adjacent_matrix(int x, int y) { return adj_matrix[(x*n+y)/adj_chunk]&(1<<((x*n+y)%adj_chunk)); }
-bool (*adjacent)(int,int);
+bool adjacent(int x, int y) { return use_adj_matrix ? adjacent_matrix(x,y) : adjacent_list(x,y); }
 int getEdgeId(int x, int y) { return inc[x][lower_bound(adj[x],adj[x]+deg[x],y)-adj[x]].second; }
 
 int64 **orbit; // orbit[x][o] - how many times does node x participate in orbit o
@@ -1437,20 +1463,77 @@ string writeEdgeResultsString(int g) {
     return ss.str();
 }
 
+
+/** check the edge list and set up adjacency, incidence structures (edges, deg, n, m must be set) */
+int init_graph(string &err) {
+    if ((int)(set<PAIR>(edges,edges+m).size())!=m) {
+        err = "Input contains duplicate undirected edges.";
+        return 0;
+    }
+    // set up adjacency matrix if it's smaller than 100MB
+    if ((int64)n*n < 100LL*1024*1024*8) {
+        use_adj_matrix = true;
+        adj_matrix = (int*)calloc((n*n)/adj_chunk+1,sizeof(int));
+        for (int i=0;i<m;i++) {
+            int a=edges[i].a, b=edges[i].b;
+            adj_matrix[(a*n+b)/adj_chunk]|=(1<<((a*n+b)%adj_chunk));
+            adj_matrix[(b*n+a)/adj_chunk]|=(1<<((b*n+a)%adj_chunk));
+        }
+    } else {
+        use_adj_matrix = false;
+    }
+    // set up adjacency, incidence lists
+    adj = (int**)malloc(n*sizeof(int*));
+    for (int i=0;i<n;i++) adj[i] = (int*)malloc(deg[i]*sizeof(int));
+    inc = (PII**)malloc(n*sizeof(PII*));
+    for (int i=0;i<n;i++) inc[i] = (PII*)malloc(deg[i]*sizeof(PII));
+    int *d = (int*)calloc(n,sizeof(int));
+    for (int i=0;i<m;i++) {
+        int a=edges[i].a, b=edges[i].b;
+        adj[a][d[a]]=b; adj[b][d[b]]=a;
+        inc[a][d[a]]=PII(b,i); inc[b][d[b]]=PII(a,i);
+        d[a]++; d[b]++;
+    }
+    for (int i=0;i<n;i++) {
+        sort(adj[i],adj[i]+deg[i]);
+        sort(inc[i],inc[i]+deg[i]);
+    }
+    free(d);
+    return 1;
+}
+
+/** release the structures allocated by init_graph (and the edge list, degrees) */
+void free_graph() {
+    free(edges);
+    free(deg);
+    if (use_adj_matrix) free(adj_matrix);
+    for (int i=0;i<n;i++) free(adj[i]);
+    free(adj);
+    for (int i=0;i<n;i++) free(inc[i]);
+    free(inc);
+}
+
+/** count node or edge orbits; orbit/eorbit must point to allocated rows */
+void run_counts(const char* orbit_type, int graphlet_size) {
+    if (strcmp(orbit_type,"node") == 0) {
+        if (graphlet_size==4) count4();
+        if (graphlet_size==5) count5();
+    } else {
+        if (graphlet_size==4) ecount4();
+        if (graphlet_size==5) ecount5();
+    }
+}
+
 int motif_counts(const char* orbit_type, int graphlet_size, 
         const char* input_str, const char* output_filename, string &out_str) {
     common2.clear();
     common3.clear();
-    bool use_adj_matrix;
+    string err;
     //fstream fin; // input and output files
     stringstream fin(input_str);
     // open input, output files
-    if (strcmp(orbit_type, "node")!=0 && strcmp(orbit_type, "edge")!=0) {
-        cerr << "Incorrect orbit type '" << orbit_type << "'. Should be 'node' or 'edge'." << endl;
-        return 0;
-    }
-    if (graphlet_size!=4 && graphlet_size!=5) {
-        cerr << "Incorrect graphlet size " << graphlet_size << ". Should be 4 or 5." << endl;
+    if (!check_args(orbit_type, graphlet_size, err)) {
+        cerr << err << endl;
         return 0;
     }
     //fin.open(input_filename, fstream::in);
@@ -1484,40 +1567,10 @@ int motif_counts(const char* orbit_type, int graphlet_size,
     //printf("edges: %d\n",m);
     //printf("max degree: %d\n",d_max);
     //fin.close();
-    if ((int)(set<PAIR>(edges,edges+m).size())!=m) {
-        cerr << "Input file contains duplicate undirected edges." << endl;
+    if (!init_graph(err)) {
+        cerr << err << endl;
         return 0;
     }
-    // set up adjacency matrix if it's smaller than 100MB
-    if ((int64)n*n < 100LL*1024*1024*8) {
-        use_adj_matrix = true;
-        adjacent = adjacent_matrix;
-        adj_matrix = (int*)calloc((n*n)/adj_chunk+1,sizeof(int));
-        for (int i=0;i<m;i++) {
-            int a=edges[i].a, b=edges[i].b;
-            adj_matrix[(a*n+b)/adj_chunk]|=(1<<((a*n+b)%adj_chunk));
-            adj_matrix[(b*n+a)/adj_chunk]|=(1<<((b*n+a)%adj_chunk));
-        }
-    } else {
-        use_adj_matrix = false;
-        adjacent = adjacent_list;
-    }
-    // set up adjacency, incidence lists
-    adj = (int**)malloc(n*sizeof(int*));
-    for (int i=0;i<n;i++) adj[i] = (int*)malloc(deg[i]*sizeof(int));
-    inc = (PII**)malloc(n*sizeof(PII*));
-    for (int i=0;i<n;i++) inc[i] = (PII*)malloc(deg[i]*sizeof(PII));
-    int *d = (int*)calloc(n,sizeof(int));
-    for (int i=0;i<m;i++) {
-        int a=edges[i].a, b=edges[i].b;
-        adj[a][d[a]]=b; adj[b][d[b]]=a;
-        inc[a][d[a]]=PII(b,i); inc[b][d[b]]=PII(a,i);
-        d[a]++; d[b]++;
-    }
-    for (int i=0;i<n;i++) {
-        sort(adj[i],adj[i]+deg[i]);
-        sort(inc[i],inc[i]+deg[i]);
-    }
     // initialize orbit counts
     orbit = (int64**)malloc(n*sizeof(int64*));
     for (int i=0;i<n;i++) orbit[i] = (int64*)calloc(73,sizeof(int64));
@@ -1525,10 +1578,9 @@ int motif_counts(const char* orbit_type, int graphlet_size,
     eorbit = (int64**)malloc(m*sizeof(int64*));
     for (int i=0;i<m;i++) eorbit[i] = (int64*)calloc(68,sizeof(int64));
 
-    if (strcmp(orbit_type,"node") == 0) {
+    run_counts(orbit_type, graphlet_size);
+    if (strcmp(orbit_type, "node") == 0) {
         //printf("Counting NODE orbits of graphlets on %d nodes.\n\n",graphlet_size);
-        if (graphlet_size==4) count4();
-        if (graphlet_size==5) count5();
         if (strcmp(output_filename, "std") == 0) {
             cout << "orbit counts: \n" << writeResultsString(graphlet_size) << endl;
         } else {
@@ -1537,8 +1589,6 @@ int motif_counts(const char* orbit_type, int graphlet_size,
         }
     } else {
         //printf("Counting EDGE orbits of graphlets on %d nodes.\n\n",graphlet_size);
-        if (graphlet_size==4) ecount4();
-        if (graphlet_size==5) ecount5();
         if (strcmp(output_filename, "std") == 0) {
             cout << "orbit counts: \n" << writeEdgeResultsString(graphlet_size) << endl;
         } else {
@@ -1547,17 +1597,7 @@ int motif_counts(const char* orbit_type, int graphlet_size,
         }
     }
 
-    free(edges);
-    free(deg);
-    free(d);
-    if (use_adj_matrix) {
-        free(adj_matrix);
-    } else {
-        for (int i=0;i<n;i++) free(adj[i]);
-        free(adj);
-    }
-    for (int i=0;i<n;i++) free(inc[i]);
-    free(inc);
+    free_graph();
     for (int i=0;i<n;i++) free(orbit[i]);
     free(orbit);
     for (int i=0;i<m;i++) free(eorbit[i]);
@@ -1565,6 +1605,62 @@ int motif_counts(const char* orbit_type, int graphlet_size,
     return 1;
 }
 
+/**
+ * Count orbits of a graph given as a contiguous (n_edges x 2) array of node ids.
+ * Counts are written row by row into out, which must hold n_nodes x node_orbits[graphlet_size]
+ * (node orbits) or n_edges x edge_orbits[graphlet_size] (edge orbits) zero-initialized int64 values.
+ */
+int motif_counts_edges(const char* orbit_type, int graphlet_size, int n_nodes,
+        const int* edge_data, int n_edges, int64* out, string &err) {
+    if (!check_args(orbit_type, graphlet_size, err)) return 0;
+    common2.clear();
+    common3.clear();
+    n = n_nodes; m = n_edges;
+    edges = (PAIR*)malloc(m*sizeof(PAIR));
+    deg = (int*)calloc(n,sizeof(int));
+    for (int i=0;i<m;i++) {
+        int a=edge_data[2*i], b=edge_data[2*i+1];
+        if (!(0<=a && a<n) || !(0<=b && b<n) || a==b) {
+            err = !(0<=a && a<n) || !(0<=b && b<n) ? "Node ids should be between 0 and n-1."
+                                                   : "Self loops (edge from x to x) are not allowed.";
+            free(edges);
+            free(deg);
+            return 0;
+        }
+        deg[a]++; deg[b]++;
+        edges[i]=PAIR(a,b);
+    }
+    if (!init_graph(err)) {
+        free(edges);
+        free(deg);
+        return 0;
+    }
+    // orbit rows point straight into the output buffer, the unused orbit type shares a scratch row
+    bool node_type = strcmp(orbit_type, "node") == 0;
+    int64 *scratch = NULL;
+    orbit = (int64**)malloc(n*sizeof(int64*));
+    eorbit = (int64**)malloc(m*sizeof(int64*));
+    if (node_type) {
+        scratch = (int64*)calloc(edge_orbits[graphlet_size],sizeof(int64));
+        for (int i=0;i<n;i++) orbit[i] = out + (int64)i*node_orbits[graphlet_size];
+        for (int i=0;i<m;i++) eorbit[i] = scratch;
+    } else {
+        scratch = (int64*)calloc(node_orbits[graphlet_size],sizeof(int64));
+        for (int i=0;i<n;i++) orbit[i] = scratch;
+        for (int i=0;i<m;i++) eorbit[i] = out + (int64)i*edge_orbits[graphlet_size];
+    }
+
+    run_counts(orbit_type, graphlet_size);
+
+    free_graph();
+    free(orbit);
+    free(eorbit);
+    free(scratch);
+    return 1;
+}
+
+}; // struct Orca
+
 PyObject * motif_counts_wrap(PyObject *self, PyObject *args) {
     //(const char* orbit_type, int graphlet_size, 
     //    const char* input_filename, const char* output_filename, string &out_str)
@@ -1576,13 +1672,70 @@ PyObject * motif_counts_wrap(PyObject *self, PyObject *args) {
 		return NULL;
 
 	//sprintf(eq, "%d + %d", num1, num2);
-    static string out;
-    motif_counts(orbit_type, graphlet_size, input_filename, "", out);
+    string out;
+    Orca ctx;
+    // the input string stays alive through args, so the count can run without the GIL
+    Py_BEGIN_ALLOW_THREADS
+    ctx.motif_counts(orbit_type, graphlet_size, input_filename, "", out);
+    Py_END_ALLOW_THREADS
 
 	//return Py_BuildValue("is", num1 + num2, eq);
 	return PyUnicode_FromString(out.c_str());
 }
 
+PyObject * motif_counts_arr_wrap(PyObject *self, PyObject *args) {
+    char *orbit_type;
+    int graphlet_size, n_nodes;
+    PyObject *edges_obj;
+    Py_buffer view;
+
+    if (!PyArg_ParseTuple(args, "siiO", &orbit_type, &graphlet_size, &n_nodes, &edges_obj))
+        return NULL;
+    if (PyObject_GetBuffer(edges_obj, &view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) < 0)
+        return NULL;
+
+    string err;
+    if (view.ndim != 2 || (view.shape[0] > 0 && view.shape[1] != 2))
+        err = "Edges should be an array of shape (n_edges, 2).";
+    else if (view.itemsize != 4 || strchr("il", view.format[strlen(view.format)-1]) == NULL)
+        err = "Edges should be an array of int32 node ids.";
+    else if (n_nodes < 0)
+        err = "Number of nodes should be non-negative.";
+    else if (!check_args(orbit_type, graphlet_size, err)) ;
+    if (!err.empty()) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError, err.c_str());
+        return NULL;
+    }
+
+    int n_edges = (int)view.shape[0];
+    bool node_type = strcmp(orbit_type, "node") == 0;
+    npy_intp dims[2];
+    dims[0] = node_type ? n_nodes : n_edges;
+    dims[1] = node_type ? node_orbits[graphlet_size] : edge_orbits[graphlet_size];
+    PyObject *out = PyArray_ZEROS(2, dims, NPY_INT64, 0);
+    if (out == NULL) {
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+
+    // the edge buffer is held by view and the output array is not shared yet, so release the GIL
+    int ok;
+    Orca ctx;
+    int64 *out_data = (int64*)PyArray_DATA((PyArrayObject*)out);
+    Py_BEGIN_ALLOW_THREADS
+    ok = ctx.motif_counts_edges(orbit_type, graphlet_size, n_nodes, (const int*)view.buf, n_edges,
+                                out_data, err);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&view);
+    if (!ok) {
+        Py_DECREF(out);
+        PyErr_SetString(PyExc_ValueError, err.c_str());
+        return NULL;
+    }
+    return out;
+}
+
 
 int init(int argc, char *argv[]) {
     if (argc!=5) {
@@ -1593,7 +1746,8 @@ int init(int argc, char *argv[]) {
     int graphlet_size;
     sscanf(argv[2],"%d", &graphlet_size);
     string out;
-    motif_counts(argv[1], graphlet_size, argv[3], argv[4], out);
+    Orca ctx;
+    ctx.motif_counts(argv[1], graphlet_size, argv[3], argv[4], out);
 
     return 1;
 }
@@ -10,7 +10,11 @@
 #include <algorithm>
 
 #include <Python.h>
+#define PY_ARRAY_UNIQUE_SYMBOL orca_ARRAY_API
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#include <numpy/arrayobject.h>
 using namespace std;
 
 PyObject * motif_counts_wrap(PyObject *self, PyObject *args);
+PyObject * motif_counts_arr_wrap(PyObject *self, PyObject *args);
 
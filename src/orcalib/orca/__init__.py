@@ -1,4 +1,5 @@
 from .. import orcastr
+import numpy as np
 import networkx as nx
 
 def orbit_counts(task, size, graph):
@@ -11,3 +12,39 @@ def orbit_counts(task, size, graph):
     out = [[int(c) for c in s.split(" ")] for s in out.split("\n") if s]
     return out
 
+def edge_array(graph):
+    """
+    Gets the edges of a graph as an array of node positions (following the order of graph.nodes),
+      without self-loops and parallel edges
+
+    :param graph: networkx graph, nodes can have any hashable label, or a compact graph with its own
+                  edge_array method (see src.csr_graph), used as is
+
+    return: np.array of int32 and shape (E, 2)
+    """
+    if hasattr(graph, 'edge_array'):
+        return graph.edge_array()
+
+    index = {node: i for i, node in enumerate(graph)}
+    edges = np.fromiter((index[node] for edge in graph.edges(data=False) for node in edge[:2]),
+                        dtype=np.int32, count=2*graph.number_of_edges()).reshape(-1, 2)
+
+    #Orca expects a simple graph, so drop self-loops and parallel edges:
+    edges = np.sort(edges, axis=1)
+    edges = edges[edges[:, 0] != edges[:, 1]]
+    if graph.is_multigraph():
+        edges = np.unique(edges, axis=0)
+
+    return np.ascontiguousarray(edges)
+
+def orbit_counts_array(task, size, graph):
+    """
+    Counts orbits passing the edges to orca as an array, skipping the text round trip of orbit_counts
+
+    :param task: 'node' or 'edge'
+    :param size: 4 or 5, maximum size of graphlets
+    :param graph: networkx graph or src.csr_graph.CSRGraph
+
+    return: np.array of int64, one row per node (in the order of graph.nodes) or per edge of edge_array(graph)
+    """
+    return orcastr.motif_counts_arr(task, size, len(graph), edge_array(graph))
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 
 from setuptools import setup, Extension
+import numpy as np
 
 setup(
 	name = "orca",
 	version = "1.0",
-	ext_modules = [Extension("orcastr", ["bind.cpp", "liborca.cpp"])],
+	ext_modules = [Extension("orcastr", ["bind.cpp", "liborca.cpp"], include_dirs=[np.get_include()])],
         py_modules = ["orca"]
 	);
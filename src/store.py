@@ -0,0 +1,497 @@
+#--------------------------------------------------------------------------------------------
+# GOAL: store per-city results on disk, one partition per (city, country), written once
+#--------------------------------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import pickle as pkl
+from collections.abc import Mapping
+sys.path.append('../')
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from affine import Affine
+
+from src.csr_graph import CSRGraph
+
+#--------------------------------------------------------------------------------------------
+
+def atomic_write(filepath, write_func, mode='wb'):
+    """
+    Writes a file through a temporary file in the same directory that is renamed at the end,
+      so the file is either complete or not there at all (a crash never leaves it half written)
+
+    :param filepath: string, final path of the file
+    :param write_func: function receiving the open file object and writing the content
+    :param mode: string, 'wb' for binary files or 'w' for text files
+    """
+    directory = os.path.dirname(os.path.abspath(filepath))
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp_filepath = tempfile.mkstemp(dir=directory, prefix='.tmp_')
+    try:
+        with os.fdopen(fd, mode) as file:
+            write_func(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        raise
+
+def load_manifest(store_dir):
+    """
+    Loads the manifest of a store, i.e. the dictionary describing each of its partitions
+
+    :param store_dir: string, directory of the store
+
+    return: dictionary, keys are partition names and values are dictionaries with at least city and country
+    """
+    try:
+        with open(os.path.join(store_dir, 'manifest.json')) as file:
+            manifest = json.load(file)
+    except FileNotFoundError:
+        manifest = dict()
+    return manifest
+
+def update_manifest(store_dir, partition, entry):
+    """
+    Adds (or replaces) a partition in the manifest of a store
+
+    :param store_dir: string, directory of the store
+    :param partition: string, partition name
+    :param entry: dictionary describing the partition, must include city and country
+
+    return: the updated manifest
+    """
+    manifest = load_manifest(store_dir)
+    manifest[partition] = entry
+    atomic_write(os.path.join(store_dir, 'manifest.json'),
+                 lambda file: json.dump(manifest, file, indent=1), mode='w')
+    return manifest
+
+def get_partition_name(city, country, manifest):
+    """
+    Gets a filename-safe partition name for (city, country), reusing its name if already in the manifest
+
+    :param city: string
+    :param country: string
+    :param manifest: dictionary, the manifest of the store
+
+    return: string
+    """
+    for partition, entry in manifest.items():
+        if (entry['city'], entry['country']) == (city, country):
+            return partition
+
+    #Names such as 'N/A' are not valid filenames, and different names could collide once cleaned:
+    name = re.sub(r'[^\w\-]+', '_', city) + '__' + re.sub(r'[^\w\-]+', '_', country)
+    partition = name
+    counter = 1
+    while partition in manifest:
+        partition = name + '_' + str(counter)
+        counter += 1
+    return partition
+
+def get_partitions(store_dir, cities=None, status='done'):
+    """
+    Lists the partitions of a store
+
+    :param store_dir: string, directory of the store
+    :param cities: list of tuples (city, country) to select, if None all partitions
+    :param status: string, only partitions with this status are returned (None for all)
+
+    return: list of tuples (partition name, manifest entry)
+    """
+    manifest = load_manifest(store_dir)
+    if cities is not None:
+        cities = set(tuple(key) for key in cities)
+
+    partitions = []
+    for partition, entry in manifest.items():
+        if status is not None and entry.get('status', 'done') != status:
+            continue
+        if cities is not None and (entry['city'], entry['country']) not in cities:
+            continue
+        partitions.append((partition, entry))
+    return partitions
+
+#--------------------------------------------------------------------------------------------
+# Tile store: one .npz file per city with the columns of the tiles GeoDataFrame
+
+def save_city_tiles(city_gdf, city, country, store_dir, transform, crs, n_orbits=11):
+    """
+    Writes the tiles of one city as a partition of the tile store. Geometries are not stored, they are
+      rebuilt from the pixel indices (row, col) and the raster transformation when reading
+
+    :param city_gdf: GeoDataFrame of the city tiles with row, col, classification, GDM, GCM and valid_GCM columns
+    :param city: string
+    :param country: string
+    :param store_dir: string, directory of the store
+    :param transform: affine.Affine, transformation of the city (clipped) raster
+    :param crs: crs of the city raster
+    :param n_orbits: int, size of the GCMs
+
+    return: string, the partition name
+    """
+    partition = get_partition_name(city, country, load_manifest(store_dir))
+
+    #GCMs as a dense array, GDMs (ragged) as their concatenated rows plus offsets:
+    n_tiles = len(city_gdf)
+    GCMs = np.full((n_tiles, n_orbits, n_orbits), np.nan)
+    for i, GCM in enumerate(city_gdf['GCM']):
+        if GCM is not None:
+            GCMs[i] = GCM
+    GDMs = [np.asarray(GDM) for GDM in city_gdf['GDM']]
+    GDM_offsets = np.concatenate([[0], np.cumsum([len(GDM) for GDM in GDMs])]).astype(np.int64)
+    GDM_values = np.concatenate(GDMs) if n_tiles else np.zeros((0, 15))
+
+    columns = {'row': city_gdf['row'].to_numpy(dtype=np.int32),
+               'col': city_gdf['col'].to_numpy(dtype=np.int32),
+               'classification': city_gdf['classification'].to_numpy(dtype=float),
+               'valid_GCM': city_gdf['valid_GCM'].to_numpy(dtype=bool),
+               'GCM': GCMs,
+               'GDM_values': GDM_values.astype(np.int64),
+               'GDM_offsets': GDM_offsets}
+
+    atomic_write(os.path.join(store_dir, partition + '.npz'), lambda file: np.savez(file, **columns))
+
+    entry = {'city': city, 'country': country, 'status': 'done', 'n_tiles': n_tiles,
+             'transform': list(transform)[:6], 'crs': crs.to_wkt() if hasattr(crs, 'to_wkt') else str(crs)}
+    update_manifest(store_dir, partition, entry)
+
+    return partition
+
+def load_tiles(store_dir, cities=None, columns=None, proj=None):
+    """
+    Reads the tile store, loading only the requested cities and columns
+
+    :param store_dir: string, directory of the store
+    :param cities: list of tuples (city, country), if None all cities in the store
+    :param columns: list of column names among row, col, classification, GDM, GCM, valid_GCM, geometry
+                    (city and country are always included), if None all columns
+    :param proj: crs to project the geometries, if None they stay in the raster crs
+
+    return: GeoDataFrame if geometry is among the columns, DataFrame otherwise
+    """
+    #Imported here since get_GCM itself writes to the store:
+    from src.get_GCM import get_tile_geometries
+
+    if columns is None:
+        columns = ['row', 'col', 'classification', 'GDM', 'GCM', 'valid_GCM', 'geometry']
+
+    city_dfs = []
+    for partition, entry in get_partitions(store_dir, cities):
+        with np.load(os.path.join(store_dir, partition + '.npz')) as arrays:
+            df = pd.DataFrame({column: arrays[column] for column in ['row', 'col', 'classification', 'valid_GCM']
+                               if column in columns})
+            if 'GCM' in columns:
+                df['GCM'] = pd.Series(list(arrays['GCM']), dtype=object)
+            if 'GDM' in columns:
+                offsets = arrays['GDM_offsets']
+                df['GDM'] = pd.Series(np.split(arrays['GDM_values'], offsets[1:-1]) if len(offsets) > 1 else [],
+                                      dtype=object)
+            if 'geometry' in columns:
+                geometries = get_tile_geometries(arrays['row'], arrays['col'], Affine(*entry['transform']))
+                df = gpd.GeoDataFrame(df, geometry=geometries, crs=entry['crs'])
+                if proj is not None:
+                    df = df.to_crs(proj)
+        df['city'] = entry['city']
+        df['country'] = entry['country']
+        city_dfs.append(df)
+
+    if not city_dfs:
+        return pd.DataFrame(columns=[column for column in columns if column != 'geometry'] + ['city', 'country'])
+
+    tiles_df = pd.concat(city_dfs, ignore_index=True)
+    if 'geometry' in columns:
+        tiles_df = gpd.GeoDataFrame(tiles_df, geometry='geometry', crs=city_dfs[0].crs)
+    return tiles_df
+
+def load_GCMs(store_dir, cities=None, valid_only=False):
+    """
+    Reads the GCMs of the tile store as a dense numeric array
+
+    :param store_dir: string, directory of the store
+    :param cities: list of tuples (city, country), if None all cities in the store
+    :param valid_only: Boolean, if True keep only tiles with valid GCM (only finite values)
+
+    return: tuple of np.array of shape (n_tiles, 11, 11) and DataFrame with city, country, row, col of each tile
+    """
+    GCMs = []
+    index_dfs = []
+    for partition, entry in get_partitions(store_dir, cities):
+        with np.load(os.path.join(store_dir, partition + '.npz')) as arrays:
+            keep = arrays['valid_GCM'] if valid_only else np.ones(len(arrays['row']), dtype=bool)
+            GCMs.append(arrays['GCM'][keep])
+            index_dfs.append(pd.DataFrame({'city': entry['city'], 'country': entry['country'],
+                                           'row': arrays['row'][keep], 'col': arrays['col'][keep]}))
+
+    if not GCMs:
+        return np.zeros((0, 11, 11)), pd.DataFrame(columns=['city', 'country', 'row', 'col'])
+
+    return np.concatenate(GCMs), pd.concat(index_dfs, ignore_index=True)
+
+#--------------------------------------------------------------------------------------------
+# Artifact store: one file per city (e.g. street networks), failures are kept in the manifest. CSR graphs are
+# written as their arrays (.npz, see CSRGraph.save), any other object is pickled
+
+def save_city_artifact(artifact, city, country, store_dir):
+    """
+    Writes the artifact of one city as a partition of the store
+
+    :param artifact: object to store, a CSRGraph or any picklable object (e.g. a networkx graph)
+    :param city: string
+    :param country: string
+    :param store_dir: string, directory of the store
+
+    return: string, the partition name
+    """
+    partition = get_partition_name(city, country, load_manifest(store_dir))
+    if isinstance(artifact, CSRGraph):
+        file_format = 'csr'
+        atomic_write(os.path.join(store_dir, partition + '.npz'), artifact.save)
+    else:
+        file_format = 'pickle'
+        atomic_write(os.path.join(store_dir, partition + '.pickle'),
+                     lambda file: pkl.dump(artifact, file, protocol=pkl.HIGHEST_PROTOCOL))
+    update_manifest(store_dir, partition, {'city': city, 'country': country, 'status': 'done', 'format': file_format})
+    return partition
+
+def save_city_failure(city, country, store_dir, error):
+    """
+    Records in the manifest that the artifact of a city could not be obtained
+
+    :param city: string
+    :param country: string
+    :param store_dir: string, directory of the store
+    :param error: exception or string describing the problem
+
+    return: string, the partition name
+    """
+    partition = get_partition_name(city, country, load_manifest(store_dir))
+    error = error if isinstance(error, str) else type(error).__name__ + ': ' + str(error)
+    update_manifest(store_dir, partition, {'city': city, 'country': country, 'status': 'failed', 'error': error})
+    return partition
+
+def load_city_artifact(city, country, store_dir):
+    """
+    Reads the artifact of one city
+
+    :param city: string
+    :param country: string
+    :param store_dir: string, directory of the store
+
+    return: the stored object, None if the city failed
+    """
+    return CityStore(store_dir)[(city, country)]
+
+class CityStore(Mapping):
+    """
+    Read-only dictionary view of an artifact store, keys are tuples (city, country) and each value is
+      only loaded (unpickled, or read with CSRGraph.load) when accessed. Failed cities map to None, as in the
+      pickled dictionaries.
+    
+    :attr store_dir: string, directory of the store
+    """
+    
+    def __init__(self, store_dir, cities=None):
+        """
+        :param store_dir: string, directory of the store
+        :param cities: list of tuples (city, country) to include, if None all cities in the store
+        """
+        self.store_dir = store_dir
+        self._partitions = {(entry['city'], entry['country']): (partition, entry)
+                            for partition, entry in get_partitions(store_dir, cities, status=None)}
+    
+    def __getitem__(self, key):
+        partition, entry = self._partitions[tuple(key)]
+        if entry['status'] == 'failed':
+            return None
+        if entry.get('format', 'pickle') == 'csr':
+            return CSRGraph.load(os.path.join(self.store_dir, partition + '.npz'))
+        with open(os.path.join(self.store_dir, partition + '.pickle'), 'rb') as file:
+            return pkl.load(file)
+    
+    def __iter__(self):
+        return iter(self._partitions)
+    
+    def __len__(self):
+        return len(self._partitions)
+    
+    def get_failures(self):
+        """
+        return: dictionary with the error of each failed city, keys are tuples (city, country)
+        """
+        return {key: entry.get('error') for key, (partition, entry) in self._partitions.items()
+                if entry['status'] == 'failed'}
+
+#--------------------------------------------------------------------------------------------
+# GDM store: the GDMs of all cities as one contiguous array, with the rows of each city in an index
+
+def save_GDMs(GDMs_dict, store_dir, n_orbits=None):
+    """
+    Writes the GDMs of all cities to GDMs.npy (one int64 array with the rows of every city, one after
+      the other) and the row range of each city to GDMs_index.json. Both are replaced atomically.
+
+    :param GDMs_dict: dictionary with GDMs (or None), keys are tuples (city, country)
+    :param store_dir: string, directory of the store
+    :param n_orbits: int, number of columns of the GDMs, if None taken from the first GDM (15 if there are none)
+
+    return: dictionary with the (start, stop) rows of each city, None for cities without GDM
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    if n_orbits is None:
+        n_orbits = next((GDM.shape[1] for GDM in GDMs_dict.values() if GDM is not None), 15)
+
+    index = dict()
+    n_rows = 0
+    for key, GDM in GDMs_dict.items():
+        index[key] = None if GDM is None else (n_rows, n_rows + len(GDM))
+        n_rows += 0 if GDM is None else len(GDM)
+
+    #Rows are copied city by city into the file, never concatenated in memory:
+    fd, tmp_filepath = tempfile.mkstemp(dir=store_dir, prefix='.tmp_', suffix='.npy')
+    os.close(fd)
+    try:
+        GDMs = np.lib.format.open_memmap(tmp_filepath, mode='w+', dtype=np.int64, shape=(n_rows, n_orbits))
+        for key, GDM in GDMs_dict.items():
+            if GDM is not None:
+                GDMs[index[key][0]:index[key][1]] = GDM
+        GDMs.flush()
+        del GDMs
+        os.replace(tmp_filepath, os.path.join(store_dir, 'GDMs.npy'))
+    except BaseException:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        raise
+
+    entries = [{'city': city, 'country': country, 'rows': rows} for (city, country), rows in index.items()]
+    atomic_write(os.path.join(store_dir, 'GDMs_index.json'), lambda file: json.dump(entries, file, indent=1), mode='w')
+
+    return index
+
+class GDMStore(Mapping):
+    """
+    Read-only dictionary view of the GDM store, keys are tuples (city, country). The array is memory-mapped,
+      so opening the store reads only the index and each GDM is a zero-copy view of its rows. Joblib passes
+      these views to worker processes by filename and offset instead of pickling their content.
+
+    :attr store_dir: string, directory of the store
+    :attr GDMs: np.memmap with the rows of all cities
+    """
+
+    def __init__(self, store_dir, cities=None):
+        """
+        :param store_dir: string, directory of the store
+        :param cities: list of tuples (city, country) to include, if None all cities in the store
+        """
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'GDMs_index.json')) as file:
+            entries = json.load(file)
+        cities = None if cities is None else set(tuple(key) for key in cities)
+        self._index = {(entry['city'], entry['country']): entry['rows'] for entry in entries
+                       if cities is None or (entry['city'], entry['country']) in cities}
+        self.GDMs = np.load(os.path.join(store_dir, 'GDMs.npy'), mmap_mode='r')
+
+    def __getitem__(self, key):
+        rows = self._index[tuple(key)]
+        if rows is None:
+            return None
+        return self.GDMs[rows[0]:rows[1]]
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+#--------------------------------------------------------------------------------------------
+# Array cache: results (e.g. distance matrices and linkages) keyed by a fingerprint of their inputs
+
+def get_fingerprint(*parts):
+    """
+    Gets a key identifying some inputs: numeric arrays are hashed by content, dtype and shape, and
+      anything else (strings, numbers, tuples...) by its repr
+
+    :param parts: arrays and parameters
+
+    return: string, hexadecimal SHA-1 digest
+    """
+    fingerprint = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            fingerprint.update(repr((part.dtype.str, part.shape)).encode())
+            fingerprint.update(part.data)
+        else:
+            fingerprint.update(repr(part).encode())
+        fingerprint.update(b'|')
+    return fingerprint.hexdigest()
+
+def load_cached_arrays(cache_dir, key):
+    """
+    Reads an entry of the array cache, marking it as recently used
+
+    :param cache_dir: string, directory of the cache
+    :param key: string, fingerprint of the entry
+
+    return: dictionary of arrays, None if the entry is not in the cache
+    """
+    filepath = os.path.join(cache_dir, key + '.npz')
+    try:
+        with np.load(filepath) as arrays:
+            cached = {name: arrays[name] for name in arrays.files}
+    except (FileNotFoundError, OSError, ValueError):
+        return None
+    os.utime(filepath)
+    return cached
+
+def evict_cached_arrays(cache_dir, max_bytes):
+    """
+    Removes the least recently used entries of the array cache until it takes at most max_bytes
+
+    :param cache_dir: string, directory of the cache
+    :param max_bytes: int, size bound of the cache
+    """
+    entries = []
+    for filename in os.listdir(cache_dir):
+        if filename.endswith('.npz'):
+            stat = os.stat(os.path.join(cache_dir, filename))
+            entries.append((stat.st_mtime, stat.st_size, filename))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, filename in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, filename))
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+
+def save_cached_arrays(cache_dir, key, arrays, max_bytes=2**33):
+    """
+    Writes an entry of the array cache (atomically, so concurrent sessions never read half an entry)
+      and evicts the least recently used entries beyond the size bound
+
+    :param cache_dir: string, directory of the cache
+    :param key: string, fingerprint of the entry
+    :param arrays: dictionary of np.arrays
+    :param max_bytes: int, size bound of the cache, entries larger than it are not stored
+    """
+    if sum(np.asarray(array).nbytes for array in arrays.values()) > max_bytes:
+        return
+    atomic_write(os.path.join(cache_dir, key + '.npz'), lambda file: np.savez(file, **arrays))
+    evict_cached_arrays(cache_dir, max_bytes)
+
+#--------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    pass
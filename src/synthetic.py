@@ -0,0 +1,230 @@
+#--------------------------------------------------------------------------------------------
+# GOAL: generate synthetic street-like networks and rasters (offline), e.g. for benchmarks
+#--------------------------------------------------------------------------------------------
+
+import sys
+sys.path.append('../')
+
+import numpy as np
+import networkx as nx
+import rasterio as rio
+from rasterio.transform import from_origin
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import minimum_spanning_tree
+
+from src.vars import ghsl_crs, ghsl_resolution
+
+#--------------------------------------------------------------------------------------------
+
+"""
+ghsl_classes: list of ints
+              values of the GHSL settlement model layer (SMOD), from water (10) to urban centre (30)
+"""
+ghsl_classes = [10, 11, 12, 13, 21, 22, 23, 30]
+
+#--------------------------------------------------------------------------------------------
+# Street-like layouts: node coordinates in meters and undirected edges (pairs of node positions)
+
+def get_perturbed_grid(n_nodes, spacing=100, jitter=0.1, drop=0.1, seed=0):
+    """
+    Gets a square grid whose nodes are moved at random and where some streets are missing
+
+    :param n_nodes: int
+    :param spacing: float, distance (in meters) between neighbouring intersections
+    :param jitter: float, standard deviation of the node displacement, as a fraction of spacing
+    :param drop: float, fraction of streets removed
+    :param seed: int
+
+    return: tuple of np.array of shape (n_nodes, 2) with coordinates and np.array of shape (E, 2) with edges
+    """
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(n_nodes)))
+    rows, cols = np.divmod(np.arange(n_nodes), side)
+    points = spacing*(np.column_stack([cols, rows]) + jitter*rng.normal(size=(n_nodes, 2)))
+
+    #Streets to the right and upwards neighbours that exist:
+    nodes = np.arange(n_nodes)
+    right = nodes[(cols < side-1) & (nodes+1 < n_nodes)]
+    up = nodes[nodes+side < n_nodes]
+    edges = np.concatenate([np.column_stack([right, right+1]), np.column_stack([up, up+side])])
+    edges = edges[rng.random(len(edges)) >= drop]
+
+    return points, edges
+
+def get_random_geometric(n_nodes, spacing=100, mean_degree=3, seed=0):
+    """
+    Gets a random geometric graph: uniform nodes with about one node per spacing^2, joined when closer
+      than the radius giving the mean degree
+
+    :param n_nodes: int
+    :param spacing: float, typical distance (in meters) between neighbouring nodes
+    :param mean_degree: float
+    :param seed: int
+
+    return: tuple of np.array of shape (n_nodes, 2) with coordinates and np.array of shape (E, 2) with edges
+    """
+    rng = np.random.default_rng(seed)
+    points = spacing*np.sqrt(n_nodes)*rng.random((n_nodes, 2))
+    radius = spacing*np.sqrt(mean_degree/np.pi)
+    edges = cKDTree(points).query_pairs(radius, output_type='ndarray')
+
+    return points, edges
+
+def get_organic(n_nodes, spacing=100, loop_fraction=0.15, n_neighbors=6, seed=0):
+    """
+    Gets an organic network: a tree joining nearby uniform nodes (minimum spanning tree of their nearest
+      neighbours), plus some of the remaining nearest-neighbour links closing loops
+
+    :param n_nodes: int
+    :param spacing: float, typical distance (in meters) between neighbouring nodes
+    :param loop_fraction: float, fraction of the non-tree nearest-neighbour links added
+    :param n_neighbors: int, nearest neighbours considered for each node
+    :param seed: int
+
+    return: tuple of np.array of shape (n_nodes, 2) with coordinates and np.array of shape (E, 2) with edges
+    """
+    rng = np.random.default_rng(seed)
+    points = spacing*np.sqrt(n_nodes)*rng.random((n_nodes, 2))
+    k = min(n_neighbors, n_nodes-1)
+    distances, neighbours = cKDTree(points).query(points, k=k+1)
+
+    #Nearest-neighbour links, each once:
+    links = np.sort(np.column_stack([np.repeat(np.arange(n_nodes), k), neighbours[:, 1:].ravel()]), axis=1)
+    links, unique = np.unique(links, axis=0, return_index=True)
+    lengths = distances[:, 1:].ravel()[unique]
+
+    tree = minimum_spanning_tree(coo_matrix((lengths, (links[:, 0], links[:, 1])), shape=(n_nodes, n_nodes))).tocoo()
+    tree_edges = np.sort(np.column_stack([tree.row, tree.col]), axis=1)
+    in_tree = np.isin(links[:, 0]*n_nodes + links[:, 1], tree_edges[:, 0]*n_nodes + tree_edges[:, 1])
+    loops = links[~in_tree][rng.random((~in_tree).sum()) < loop_fraction]
+
+    return points, np.concatenate([tree_edges, loops])
+
+def add_split_intersections(points, edges, fraction=0.1, distance=8, seed=0):
+    """
+    Splits some intersections into two nodes a few meters apart (as dual carriageways do in OSM), which
+      street network simplification is expected to merge again
+
+    :param points: np.array of shape (n, 2), coordinates in meters
+    :param edges: np.array of shape (E, 2)
+    :param fraction: float, fraction of nodes split
+    :param distance: float, distance (in meters) between the two nodes of a split intersection
+    :param seed: int
+
+    return: tuple of np.array of coordinates and np.array of edges, with the new nodes at the end
+    """
+    rng = np.random.default_rng(seed)
+    n = len(points)
+    split = np.flatnonzero(rng.random(n) < fraction)
+    twins = n + np.arange(len(split))
+    angles = rng.uniform(0, 2*np.pi, len(split))
+    twin_points = points[split] + distance*np.column_stack([np.cos(angles), np.sin(angles)])
+
+    #One street of each split node (its first one) moves to the twin, and the twin joins the node:
+    edges = np.array(edges, dtype=np.int64)
+    twin_of = np.full(n, -1)
+    twin_of[split] = twins
+    ends = edges.ravel()
+    candidates = np.flatnonzero(twin_of[ends] >= 0)
+    _, first = np.unique(ends[candidates], return_index=True)
+    ends[candidates[first]] = twin_of[ends[candidates[first]]]
+    edges = ends.reshape(-1, 2)
+
+    return np.concatenate([points, twin_points]), np.concatenate([edges, np.column_stack([split, twins])])
+
+"""
+generators: dictionary
+            street-like layouts by name
+"""
+generators = {'grid': get_perturbed_grid,
+              'geometric': get_random_geometric,
+              'organic': get_organic}
+
+#--------------------------------------------------------------------------------------------
+# Conversion to the formats of the pipeline
+
+def to_street_graph(points, edges, origin=(0, 0)):
+    """
+    Builds a street network with the schema of osmnx (unprojected MultiDiGraph with both directions of
+      every street, node attributes x, y and street_count, edge attributes osmid, length and oneway)
+
+    :param points: np.array of shape (n, 2), coordinates in meters
+    :param edges: np.array of shape (E, 2)
+    :param origin: tuple (lon, lat) placed at the coordinates (0, 0)
+
+    return: networkx.MultiDiGraph
+    """
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    edges = np.unique(np.sort(edges[edges[:, 0] != edges[:, 1]], axis=1), axis=0)
+
+    lat = origin[1] + points[:, 1]/111320
+    lon = origin[0] + points[:, 0]/(111320*np.cos(np.radians(origin[1])))
+    degree = np.bincount(edges.ravel(), minlength=len(points))
+    lengths = np.linalg.norm(points[edges[:, 0]] - points[edges[:, 1]], axis=1)
+
+    #osmnx node ids start at 1:
+    graph = nx.MultiDiGraph(crs='epsg:4326')
+    graph.add_nodes_from((i+1, {'x': x, 'y': y, 'street_count': d})
+                         for i, (x, y, d) in enumerate(zip(lon.tolist(), lat.tolist(), degree.tolist())))
+    for direction in [(0, 1), (1, 0)]:
+        graph.add_edges_from((u+1, v+1, 0, {'osmid': osmid, 'length': length, 'oneway': False})
+                             for osmid, ((u, v), length) in enumerate(zip(edges[:, direction].tolist(), lengths.tolist())))
+
+    return graph
+
+def get_street_graph(generator, n_nodes, split_fraction=0.1, origin=(0, 0), seed=0, **kwargs):
+    """
+    Gets a synthetic street network with the schema of osmnx
+
+    :param generator: string, one of the generators (grid, geometric, organic)
+    :param n_nodes: int, number of intersections before splitting some of them
+    :param split_fraction: float, fraction of intersections split in two nodes (see add_split_intersections)
+    :param origin: tuple (lon, lat) of the corner of the network
+    :param seed: int
+    :param kwargs: parameters of the generator
+
+    return: networkx.MultiDiGraph
+    """
+    if generator not in generators:
+        print('Invalid generator. Only valid parameters are ' + ', '.join(generators) + '.')
+        return None
+
+    points, edges = generators[generator](n_nodes, seed=seed, **kwargs)
+    points, edges = add_split_intersections(points, edges, split_fraction, seed=seed)
+
+    return to_street_graph(points, edges, origin)
+
+def get_synthetic_raster(x, y, filepath, crs=ghsl_crs, resolution=ghsl_resolution, nodata=-200, seed=0):
+    """
+    Writes a GeoTIFF with random GHSL classes covering some points, aligned to the resolution as the GHSL grid is
+
+    :param x: np.array, coordinates of the points in crs
+    :param y: np.array, coordinates of the points in crs
+    :param filepath: string, .tif file to write
+    :param crs: crs of the raster
+    :param resolution: tuple, size of a pixel
+    :param nodata: int, value of pixels without data (about 5% of them)
+    :param seed: int
+
+    return: rasterio DatasetReader of the file
+    """
+    rng = np.random.default_rng(seed)
+    left = np.floor(np.min(x)/resolution[0])*resolution[0]
+    top = np.ceil(np.max(y)/resolution[1])*resolution[1]
+    width = int(np.ceil((np.max(x) - left)/resolution[0])) + 1
+    height = int(np.ceil((top - np.min(y))/resolution[1])) + 1
+
+    values = rng.choice(ghsl_classes, size=(height, width)).astype(np.int16)
+    values[rng.random((height, width)) < 0.05] = nodata
+
+    with rio.open(filepath, 'w', driver='GTiff', height=height, width=width, count=1, dtype='int16', crs=crs,
+                  transform=from_origin(left, top, resolution[0], resolution[1]), nodata=nodata) as raster:
+        raster.write(values, 1)
+
+    return rio.open(filepath)
+
+#--------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    pass
@@ -8,21 +8,208 @@ sys.path.append('../')
 
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib import cm
-from collections import Counter
 
 from scipy.spatial.distance import squareform
 from scipy.spatial.distance import pdist
 import scipy.cluster.hierarchy as shc
 
 from src.utils import get_categorical_cmap
-from src.vars import available_metrics
+from src import store
+from src.node_clustering import get_weighted_linkage
+from src.vars import config, available_metrics, matrix_metrics
 
 test=True
 
 #--------------------------------------------------------------------------------------------
 
+def get_micro_clusters(GCM_vectors, n_micro_clusters, batch_size=4096, random_state=0):
+    """
+    Compresses the GCM vectors into micro-clusters with mini-batch k-means
+    
+    :param GCM_vectors: np.array with one vectorized GCM per row
+    :param n_micro_clusters: int, number of k-means clusters
+    :param batch_size: int, number of tiles in each mini-batch
+    :param random_state: int, seed of the k-means initialization and batches
+    
+    return tuple of np.array with the micro-cluster of each tile, np.array with the centroids, and
+           np.array with the number of tiles of each micro-cluster (empty micro-clusters are dropped)
+    """
+    from sklearn.cluster import MiniBatchKMeans
+    
+    kmeans = MiniBatchKMeans(n_clusters=n_micro_clusters, batch_size=batch_size,
+                             random_state=random_state, n_init=3).fit(GCM_vectors)
+    sizes = np.bincount(kmeans.labels_, minlength=n_micro_clusters)
+    
+    #Relabel the micro-clusters that received tiles as 0, ..., m-1:
+    non_empty = np.flatnonzero(sizes)
+    new_label = np.full(n_micro_clusters, -1)
+    new_label[non_empty] = np.arange(len(non_empty))
+    
+    #Centroids are the means of the tiles assigned to them:
+    labels = new_label[kmeans.labels_]
+    centroids = np.zeros((len(non_empty), GCM_vectors.shape[1]))
+    np.add.at(centroids, labels, GCM_vectors)
+    centroids /= sizes[non_empty][:, None]
+    
+    return labels, centroids, sizes[non_empty]
+
+def cut_linkage(linkage, k_values):
+    """
+    Cuts a linkage into k clusters for every k at once (as scipy's cut_tree), replaying its merges a
+      single time and recording the clusters when only k remain
+    
+    :param linkage: linkage matrix in the scipy format, of n observations
+    :param k_values: list of ints between 1 and n, numbers of clusters
+    
+    return np.array of shape (n, len(k_values)), column j has the cluster of each observation (an
+           observation index, not consecutive) when there are k_values[j] clusters
+    """
+    n = len(linkage) + 1
+    k_values = np.asarray(k_values, dtype=np.int64)
+    label_matrix = np.zeros((n, len(k_values)), dtype=np.int64)
+    
+    #Columns recorded after n-k merges, one list per number of merges:
+    columns_after = dict()
+    for column, k in enumerate(k_values):
+        columns_after.setdefault(n - int(k), []).append(column)
+    
+    #Each cluster keeps the array of its observations, and the smaller one is relabelled when merging:
+    labels = np.arange(n)
+    members = {i: np.array([i]) for i in range(n)}
+    for column in columns_after.get(0, []):
+        label_matrix[:, column] = labels
+    for row, (a, b) in enumerate(linkage[:, :2].astype(np.int64)):
+        a_members, b_members = members.pop(a), members.pop(b)
+        if len(a_members) < len(b_members):
+            a_members, b_members = b_members, a_members
+        labels[b_members] = labels[a_members[0]]
+        members[n + row] = np.concatenate([a_members, b_members])
+        for column in columns_after.get(row + 1, []):
+            label_matrix[:, column] = labels
+    
+    return label_matrix
+
+def get_compact_labels(label_matrix, by_size=True):
+    """
+    Relabels the clusters of every column of a label matrix as 0, ..., k-1. If by_size, labels increase
+      as cluster sizes decrease, i.e. 0 is the largest cluster, 1 is the second largest, etc., with ties
+      going to the cluster appearing first. Otherwise clusters are labelled by first appearance.
+    
+    :param label_matrix: np.array of ints and shape (n, K), one clustering per column
+    :param by_size: Boolean, whether labels follow cluster sizes
+    
+    return np.array of shape (n, K) with the new labels
+    """
+    label_matrix = np.asarray(label_matrix, dtype=np.int64)
+    n, K = label_matrix.shape
+    
+    #Make labels of different columns distinct, column by column:
+    span = label_matrix.max() - label_matrix.min() + 1 if n else 1
+    keys = (label_matrix - label_matrix.min() + span*np.arange(K)).T.ravel()
+    unique_keys, first, inverse, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+    key_column = unique_keys//span
+    
+    #Rank the clusters of each column by size, then by first appearance:
+    if by_size:
+        order = np.lexsort((first, -counts, key_column))
+    else:
+        order = np.lexsort((first, key_column))
+    rank = np.empty(len(unique_keys), dtype=np.int64)
+    rank[order] = np.arange(len(unique_keys))
+    column_start = np.searchsorted(key_column[order], np.arange(K))
+    
+    new_labels = rank[inverse.reshape(-1)] - column_start[key_column[inverse.reshape(-1)]]
+    return new_labels.reshape(K, n).T
+
+#--------------------------------------------------------------------------------------------
+# Distances between GCMs as matrices (vectorized=False), computed on a stacked (n, 11, 11) array
+
+def get_matrix_functions(GCMs, func, eps=1e-6, block_size=2**16):
+    """
+    Applies a function to the eigenvalues of symmetric matrices: V diag(func(eigenvalues)) V^T, one block
+      of matrices at a time. Eigenvalues are clipped below at eps, since correlation matrices can be singular.
+    
+    :param GCMs: np.array of shape (n, m, m), symmetric matrices
+    :param func: function applied elementwise to the eigenvalues, e.g. np.log
+    :param eps: float, smallest eigenvalue
+    :param block_size: int, number of matrices decomposed at once
+    
+    return np.array of shape (n, m, m)
+    """
+    out = np.zeros(GCMs.shape)
+    for start in range(0, len(GCMs), block_size):
+        eigenvalues, eigenvectors = np.linalg.eigh(GCMs[start:start+block_size])
+        values = func(np.maximum(eigenvalues, eps))
+        out[start:start+block_size] = (eigenvectors*values[:, None, :]) @ np.swapaxes(eigenvectors, 1, 2)
+    return out
+
+def get_geodesic_pdist(GCMs, eps=1e-6, chunk_size=2**16):
+    """
+    Gets the condensed matrix of affine-invariant (geodesic) distances between positive definite matrices,
+      ||log(A^(-1/2) B A^(-1/2))||_F, i.e. the root of the sum of the squared logarithms of the eigenvalues
+      of A^(-1/2) B A^(-1/2). Pairs are computed one block of rows at a time.
+    
+    :param GCMs: np.array of shape (n, m, m), symmetric matrices
+    :param eps: float, smallest eigenvalue
+    :param chunk_size: int, approximate number of pairs computed at once
+    
+    return condensed distance matrix
+    """
+    n = len(GCMs)
+    inverse_sqrt = get_matrix_functions(GCMs, lambda values: 1/np.sqrt(values), eps)
+    D_cond = np.zeros(n*(n-1)//2)
+    
+    #Blocks of consecutive rows of the condensed matrix with about chunk_size pairs each:
+    offsets = np.concatenate([[0], np.cumsum(np.arange(n-1, 0, -1))]).astype(np.int64)
+    boundaries = np.unique(np.searchsorted(offsets, np.arange(0, offsets[-1], chunk_size), side='right') - 1)
+    boundaries = np.append(boundaries, max(n-1, 0))
+    
+    for start, stop in zip(boundaries[:-1], boundaries[1:]):
+        rows = np.arange(start, stop)
+        counts = n - rows - 1
+        i = np.repeat(rows, counts)
+        j = np.arange(offsets[start], offsets[stop]) - np.repeat(offsets[rows], counts) + i + 1
+        eigenvalues = np.linalg.eigvalsh(inverse_sqrt[i] @ GCMs[j] @ inverse_sqrt[i])
+        D_cond[offsets[start]:offsets[stop]] = np.sqrt(np.sum(np.log(np.maximum(eigenvalues, eps))**2, axis=1))
+    
+    return D_cond
+
+def get_matrix_pdist(GCMs, metric, eps=1e-6):
+    """
+    Gets the condensed distance matrix between GCMs for one of the matrix_metrics:
+        - 'gcd': Graphlet Correlation Distance, Euclidean distance between the upper triangles
+        - 'frobenius': Frobenius norm of the difference
+        - 'log_euclidean': Frobenius norm of the difference of the matrix logarithms
+        - 'geodesic': affine-invariant distance between the matrices as positive definite matrices
+    
+    :param GCMs: np.array of shape (n, m, m)
+    :param metric: string, one of the above
+    :param eps: float, smallest eigenvalue for the logarithmic metrics (correlation matrices can be singular)
+    
+    return condensed distance matrix
+    """
+    GCMs = np.asarray(GCMs, dtype=np.float64)
+    n, m, _ = GCMs.shape
+    
+    if metric == 'gcd':
+        i, j = np.triu_indices(m, k=1)
+        return pdist(GCMs[:, i, j], metric='euclidean')
+    elif metric == 'frobenius':
+        return pdist(GCMs.reshape(n, m*m), metric='euclidean')
+    elif metric == 'log_euclidean':
+        #The Frobenius norm of symmetric matrices is the Euclidean norm of diagonal and sqrt(2) times upper triangle:
+        log_GCMs = get_matrix_functions(GCMs, np.log, eps)
+        i, j = np.triu_indices(m)
+        weights = np.where(i == j, 1, np.sqrt(2))
+        return pdist(log_GCMs[:, i, j]*weights, metric='euclidean')
+    elif metric == 'geodesic':
+        return get_geodesic_pdist(GCMs, eps)
+    else:
+        print('Invalid metric. Only valid parameters are gcd, frobenius, log_euclidean, and geodesic.')
+        return None
+
+#--------------------------------------------------------------------------------------------
+
 class HierClustering:
     """
     :attr data: GeoDataFrame
@@ -31,9 +218,14 @@ class HierClustering:
     :attr dmatrix_cond: condensed matrix, distance between GCMs
     :attr linkage: array, linkage from scipy.hierarchy
     :attr gdf_with_clusters: dict, keys are ints representing flat cluster assignments
+    :attr micro_labels: None or np.array, micro-cluster of each valid tile (leaves of the linkage are micro-clusters)
+    :attr micro_sizes: None or np.array, number of tiles of each micro-cluster
+    :attr label_matrix: None or np.array of shape (valid tiles, number of k), flat clusters of every k
+    :attr label_k: None or np.array, number of clusters of each column of label_matrix
     """
     
-    def __init__(self, full_gdf, method='ward', metric='euclidean', optimal_ordering=False, vectorized=True):
+    def __init__(self, full_gdf, method='ward', metric='euclidean', optimal_ordering=False, vectorized=True,
+                 n_micro_clusters=None, random_state=0, cache=False, cache_dir=None, max_cache_bytes=2**33):
         """
         :param full_gdf: GeoDataFrame of tiles containing classification, GCM, and valid_GCM columns
         :param method: string, clustering algorithm to use, for example:
@@ -41,28 +233,140 @@ class HierClustering:
             - 'single'
             - 'average'
             - 'complete'
-        :param metric: string or callable, metric to impose in the space of GCMs
+        :param metric: string or callable, metric to impose in the space of GCMs. With vectorized=False, the
+                       matrix_metrics (gcd, frobenius, log_euclidean, geodesic) are computed natively, and a
+                       callable receives two 11x11 GCMs
         :param vectorized: Boolean, if True treat GCMs as 55-dimensional vectors
         :param optimal_ordering: Boolean, see scipy documentation
+        :param n_micro_clusters: None or int, if given the (vectorized) GCMs are first compressed into this many
+                                 micro-clusters with mini-batch k-means and the hierarchy is built on their
+                                 centroids, weighted by their number of tiles. Each tile then takes the flat
+                                 cluster of its micro-cluster. Meant for many tiles, the distance matrix is
+                                 quadratic in the number of micro-clusters only
+        :param random_state: int, seed of the micro-clustering
+        :param cache: Boolean (default False), whether distance matrices (keyed by the GCMs and metric) and linkages
+                      (keyed also by the method) are reused from and saved to the disk cache. A condensed matrix
+                      takes 4*n*(n-1) bytes for n tiles (about 4 GB for 30000 tiles), so the cache can grow up to
+                      max_cache_bytes. Callable metrics are not cached
+        :param cache_dir: string, directory of the cache, default is in the test-run or results folder
+        :param max_cache_bytes: int, size of the cache (default 8 GiB), least recently used entries are removed
+                                beyond it
         """
         
         #Initialize parameters
         self.data = full_gdf
         self.method = method
         self.metric = metric
-        
-        #If vectorized metrics are used, we need the condensed distance matric of the array of 55-dimensional GCM vectors:
+        self.micro_labels = None
+        self.micro_sizes = None
+        
+        #Two-stage clustering is only available for vectorized GCMs and reducible methods:
+        if n_micro_clusters is not None and not vectorized:
+            print('Micro-clusters are only available for vectorized GCMs, using the full hierarchy.')
+            n_micro_clusters = None
+        if n_micro_clusters is not None and method not in ['ward', 'single', 'complete', 'average', 'weighted']:
+            print('Invalid method for micro-clusters. Only valid parameters are ward, single, complete, average, and weighted.')
+            n_micro_clusters = None
+        if n_micro_clusters is not None and n_micro_clusters >= self.data['valid_GCM'].sum():
+            n_micro_clusters = None
+        
+        #If vectorized metrics are used, we need the array of 55-dimensional GCM vectors:
         if vectorized:
-            self.dmatrix_cond = pdist(self.get_GCM_vectorized(), metric=metric)
-        #If we are not vectorizing the matrices, we need to pass the metric to compute the pairwise dist. matrix (see scipy):    
+            GCM_arr = self.get_GCM_vectorized()
+        #If we are not vectorizing the matrices, we need the stacked 11x11 GCMs:    
         else:
-            self.dmatrix_cond = pdist(self.data['GCM'].dropna().values, metric=metric)
-            
+            GCM_arr = self.get_GCM_stacked()
+        
+        #Cache keys: distances depend on the GCMs and metric (and micro-clusters), linkages also on the method:
+        cache = cache and not callable(metric)
+        if cache:
+            if cache_dir is None:
+                cache_dir = config.get_path('test-run/cache' if test else 'd3_results/cache')
+            data_key = store.get_fingerprint(GCM_arr, vectorized, metric,
+                                             n_micro_clusters, random_state)
+            linkage_key = store.get_fingerprint(data_key, method, optimal_ordering)
+        
+        #Distance matrix (and micro-clusters):
+        cached = store.load_cached_arrays(cache_dir, data_key) if cache else None
+        if cached is not None:
+            self.dmatrix_cond = cached['dmatrix_cond']
+            self.micro_labels = cached.get('micro_labels')
+            self.micro_sizes = cached.get('micro_sizes')
+        else:
+            #Micro-clusters first, then the distances between their centroids:
+            if n_micro_clusters is not None:
+                self.get_micro_distances(GCM_arr, n_micro_clusters, random_state)
+            elif vectorized:
+                self.dmatrix_cond = pdist(GCM_arr, metric=metric)
+            #Matrix metrics are computed natively, other metrics (see scipy) receive the flattened matrices:
+            elif metric in matrix_metrics:
+                self.dmatrix_cond = get_matrix_pdist(GCM_arr, metric)
+            elif callable(metric):
+                n_orbits = GCM_arr.shape[1]
+                self.dmatrix_cond = pdist(GCM_arr.reshape(len(GCM_arr), -1),
+                                          metric=lambda u, v: metric(u.reshape(n_orbits, n_orbits), v.reshape(n_orbits, n_orbits)))
+            else:
+                self.dmatrix_cond = pdist(GCM_arr.reshape(len(GCM_arr), -1), metric=metric)
+            if cache:
+                arrays = {'dmatrix_cond': self.dmatrix_cond}
+                if self.micro_labels is not None:
+                    arrays.update(micro_labels=self.micro_labels, micro_sizes=self.micro_sizes)
+                store.save_cached_arrays(cache_dir, data_key, arrays, max_cache_bytes)
+        
         #Use the condensed distance matrix to obtain the linkage:
-        self.linkage = shc.linkage(self.dmatrix_cond, method=method, metric=None, optimal_ordering=optimal_ordering)
+        cached = store.load_cached_arrays(cache_dir, linkage_key) if cache else None
+        if cached is not None:
+            self.linkage = cached['linkage']
+        else:
+            if self.micro_labels is not None:
+                self.get_micro_linkage(optimal_ordering)
+            else:
+                self.linkage = shc.linkage(self.dmatrix_cond, method=method, metric=None, optimal_ordering=optimal_ordering)
+            if cache:
+                store.save_cached_arrays(cache_dir, linkage_key, {'linkage': self.linkage}, max_cache_bytes)
         
         #Dictionary where full gdfs for cluster assignments will be stored, keys are the number of clusters:
         self.gdf_with_clusters_dict = dict()
+        self.label_matrix = None
+        self.label_k = None
+        
+    def get_micro_distances(self, GCM_vectors, n_micro_clusters, random_state=0):
+        """
+        Sets the micro-clusters of the tiles and the condensed distance matrix between their centroids
+        
+        :param GCM_vectors: np.array with one vectorized GCM per valid tile
+        :param n_micro_clusters: int, number of k-means clusters
+        :param random_state: int, seed of the micro-clustering
+        """
+        self.micro_labels, centroids, self.micro_sizes = get_micro_clusters(GCM_vectors, n_micro_clusters,
+                                                                            random_state=random_state)
+        self.dmatrix_cond = pdist(centroids, metric=self.metric)
+        
+    def get_micro_linkage(self, optimal_ordering=False):
+        """
+        Sets the linkage between the micro-clusters (leaves are micro-clusters). For ward, the distance between
+          two micro-clusters is their ward merging cost, so the linkage is that of the tiles once each
+          micro-cluster is merged. For the other methods each micro-cluster stands for its tiles at its centroid.
+        
+        :param optimal_ordering: Boolean, see scipy documentation
+        """
+        n_micro_clusters = len(self.micro_sizes)
+        D_cond = self.dmatrix_cond
+        if self.method == 'ward':
+            i, j = np.triu_indices(n_micro_clusters, k=1)
+            sizes_i, sizes_j = self.micro_sizes[i], self.micro_sizes[j]
+            D_cond = D_cond*np.sqrt(2*sizes_i*sizes_j/(sizes_i + sizes_j))
+            
+        self.linkage = get_weighted_linkage(D_cond, self.micro_sizes, self.method)
+        
+        #Scipy expects the number of leaves (micro-clusters) of each cluster, not of tiles:
+        n_leaves = np.ones(2*n_micro_clusters - 1)
+        for row, (a, b, _, _) in enumerate(self.linkage):
+            n_leaves[n_micro_clusters + row] = n_leaves[int(a)] + n_leaves[int(b)]
+        self.linkage[:, 3] = n_leaves[n_micro_clusters:]
+        
+        if optimal_ordering:
+            self.linkage = shc.optimal_leaf_ordering(self.linkage, D_cond)
         
     def get_GCM_vectorized(self, n_orbits=11):
         """
@@ -76,6 +380,19 @@ class HierClustering:
 
         return GCM_full_vectors
     
+    def get_GCM_stacked(self):
+        """
+        Gets the GCMs of the valid tiles as one array
+        
+        return array of shape (n observations, n_orbits, n_orbits)
+        """
+        
+        valid_GCMs = self.data['GCM'][self.data['valid_GCM'].to_numpy(dtype=bool)]
+        if len(valid_GCMs) == 0:
+            return np.zeros((0, 11, 11))
+        
+        return np.stack(valid_GCMs.values).astype(np.float64)
+    
     def save_gdf_with_clusters(self, gdf_file, file_id='', test=test):
         """
         Saves the gdf with clusters
@@ -89,9 +406,9 @@ class HierClustering:
         
         #Find the full filepath:
         if test:
-            filepath = '../data/test-run/' + filename + '.pickle'
+            filepath = config.get_path('test-run/' + filename + '.pickle')
         else:
-            filepath = '../data/d3_results/' + filename + '.pickle'
+            filepath = config.get_path('d3_results/' + filename + '.pickle')
                 
         with open(filepath, 'wb') as file:
             pkl.dump(gdf_file, file)
@@ -113,15 +430,13 @@ class HierClustering:
     def relabel_clusters(self, cluster_arr):
         """
         Relabels clsuters so that cluster labels decrease according to cluster sizes
-         i.e. 0 is the largest cluster, 1 is the second largest, etc.
+         i.e. 1 is the largest cluster, 2 is the second largest, etc. (labels start at 1, as in scipy's fcluster)
          
         :param cluster_arr: np.array of cluster assignments
         
         return re-ordered cluster assignment
         """
-        counts = Counter(cluster_arr)
-        
-        ordered_cluster_arr = cluster_arr
+        ordered_cluster_arr = get_compact_labels(np.asarray(cluster_arr)[:, None])[:, 0] + 1
         
         return ordered_cluster_arr
     
@@ -140,6 +455,9 @@ class HierClustering:
         
         #Use scipy to get the flat clusters, and then add the column to the data GDF
         flat_cluster_arr = shc.fcluster(self.linkage, t=threshold, criterion=method)
+        #With micro-clusters, the flat clusters are those of the micro-cluster of each tile:
+        if self.micro_labels is not None:
+            flat_cluster_arr = flat_cluster_arr[self.micro_labels]
         if ordered:
             flat_cluster_arr = self.relabel_clusters(flat_cluster_arr)
         
@@ -155,6 +473,54 @@ class HierClustering:
         
         return flat_cluster_arr
     
+    def get_all_flat_clusters(self, k_values=range(2, 51), ordered=True):
+        """
+        Gets the flat cluster assignments for many numbers of clusters at once, cutting the linkage in a single
+          pass. Only the labels of valid tiles are kept, geometries are joined when plotting or exporting.
+        
+        :param k_values: list of ints, numbers of clusters
+        :param ordered: Boolean, if True then cluster labels decrease according to cluster sizes
+        
+        return: np.array of shape (valid tiles, len(k_values)), int16 (int32 if needed) labels of each k, from 1
+                to k as in get_flat_clusters
+        """
+        n_leaves = len(self.linkage) + 1
+        k_values = np.array([k for k in k_values if 1 <= k <= n_leaves], dtype=np.int64)
+        label_matrix = cut_linkage(self.linkage, k_values)
+        
+        #With micro-clusters, the flat clusters are those of the micro-cluster of each tile:
+        if self.micro_labels is not None:
+            label_matrix = label_matrix[self.micro_labels]
+        label_matrix = get_compact_labels(label_matrix, by_size=ordered) + 1
+        
+        dtype = np.int16 if label_matrix.max(initial=0) < np.iinfo(np.int16).max else np.int32
+        self.label_matrix = label_matrix.astype(dtype)
+        self.label_k = k_values
+        
+        return self.label_matrix
+    
+    def get_gdf_with_clusters(self, n_clusters):
+        """
+        Gets the GeoDataFrame with the 'cluster' column for a number of clusters in the label matrix
+        
+        :param n_clusters: int, one of label_k
+        
+        return: GeoDataFrame
+        """
+        column = int(np.flatnonzero(self.label_k == n_clusters)[0])
+        return self.add_cluster_column(self.label_matrix[:, column])
+    
+    def save_all_flat_clusters(self, file_id='all', test=test):
+        """
+        Saves the label matrix (without geometries) with the index of the valid tiles and the numbers of clusters
+        
+        :param file_id: string, identification for the filename
+        :param test: Boolean, wehther this is the test run
+        """
+        valid_index = self.data.index[self.data['valid_GCM'].to_numpy(dtype=bool)]
+        labels_dict = {'k': self.label_k, 'labels': self.label_matrix, 'index': valid_index}
+        self.save_gdf_with_clusters(labels_dict, file_id='labels_' + file_id, test=test)
+    
     def plot_dendrogram(self, order='descending',
                         set_colors=False, color_threshold=0,
                         truncate_mode='level', p=7,
@@ -172,6 +538,8 @@ class HierClustering:
         
         return ax, if return_dend return ax, dendrogram_dict
         """
+        import matplotlib.pyplot as plt
+        
         #If no ax was given, get one:
         if ax is None:
             fig, ax = plt.subplots(figsize=(20,15))
@@ -217,12 +585,15 @@ class HierClustering:
             #Locate the gdf with the assignment if possible:
             if n_clusters in self.gdf_with_clusters_dict.keys():
                 gdf_with_clusters = self.gdf_with_clusters_dict[n_clusters]
+            elif self.label_k is not None and n_clusters in self.label_k:
+                gdf_with_clusters = self.get_gdf_with_clusters(n_clusters)
             else:
-                gdf_with_clusters = self.get_flat_clusters(n_clusters)
+                self.get_flat_clusters(n_clusters)
+                gdf_with_clusters = self.gdf_with_clusters_dict[n_clusters]
                 
         #If we used another criterion, we need to compute the assignment
         else:
-            gdf_with_clusters = self.get_flat_clusters(n_clusters, method)
+            gdf_with_clusters = self.add_cluster_column(self.get_flat_clusters(n_clusters, method))
 
         #Truncate the gdf for the city portion:
         city_gdf_with_clusters = gdf_with_clusters[gdf_with_clusters['city'] == city]
@@ -232,6 +603,7 @@ class HierClustering:
         
         #Get axis if not passed:
         if ax is None:
+            import matplotlib.pyplot as plt
             fig, ax = plt.subplots(figsize=(20,20))
         
         #Plotting routine using the colors provided:
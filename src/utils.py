@@ -8,8 +8,6 @@ sys.path.append('../')
 import pickle as pkl
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib import cm
 
 def load_file(filepath, ext=None):
     
@@ -34,7 +32,12 @@ def save_file(file, filepath):
         pkl.dump(file, f)
     return file
 
-def get_categorical_cmap(df, col, null_value=pd.NA, cmap=cm.tab10):
+def get_categorical_cmap(df, col, null_value=pd.NA, cmap=None):
+    
+    #matplotlib is only imported for plots, not when loading files:
+    if cmap is None:
+        from matplotlib import cm
+        cmap = cm.tab10
 
     keys = list(df[col].unique())
     color_range = list(np.linspace(0, 1, len(keys), endpoint=False))
@@ -19,25 +19,97 @@ test_cities =  [('The Hague', 'Netherlands'),
                 ('Budapest', 'Hungary'),
                 ('Nairobi', 'Kenya')]
 
+import os
+
+class Config:
+    """
+    Paths to the data of the project, relative to a root directory. The GHSL raster is only opened when it is
+      first used (and then kept open), so importing the project neither needs the data nor a given working
+      directory, and each worker process opens its own reader if it needs one.
+    
+    The root is the environment variable URBAN_GRAPHLETS_DATA if set, '../data' otherwise (the notebooks and
+      scripts directories), and can be changed with set_root.
+    
+    :attr root: string, data directory
+    """
+    
+    ghsl_filename = 'd1_raw/raster-tiles/GHS_SMOD_POP2015_GLOBE_R2019A_54009_1K_V2_0.tif'
+    urbancentre_filename = 'd1_raw/urban-centre-database/GHS_STAT_UCDB2015MT_GLOBE_R2019A_V1_2.gpkg'
+    cities_filename = 'd1_raw/list_of_cities.csv'
+    
+    def __init__(self, root=None):
+        """
+        :param root: string, data directory, default is URBAN_GRAPHLETS_DATA or '../data'
+        """
+        self._ghsl_data = None
+        self.set_root(root if root is not None else os.environ.get('URBAN_GRAPHLETS_DATA', '../data'))
+    
+    def set_root(self, root):
+        """
+        Changes the data directory, closing the GHSL raster if it was open
+        
+        :param root: string
+        """
+        self.root = root
+        if self._ghsl_data is not None:
+            self._ghsl_data.close()
+            self._ghsl_data = None
+    
+    def get_path(self, relative_path):
+        """
+        return: string, path of a file of the data directory
+        """
+        return os.path.join(self.root, relative_path)
+    
+    @property
+    def ghsl_filepath(self):
+        return self.get_path(self.ghsl_filename)
+    
+    @property
+    def urbancentre_filepath(self):
+        return self.get_path(self.urbancentre_filename)
+    
+    @property
+    def cities_filepath(self):
+        return self.get_path(self.cities_filename)
+    
+    @property
+    def ghsl_data(self):
+        """
+        return: rasterio DatasetReader of the GHSL raster, opened on first use
+        """
+        if self._ghsl_data is None or self._ghsl_data.closed:
+            import rasterio
+            self._ghsl_data = rasterio.open(self.ghsl_filepath)
+        return self._ghsl_data
+
 """
-ghsl_data: raster reader
-           GHSL data, whose first band contains the information of interest
-ghsl_crs: crs
-          projection of the GHSL data (Mollweide), which will standardize projections across the scripts
+config: Config
+        data directory and lazily opened GHSL raster (config.ghsl_data) of this process
 """
-import rasterio
-ghsl_data = rasterio.open('../data/d1_raw/raster-tiles/GHS_SMOD_POP2015_GLOBE_R2019A_54009_1K_V2_0.tif')
-ghsl_crs = ghsl_data.crs
+config = Config()
 
 """
-urbancentre_filepath: GHSL data on urban centres
+ghsl_data: raster reader
+           GHSL data, whose first band contains the information of interest. Opened from config on first access
+           of vars.ghsl_data (see __getattr__), or use config.ghsl_data
+ghsl_crs: crs
+          projection of the GHSL data (Mollweide), which will standardize projections across the scripts
 """
-urbancentre_filepath = '../data/d1_raw/urban-centre-database/GHS_STAT_UCDB2015MT_GLOBE_R2019A_V1_2.gpkg'
+ghsl_crs = 'ESRI:54009'
 
 """
-cities_filepath: manual list of cities; countries; continents
-"""
-cities_filepath = '../data/d1_raw/list_of_cities.csv'
+urbancentre_filepath: string
+                      GHSL data on urban centres, in the data directory of config (see __getattr__)
+cities_filepath: string
+                 manual list of cities; countries; continents, in the data directory of config (see __getattr__)
+"""
+def __getattr__(name):
+    #Module attributes only resolved when accessed, so that importing vars does not open the raster and paths
+    # follow config.set_root:
+    if name in ['ghsl_data', 'urbancentre_filepath', 'cities_filepath']:
+        return getattr(config, name)
+    raise AttributeError("module " + __name__ + " has no attribute " + name)
 
 
 """
@@ -65,4 +137,10 @@ available_metrics: list of strings
 """
 available_metrics = ['braycurtis', 'canberra', 'chebyshev', 'cityblock', 'correlation', 'cosine', 'dice', 'euclidean',
                      'hamming', 'jaccard', 'jensenshannon', 'kulsinski', 'mahalanobis', 'matching', 'minkowski', 'rogerstanimoto',
-                     'russellrao', 'seuclidean', 'sokalmichener', 'sokalsneath', 'sqeuclidean', 'yule']
\ No newline at end of file
+                     'russellrao', 'seuclidean', 'sokalmichener', 'sokalsneath', 'sqeuclidean', 'yule']
+
+"""
+matrix_metrics: list of strings
+                metrics between whole GCMs (not vectorized), computed natively by tile_clustering.get_matrix_pdist
+"""
+matrix_metrics = ['gcd', 'frobenius', 'log_euclidean', 'geodesic']
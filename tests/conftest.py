@@ -0,0 +1,8 @@
+#--------------------------------------------------------------------------------------------
+# GOAL: make the src package importable when pytest runs from the repository root or from tests
+#--------------------------------------------------------------------------------------------
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
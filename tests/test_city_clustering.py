@@ -0,0 +1,51 @@
+#--------------------------------------------------------------------------------------------
+# GOAL: check the incremental city GCD matrix against the full computation
+#--------------------------------------------------------------------------------------------
+
+import numpy as np
+import pytest
+from scipy.spatial.distance import cdist, pdist
+
+from src import city_clustering
+
+#--------------------------------------------------------------------------------------------
+
+def get_test_GDMs(n_cities, seed=0):
+    """
+    return: dictionary of random GDMs, keys are tuples (city, country)
+    """
+    rng = np.random.default_rng(seed)
+    return {('City ' + str(i), 'Country'): rng.integers(0, 20, (rng.integers(30, 150), 15)) for i in range(n_cities)}
+
+@pytest.mark.parametrize('n_previous, n_new', [(0, 5), (1, 1), (2, 0), (7, 3), (50, 1), (30, 40)])
+def test_splice_condensed_matches_pdist(n_previous, n_new):
+    X = np.random.default_rng(0).random((n_previous + n_new, 4))
+    D_cond = city_clustering.splice_condensed(pdist(X[:n_previous]), n_previous, cdist(X[n_previous:], X))
+    assert np.allclose(D_cond, pdist(X))
+
+def test_incremental_GCD_matches_full():
+    GDMs_dict = get_test_GDMs(12)
+    full = city_clustering.get_city_GCD(GDMs_dict, num_cores=1)
+    previous = city_clustering.get_city_GCD({key: GDMs_dict[key] for key in list(GDMs_dict)[:5]}, num_cores=1)
+    incremental = city_clustering.get_city_GCD(GDMs_dict, previous=previous, num_cores=1)
+    assert incremental['keys'] == full['keys']
+    assert np.allclose(incremental['D_cond'], full['D_cond'])
+    i, j = np.triu_indices(11, k=1)
+    assert np.allclose(full['D_cond'], pdist(full['GCMs'][:, i, j]))
+
+def test_invalid_cities_are_skipped_in_updates(monkeypatch):
+    GDMs_dict = get_test_GDMs(4)
+    GDMs_dict[('Empty', 'Country')] = None
+    GDMs_dict[('Constant', 'Country')] = np.ones((10, 15), dtype=np.int64)
+    previous = city_clustering.get_city_GCD(GDMs_dict, num_cores=1)
+    assert previous['invalid_keys'] == [('Empty', 'Country'), ('Constant', 'Country')]
+
+    GDMs_dict.update({('New ' + city, country): GDM for (city, country), GDM in get_test_GDMs(2, seed=1).items()})
+    computed = []
+    get_city_GCMs = city_clustering.get_city_GCMs
+    monkeypatch.setattr(city_clustering, 'get_city_GCMs',
+                        lambda GDMs, num_cores: computed.append(len(GDMs)) or get_city_GCMs(GDMs, num_cores))
+    updated = city_clustering.get_city_GCD(GDMs_dict, previous=previous, num_cores=1)
+    assert computed == [2]
+    assert updated['invalid_keys'] == previous['invalid_keys']
+    assert np.allclose(updated['D_cond'], city_clustering.get_city_GCD(GDMs_dict, num_cores=1)['D_cond'])
@@ -0,0 +1,76 @@
+#--------------------------------------------------------------------------------------------
+# GOAL: check the fast orbit counts against the original text binding of orca
+#--------------------------------------------------------------------------------------------
+
+import networkx as nx
+import numpy as np
+import pytest
+
+#The orca extension is built in place (see src/orcalib/README.md):
+pytest.importorskip('src.orcalib.orcastr')
+
+from src.get_GDM import get_GDM
+from src.csr_graph import CSRGraph
+
+#--------------------------------------------------------------------------------------------
+
+def get_test_graph(n_nodes=80, n_edges=160, seed=0):
+    """
+    return: networkx Graph with non-consecutive labels and x, y attributes (as a street network)
+    """
+    graph = nx.gnm_random_graph(n_nodes, n_edges, seed=seed)
+    graph = nx.relabel_nodes(graph, {node: 1000 + 7*node for node in graph})
+    rng = np.random.default_rng(seed)
+    for node in graph:
+        graph.nodes[node]['x'], graph.nodes[node]['y'] = rng.random(2)
+    return graph
+
+@pytest.mark.parametrize('graphlets_up_to', [4, 5])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_array_binding_matches_str(graphlets_up_to, seed):
+    graph = get_test_graph(seed=seed)
+    GDM = get_GDM(graph, graphlets_up_to, method='array')
+    assert GDM.dtype == np.int64
+    assert np.array_equal(GDM, get_GDM(graph, graphlets_up_to, method='str'))
+
+def test_array_binding_of_csr_graph():
+    graph = get_test_graph()
+    assert np.array_equal(get_GDM(CSRGraph.from_networkx(graph), method='array'), get_GDM(graph, method='str'))
+
+def test_array_binding_drops_self_loops_and_parallel_edges():
+    graph = get_test_graph()
+    multigraph = nx.MultiGraph(graph)
+    multigraph.add_edges_from(list(graph.edges)[:10])
+    multigraph.add_edge(1000, 1000)
+    assert np.array_equal(get_GDM(multigraph, method='array'), get_GDM(graph, method='str'))
+
+def test_thread_pool_matches_sequential_counts():
+    from src.get_GDM import get_GDMs
+
+    graphs_dict = {('City ' + str(seed), 'Country'): get_test_graph(n_nodes=60 + 20*seed, seed=seed) for seed in range(8)}
+    graphs_dict[('Empty', 'Country')] = None
+    sequential = get_GDMs(graphs_dict, save=False, n_threads=1)
+    threaded = get_GDMs(graphs_dict, save=False, n_threads=4)
+    assert list(threaded.keys()) == list(graphs_dict.keys())
+    assert threaded[('Empty', 'Country')] is None
+    for key, GDM in sequential.items():
+        if GDM is not None:
+            assert np.array_equal(threaded[key], GDM)
+            assert np.array_equal(GDM, get_GDM(graphs_dict[key], method='str'))
+
+@pytest.mark.parametrize('graphlets_up_to', [4, 5])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_update_matches_recount(graphlets_up_to, seed):
+    from src.get_GDM import update_GDM
+
+    graph = get_test_graph(n_nodes=150, n_edges=250, seed=seed)
+    GDM = get_GDM(graph, graphlets_up_to)
+    rng = np.random.default_rng(seed)
+    edges = list(graph.edges)
+    removed_edges = [edges[i] for i in rng.choice(len(edges), 5, replace=False)]
+    nodes = list(graph.nodes)
+    added_edges = [tuple(rng.choice(nodes, 2, replace=False)) for _ in range(4)] + [(nodes[0], 5000), (5000, 5001)]
+
+    new_graph, new_GDM = update_GDM(graph, GDM, added_edges, removed_edges, graphlets_up_to)
+    assert np.array_equal(new_GDM, get_GDM(new_graph, graphlets_up_to, method='str'))
+    assert np.array_equal(GDM, get_GDM(graph, graphlets_up_to))
@@ -0,0 +1,59 @@
+#--------------------------------------------------------------------------------------------
+# GOAL: check the node linkages without the full distance matrix against scipy on the full matrix
+#--------------------------------------------------------------------------------------------
+
+import numpy as np
+import pytest
+from scipy.cluster.hierarchy import cophenet, is_valid_linkage, linkage
+
+from src import node_clustering
+
+#--------------------------------------------------------------------------------------------
+
+def get_test_GDM(n_nodes=120, seed=0):
+    """
+    return: np.array of random orbit counts, distinct rows
+    """
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 60, (n_nodes, 15))
+
+@pytest.mark.parametrize('cluster_method', ['single', 'average'])
+def test_approximate_linkage_on_complete_graph_matches_scipy(cluster_method):
+    GDM = get_test_GDM()
+    D_cond = node_clustering.get_D_matrix(GDM)
+    Z, = node_clustering.get_approximate_linkages(GDM, [cluster_method], n_neighbors=len(GDM)-1)
+    assert is_valid_linkage(Z)
+    assert np.allclose(cophenet(Z), cophenet(linkage(D_cond, method=cluster_method)))
+
+def test_approximate_linkage_joins_disconnected_components():
+    #Three groups far apart, so the 3-nearest neighbour graph has (at least) three components:
+    rng = np.random.default_rng(0)
+    GDM = np.concatenate([rng.integers(0, 5, (40, 15)), rng.integers(500, 505, (40, 15)),
+                          rng.integers(50000, 50005, (40, 15))])
+    for Z in node_clustering.get_approximate_linkages(GDM, ['single', 'average'], n_neighbors=3):
+        assert Z.shape == (len(GDM)-1, 4)
+        assert is_valid_linkage(Z)
+        assert np.all(np.diff(Z[:, 2]) >= 0)
+        assert Z[-1, 3] == len(GDM)
+
+def test_approximate_linkage_rejects_other_methods():
+    with pytest.raises(ValueError):
+        node_clustering.get_approximate_linkages(get_test_GDM(), ['single', 'complete'])
+
+@pytest.mark.parametrize('cluster_method', ['single', 'complete', 'average', 'weighted', 'ward'])
+def test_weighted_linkage_with_unit_sizes_matches_scipy(cluster_method):
+    D_cond = node_clustering.get_D_matrix(get_test_GDM(n_nodes=60))
+    Z = node_clustering.get_weighted_linkage(D_cond, np.ones(60), cluster_method)
+    assert is_valid_linkage(Z)
+    assert np.allclose(cophenet(Z), cophenet(linkage(D_cond, method=cluster_method)))
+
+@pytest.mark.parametrize('cluster_method', ['single', 'complete', 'average', 'weighted'])
+def test_collapsed_linkage_matches_scipy_on_all_nodes(cluster_method):
+    #300 nodes sharing 40 distinct GDVs:
+    rng = np.random.default_rng(1)
+    GDM = get_test_GDM(n_nodes=40)[rng.integers(0, 40, 300)]
+    D_unique, (Z,) = node_clustering.get_collapsed_linkages(GDM, [cluster_method], num_cores=1)
+    assert len(D_unique) == 40*39//2
+    assert Z.shape == (len(GDM)-1, 4)
+    assert is_valid_linkage(Z)
+    assert np.allclose(cophenet(Z), cophenet(linkage(node_clustering.get_D_matrix(GDM), method=cluster_method)))
@@ -0,0 +1,89 @@
+#--------------------------------------------------------------------------------------------
+# GOAL: check the tile clustering shortcuts (disk cache, cutting every k at once) against scipy
+#--------------------------------------------------------------------------------------------
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import store
+from src import tile_clustering
+
+#--------------------------------------------------------------------------------------------
+
+def get_test_tiles(n_tiles=80, seed=0):
+    """
+    return: DataFrame with random symmetric GCMs, a few of them invalid
+    """
+    rng = np.random.default_rng(seed)
+    GCMs = []
+    for _ in range(n_tiles):
+        A = rng.uniform(-1, 1, (11, 11))
+        GCMs.append((A + A.T)/2)
+    valid = rng.random(n_tiles) > 0.1
+    return pd.DataFrame({'classification': rng.integers(10, 30, n_tiles), 'GCM': GCMs, 'valid_GCM': valid})
+
+def test_cache_is_reused_and_matches_uncached(tmp_path, monkeypatch):
+    tiles = get_test_tiles()
+    uncached = tile_clustering.HierClustering(tiles, method='average')
+    cached = tile_clustering.HierClustering(tiles, method='average', cache=True, cache_dir=str(tmp_path))
+    assert len([filename for filename in os.listdir(tmp_path) if filename.endswith('.npz')]) == 2
+
+    #Distances are reused for another method, and both are reused as they are:
+    def no_pdist(*args, **kwargs):
+        raise AssertionError('the distance matrix should come from the cache')
+    monkeypatch.setattr(tile_clustering, 'pdist', no_pdist)
+    reopened = tile_clustering.HierClustering(tiles, method='average', cache=True, cache_dir=str(tmp_path))
+    single = tile_clustering.HierClustering(tiles, method='single', cache=True, cache_dir=str(tmp_path))
+    for clustering in [cached, reopened]:
+        assert np.array_equal(clustering.dmatrix_cond, uncached.dmatrix_cond)
+        assert np.array_equal(clustering.linkage, uncached.linkage)
+    assert np.array_equal(single.dmatrix_cond, uncached.dmatrix_cond)
+
+def test_cache_is_off_by_default(tmp_path, monkeypatch):
+    monkeypatch.setattr(tile_clustering.config, 'root', str(tmp_path))
+    tile_clustering.HierClustering(get_test_tiles())
+    assert not any(files for _, _, files in os.walk(tmp_path))
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    arrays = {'a': np.zeros(1000)}
+    for i, key in enumerate(['first', 'second', 'third']):
+        store.save_cached_arrays(str(tmp_path), key, arrays, max_bytes=10**9)
+        os.utime(os.path.join(tmp_path, key + '.npz'), (i, i))
+    assert store.load_cached_arrays(str(tmp_path), 'first') is not None
+    store.evict_cached_arrays(str(tmp_path), max_bytes=2*os.path.getsize(os.path.join(tmp_path, 'first.npz')))
+    assert sorted(os.listdir(tmp_path)) == ['first.npz', 'third.npz']
+
+def get_canonical_partition(label_matrix):
+    """
+    return: label matrix with the clusters of each column numbered by first appearance, to compare partitions
+    """
+    return tile_clustering.get_compact_labels(label_matrix, by_size=False)
+
+@pytest.mark.parametrize('method', ['single', 'average', 'ward'])
+def test_cut_linkage_matches_cut_tree(method):
+    from scipy.cluster.hierarchy import cut_tree, linkage
+
+    rng = np.random.default_rng(0)
+    Z = linkage(rng.random((200, 5)), method=method)
+    k_values = [1, 2, 3, 7, 50, 199, 200]
+    label_matrix = tile_clustering.cut_linkage(Z, k_values)
+    #One k per call: cut_tree returns a single cluster for k=n when given several k
+    reference = np.column_stack([cut_tree(Z, n_clusters=[k])[:, 0] for k in k_values])
+    assert np.array_equal(get_canonical_partition(label_matrix), get_canonical_partition(reference))
+
+def test_all_flat_clusters_are_one_based_and_ordered_by_size():
+    import scipy.cluster.hierarchy as shc
+
+    clustering = tile_clustering.HierClustering(get_test_tiles(), method='ward')
+    k_values = list(range(2, 11))
+    label_matrix = clustering.get_all_flat_clusters(k_values)
+    for column, k in enumerate(k_values):
+        labels = label_matrix[:, column]
+        assert labels.min() == 1 and labels.max() == k
+        assert np.all(np.diff(np.bincount(labels)[1:]) <= 0)
+        #Same partition, and same labels, as fcluster relabelled by size:
+        flat_clusters = clustering.relabel_clusters(shc.fcluster(clustering.linkage, t=k, criterion='maxclust'))
+        assert np.array_equal(labels, flat_clusters)